@@ -1,4 +1,5 @@
 from django.contrib import admin
+from . import inventory
 from .models import *
 
 # Organizer Admin
@@ -44,6 +45,30 @@ class TicketAdmin(CommonAdmin):
     list_filter = ("event", "ticket_type", "created_at")
     search_fields = ("name", "event__name")
 
+    # Admin edits bypass the capacity counter, so have it recomputed
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        inventory.reset_allocated_capacity(obj.event_id)
+        if change and "event" in form.changed_data:
+            inventory.reset_allocated_capacity(form.initial["event"])
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        inventory.reset_allocated_capacity(obj.event_id)
+
+    def delete_queryset(self, request, queryset):
+        event_ids = set(queryset.values_list("event_id", flat=True))
+        super().delete_queryset(request, queryset)
+        for event_id in event_ids:
+            inventory.reset_allocated_capacity(event_id)
+
+
+# TicketInventory Admin
+class TicketInventoryAdmin(CommonAdmin):
+    list_display = ("ticket", "total", "reserved", "sold")
+    search_fields = ("ticket__name", "ticket__event__name")
+    readonly_fields = ("reserved", "sold")
+
 
 # Booking Admin
 class BookingAdmin(CommonAdmin):
@@ -56,10 +81,33 @@ class BookingAdmin(CommonAdmin):
         "payment_method",
         "created_at",
     )
-    list_filter = ("ticket__event", "status", "payment_method", "created_at")
+    list_filter = (
+        "ticket__event",
+        "status",
+        "payment_method",
+        "needs_refund",
+        "created_at",
+    )
     search_fields = ("user__username", "ticket__event__name")
 
 
+# Payment Admin
+class PaymentAdmin(CommonAdmin):
+    list_display = (
+        "order_id",
+        "user",
+        "event",
+        "gateway",
+        "pidx",
+        "amount",
+        "refunded_amount",
+        "status",
+        "created_at",
+    )
+    list_filter = ("status", "gateway", "created_at")
+    search_fields = ("order_id", "pidx", "user__email")
+
+
 # Media Admin
 class MediaAdmin(CommonAdmin):
     list_display = ("event", "media_type", "caption_eng", "caption_nep")
@@ -88,6 +136,13 @@ class QRCodeAdmin(CommonAdmin):
     search_fields = ("booking__user__username",)
 
 
+# CheckIn Admin
+class CheckInAdmin(CommonAdmin):
+    list_display = ("booking", "event", "gate", "checked_in_at", "reentry_attempts")
+    list_filter = ("event", "gate")
+    search_fields = ("booking__user__email", "batch_id")
+
+
 # EventAnalytics Admin
 class EventAnalyticsAdmin(CommonAdmin):
     list_display = ("event", "user", "views", "clicks", "last_viewed_at")
@@ -106,10 +161,13 @@ class EventReviewAdmin(CommonAdmin):
 admin.site.register(Organizer, OrganizerAdmin)
 admin.site.register(Event, EventAdmin)
 admin.site.register(Ticket, TicketAdmin)
+admin.site.register(TicketInventory, TicketInventoryAdmin)
 admin.site.register(Booking, BookingAdmin)
+admin.site.register(Payment, PaymentAdmin)
 admin.site.register(Media, MediaAdmin)
 admin.site.register(AuditLog, AuditLogAdmin)
 admin.site.register(Notification, NotificationAdmin)
 admin.site.register(QRCode, QRCodeAdmin)
+admin.site.register(CheckIn, CheckInAdmin)
 admin.site.register(EventAnalytics, EventAnalyticsAdmin)
 admin.site.register(EventReview, EventReviewAdmin)
@@ -1,5 +1,27 @@
 from django.apps import AppConfig
+from django.conf import settings
+
 
 class EventmainConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "Eventmain"
+
+    def ready(self):
+        import Eventmain.checks
+        from . import background, holds, idempotency, reconciliation
+
+        background.register_periodic(
+            "expire-booking-holds",
+            settings.BOOKING_HOLD_SWEEP_INTERVAL,
+            holds.expire_stale_holds,
+        )
+        background.register_periodic(
+            "purge-idempotency-keys",
+            settings.IDEMPOTENCY_PURGE_INTERVAL,
+            idempotency.purge_expired_keys,
+        )
+        background.register_periodic(
+            "reconcile-khalti-payments",
+            settings.KHALTI_RECONCILE_INTERVAL,
+            reconciliation.reconcile_payments,
+        )
@@ -0,0 +1,83 @@
+"""
+In-process background tasks.
+
+Periodic jobs (hold sweeping and friends) are registered here from the
+apps' `ready()` hooks and run on daemon threads when
+settings.BACKGROUND_TASKS_ENABLED is on. Every job also has a management
+command, so deployments that prefer cron can leave the setting off.
+
+`submit()` runs one-off work (such as a Khalti initiation) on a shared
+thread pool of settings.BACKGROUND_WORKERS threads, off the request path.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+_periodic_tasks = {}
+_executor = None
+_lock = threading.Lock()
+
+
+class PeriodicTask(threading.Thread):
+    """Daemon thread calling `func` every `interval` seconds."""
+
+    def __init__(self, name, interval, func):
+        super().__init__(name=name, daemon=True)
+        self.interval = interval
+        self.func = func
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.func()
+            except Exception:
+                logger.exception(f"Periodic task {self.name} failed")
+            finally:
+                close_old_connections()
+
+    def stop(self):
+        self._stopped.set()
+
+
+def register_periodic(name, interval, func):
+    """
+    Start `func` as a periodic task, once per process. Does nothing when
+    background tasks are disabled or `interval` is not positive.
+    """
+    if not settings.BACKGROUND_TASKS_ENABLED or interval <= 0:
+        return None
+    with _lock:
+        if name not in _periodic_tasks:
+            task = PeriodicTask(name, interval, func)
+            task.start()
+            _periodic_tasks[name] = task
+            logger.info(f"Started periodic task {name} every {interval}s")
+        return _periodic_tasks[name]
+
+
+def _run(func, args, kwargs):
+    try:
+        return func(*args, **kwargs)
+    except Exception:
+        logger.exception(f"Background job {func.__name__} failed")
+        raise
+    finally:
+        close_old_connections()
+
+
+def submit(func, *args, **kwargs):
+    """Run `func(*args, **kwargs)` on the background pool; returns a Future."""
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.BACKGROUND_WORKERS, thread_name_prefix="background"
+            )
+    return _executor.submit(_run, func, args, kwargs)
@@ -0,0 +1,114 @@
+"""
+Gate check-in.
+
+Scanners send the QR payloads they read in batches. `check_in_batch`
+verifies every signature in memory, loads the scanned bookings with one
+query, inserts the admissions with one bulk INSERT and reads back the rows
+of its own batch to tell admissions from scans that lost to an earlier
+check-in, so a batch costs a handful of queries whatever its size.
+
+The unique constraint on CheckIn.booking is what keeps a ticket from being
+admitted twice, also across gates checking in concurrently. Scans of a
+booking already in are reported as re-entries and counted on its CheckIn.
+"""
+
+import logging
+import uuid
+
+from django.db import transaction
+from django.db.models import F
+
+from . import tickets
+from .models import Booking, CheckIn
+
+logger = logging.getLogger(__name__)
+
+
+def check_in_batch(event_id, scans, gate="", user=None):
+    """
+    Check in the QR payloads in `scans` for the event `event_id`.
+
+    Returns a dict with the batch id, the booking ids `admitted`, the
+    `reentries` (booking, first check-in time and gate) and the `rejected`
+    scans (index in `scans` and reason).
+    """
+    batch_id = uuid.uuid4()
+    rejected = []
+    scanned = {}
+    duplicates = []
+    for index, payload in enumerate(scans):
+        try:
+            booking_id = tickets.verify_ticket(payload)["booking"]
+        except tickets.InvalidTicket as exc:
+            rejected.append({"scan": index, "reason": str(exc)})
+            continue
+        if booking_id in scanned:
+            duplicates.append(booking_id)
+        else:
+            scanned[booking_id] = index
+
+    bookings = {
+        booking_id: (status, booking_event)
+        for booking_id, status, booking_event in Booking.objects.filter(
+            pk__in=scanned
+        ).values_list("id", "status", "ticket__event_id")
+    }
+    valid = []
+    for booking_id, index in scanned.items():
+        status, booking_event = bookings.get(booking_id, (None, None))
+        if status is None:
+            rejected.append({"scan": index, "reason": "unknown_booking"})
+        elif booking_event != event_id:
+            rejected.append({"scan": index, "reason": "wrong_event"})
+        elif status != "paid":
+            rejected.append({"scan": index, "reason": f"booking_{status}"})
+        else:
+            valid.append(booking_id)
+
+    with transaction.atomic():
+        # Bookings already checked in conflict and are skipped
+        CheckIn.objects.bulk_create(
+            [
+                CheckIn(
+                    booking_id=booking_id,
+                    event_id=event_id,
+                    gate=gate,
+                    batch_id=batch_id,
+                    checked_in_by=user,
+                )
+                for booking_id in valid
+            ],
+            ignore_conflicts=True,
+        )
+        admitted = set(
+            CheckIn.objects.filter(batch_id=batch_id).values_list(
+                "booking_id", flat=True
+            )
+        )
+        # Scans of bookings checked in earlier, or twice in this batch
+        reentered = {booking_id for booking_id in valid if booking_id not in admitted}
+        reentered.update(booking_id for booking_id in duplicates if booking_id in valid)
+        reentries = []
+        if reentered:
+            CheckIn.objects.filter(booking_id__in=reentered).update(
+                reentry_attempts=F("reentry_attempts") + 1
+            )
+            reentries = [
+                {"booking": booking_id, "checked_in_at": checked_in_at, "gate": at}
+                for booking_id, checked_in_at, at in CheckIn.objects.filter(
+                    booking_id__in=reentered
+                )
+                .order_by("booking_id")
+                .values_list("booking_id", "checked_in_at", "gate")
+            ]
+
+    if reentries:
+        logger.warning(
+            f"{len(reentries)} re-entry attempts at event {event_id}, gate {gate!r}"
+        )
+    return {
+        "batch_id": str(batch_id),
+        "admitted": sorted(admitted),
+        "reentries": reentries,
+        "rejected": sorted(rejected, key=lambda scan: scan["scan"]),
+    }
@@ -0,0 +1,155 @@
+"""
+Checkout of one or more ticket lines as a single order.
+
+All lines of an order are reserved in one transaction, in ticket id order so
+concurrent carts always lock inventory rows in the same sequence, and their
+bookings are inserted with one bulk INSERT sharing an `order_id`. The order
+id is what Khalti receives as `purchase_order_id`.
+"""
+
+import uuid
+
+from django.db import transaction
+
+from . import holds, inventory
+from .models import Booking, Payment, Ticket
+
+
+class CheckoutError(Exception):
+    """Raised when a cart cannot be checked out."""
+
+
+def parse_lines(items):
+    """
+    Turn `[{"ticket_id": .., "quantity": ..}, ...]` into a list of
+    `(ticket_id, quantity)` pairs, merging repeated tickets.
+    """
+    if not isinstance(items, list) or not items:
+        raise CheckoutError("items must be a non-empty list")
+
+    quantities = {}
+    for item in items:
+        try:
+            ticket_id = int(item["ticket_id"])
+            quantity = int(item["quantity"])
+        except (KeyError, TypeError, ValueError):
+            raise CheckoutError("Each item needs an integer ticket_id and quantity")
+        if quantity <= 0:
+            raise CheckoutError("Quantity must be a positive integer.")
+        quantities[ticket_id] = quantities.get(ticket_id, 0) + quantity
+    return sorted(quantities.items())
+
+
+def reserve_order(user, lines, payment_method="khalti"):
+    """
+    Reserve every `(ticket_id, quantity)` line and create pending bookings.
+
+    Returns `(order_id, bookings, remaining)` where `remaining` maps ticket
+    ids to the seats left after the reservation. A Payment row in the
+    "initiating" state is created for the order alongside the bookings.
+
+    Raises CheckoutError for unknown tickets or carts spanning several
+    events, and inventory.InsufficientInventory (with the ticket on
+    `exc.ticket`) when a line cannot be covered; nothing is reserved in
+    either case.
+    """
+    tickets = Ticket.objects.select_related("event").in_bulk(
+        [ticket_id for ticket_id, _ in lines]
+    )
+    missing = [ticket_id for ticket_id, _ in lines if ticket_id not in tickets]
+    if missing:
+        raise CheckoutError(f"Ticket(s) not found: {missing}")
+    if len({ticket.event_id for ticket in tickets.values()}) > 1:
+        raise CheckoutError("All tickets in an order must belong to the same event")
+
+    order_id = uuid.uuid4().hex
+    hold_expires_at = holds.hold_deadline()
+    remaining = {}
+    with transaction.atomic():
+        for ticket_id, quantity in sorted(lines):
+            ticket = tickets[ticket_id]
+            try:
+                remaining[ticket_id] = inventory.reserve(ticket, quantity)
+            except inventory.InsufficientInventory as exc:
+                exc.ticket = ticket
+                raise
+        bookings = Booking.objects.bulk_create(
+            [
+                Booking(
+                    user=user,
+                    ticket=tickets[ticket_id],
+                    quantity=quantity,
+                    total_amount=tickets[ticket_id].price * quantity,
+                    status="pending",  # Will change to 'paid' after callback
+                    payment_method=payment_method,
+                    order_id=order_id,
+                    hold_expires_at=hold_expires_at,
+                )
+                for ticket_id, quantity in lines
+            ]
+        )
+        Payment.objects.create(
+            user=user,
+            order_id=order_id,
+            event_id=bookings[0].ticket.event_id,
+            amount=sum(booking.total_amount for booking in bookings),
+        )
+    return order_id, bookings, remaining
+
+
+def discard_order(bookings):
+    """Delete the pending bookings of an order and free their seats."""
+    with transaction.atomic():
+        for booking in bookings:
+            inventory.release(booking.ticket_id, booking.quantity)
+        Booking.objects.filter(pk__in=[booking.pk for booking in bookings]).delete()
+
+
+def khalti_payload(order_id, bookings, user, return_url, website_url):
+    """Build the Khalti e-payment initiation payload for an order."""
+    event = bookings[0].ticket.event
+    total_amount = sum(booking.total_amount for booking in bookings)
+    return {
+        "return_url": return_url,
+        "website_url": website_url,
+        "amount": int(total_amount * 100),  # Convert Rs to paisa
+        "purchase_order_id": order_id,
+        "purchase_order_name": f"Ticket for {event.name}",
+        "customer_info": {
+            "name": user.get_full_name() or user.username,
+            "email": user.email,
+        },
+        "amount_breakdown": [
+            {
+                "label": f"{booking.ticket.name} x {booking.quantity}",
+                "amount": int(booking.total_amount * 100),
+            }
+            for booking in bookings
+        ],
+        "product_details": [
+            {
+                "identity": str(booking.ticket.id),
+                "name": booking.ticket.name,
+                "total_price": int(booking.total_amount * 100),
+                "quantity": booking.quantity,
+                "unit_price": int(booking.ticket.price * 100),
+            }
+            for booking in bookings
+        ],
+    }
+
+
+def booking_order_id(booking):
+    """Return the order id a booking was (or would be) paid under."""
+    return booking.order_id or str(booking.id)
+
+
+def order_bookings(purchase_order_id):
+    """
+    Return a queryset of the bookings paid by a Khalti `purchase_order_id`.
+    Older single bookings used the booking id itself as the order id.
+    """
+    bookings = Booking.objects.filter(order_id=purchase_order_id)
+    if purchase_order_id.isdigit() and not bookings.exists():
+        bookings = Booking.objects.filter(id=int(purchase_order_id))
+    return bookings
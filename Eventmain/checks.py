@@ -0,0 +1,21 @@
+"""
+System checks run by `manage.py check --deploy`.
+
+The ticket signing key is only loaded when a ticket is first signed or
+verified, so management commands and fresh checkouts start without one;
+these checks make a deploy fail fast instead.
+"""
+
+from django.core.checks import Error, Tags, register
+from django.core.exceptions import ImproperlyConfigured
+
+
+@register(Tags.security, deploy=True)
+def check_ticket_signing_key(app_configs, **kwargs):
+    from . import tickets
+
+    try:
+        tickets.signing_key()
+    except ImproperlyConfigured as e:
+        return [Error(str(e), id="Eventmain.E001")]
+    return []
@@ -0,0 +1,72 @@
+"""
+Pending booking holds.
+
+A pending booking reserves its seats until `hold_expires_at`. Checkouts that
+are abandoned before Khalti redirects back are expired here in batches and
+their seats are handed back to the ticket inventory. Pending bookings
+without a deadline (created outside checkout, e.g. in the admin) are held
+for BOOKING_HOLD_MINUTES from their creation.
+"""
+
+import logging
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import inventory
+from .models import Booking
+
+logger = logging.getLogger(__name__)
+
+
+def hold_deadline(now=None):
+    """Return the hold deadline for a booking created at `now`."""
+    return (now or timezone.now()) + timedelta(minutes=settings.BOOKING_HOLD_MINUTES)
+
+
+def expire_stale_holds(batch_size=500, now=None):
+    """
+    Expire pending bookings whose hold has run out and release their seats.
+
+    Works through the backlog `batch_size` bookings at a time, each batch in
+    its own transaction. Returns the number of bookings expired.
+    """
+    now = now or timezone.now()
+    hold = timedelta(minutes=settings.BOOKING_HOLD_MINUTES)
+    expired = 0
+    while True:
+        with transaction.atomic():
+            stale = list(
+                Booking.objects.select_for_update(skip_locked=True)
+                .filter(
+                    Q(hold_expires_at__lte=now)
+                    | Q(hold_expires_at__isnull=True, created_at__lte=now - hold),
+                    status="pending",
+                )
+                .order_by("id")
+                .values_list("id", "ticket_id", "quantity")[:batch_size]
+            )
+            if not stale:
+                break
+
+            Booking.objects.filter(
+                id__in=[booking_id for booking_id, _, _ in stale], status="pending"
+            ).update(status="expired")
+
+            released = defaultdict(int)
+            for _, ticket_id, quantity in stale:
+                released[ticket_id] += quantity
+            for ticket_id, quantity in released.items():
+                inventory.release(ticket_id, quantity)
+
+        expired += len(stale)
+        if len(stale) < batch_size:
+            break
+
+    if expired:
+        logger.info(f"Expired {expired} stale booking holds")
+    return expired
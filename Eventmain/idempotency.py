@@ -0,0 +1,151 @@
+"""
+Idempotency-Key support for booking endpoints.
+
+A client that sends the same `Idempotency-Key` header again (for example
+after a timeout) gets the stored response of the first request replayed,
+without reserving seats or calling Khalti a second time.
+
+While the first request is processed, duplicates get a 409. A request that
+crashed or timed out before storing its response would block its key for
+its whole TTL, so a retry with the same request takes the key over once it
+has been claimed for IDEMPOTENCY_CLAIM_TIMEOUT_SECONDS. Only the request
+holding the claim stores its response.
+"""
+
+import functools
+import hashlib
+import json
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+logger = logging.getLogger(__name__)
+
+HEADER = "Idempotency-Key"
+
+
+def _request_hash(request):
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(f"{request.method}:{body}".encode()).hexdigest()
+
+
+def _claim(user, endpoint, key, request_hash):
+    """
+    Insert the key for a new request. Returns `(record, created)` where
+    `record` is either the new row or the live row of an earlier request;
+    an existing record that has expired is replaced, and a stale claim of
+    the same request is taken over.
+    """
+    now = timezone.now()
+    fields = {
+        "request_hash": request_hash,
+        "claimed_at": now,
+        "expires_at": now + timedelta(hours=settings.IDEMPOTENCY_KEY_TTL_HOURS),
+    }
+    stale = now - timedelta(seconds=settings.IDEMPOTENCY_CLAIM_TIMEOUT_SECONDS)
+    keys = IdempotencyKey.objects.filter(user=user, endpoint=endpoint, key=key)
+    # Each round either inserts the key or finds the row that holds it; a
+    # row that disappears or expires in between only costs another round
+    while True:
+        try:
+            with transaction.atomic():
+                record = IdempotencyKey.objects.create(
+                    user=user, endpoint=endpoint, key=key, **fields
+                )
+            return record, True
+        except IntegrityError:
+            pass
+        record = keys.filter(expires_at__gt=now).first()
+        if record is None:
+            keys.filter(expires_at__lte=now).delete()
+            continue
+        abandoned = (
+            record.status_code is None
+            and record.request_hash == request_hash
+            and record.claimed_at <= stale
+        )
+        # Only one retry wins the takeover of an abandoned claim
+        if abandoned and keys.filter(
+            pk=record.pk, status_code__isnull=True, claimed_at=record.claimed_at
+        ).update(**fields):
+            for field, value in fields.items():
+                setattr(record, field, value)
+            return record, True
+        return record, False
+
+
+def idempotent(view_method):
+    """
+    Make a viewset method honor the `Idempotency-Key` header.
+
+    Responses below 500 are stored and replayed for duplicate requests;
+    server errors drop the key so the client can retry.
+    """
+
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key or not request.user.is_authenticated:
+            return view_method(self, request, *args, **kwargs)
+        if len(key) > 255:
+            return Response(
+                {"error": f"{HEADER} must be at most 255 characters."},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        endpoint = f"{self.basename}-{self.action}"
+        request_hash = _request_hash(request)
+        record, created = _claim(request.user, endpoint, key, request_hash)
+
+        if not created:
+            if record.request_hash != request_hash:
+                return Response(
+                    {"error": f"{HEADER} was already used with a different request."},
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                )
+            if record.status_code is None:
+                response = Response(
+                    {"error": "The original request is still being processed."},
+                    status=status.HTTP_409_CONFLICT,
+                )
+                response["Retry-After"] = "1"
+                return response
+            response = Response(record.response_body, status=record.status_code)
+            response["Idempotent-Replayed"] = "true"
+            return response
+
+        # Left alone when a retry took the key over meanwhile
+        claim = IdempotencyKey.objects.filter(
+            pk=record.pk, claimed_at=record.claimed_at
+        )
+        try:
+            response = view_method(self, request, *args, **kwargs)
+        except Exception:
+            claim.delete()
+            raise
+
+        if response.status_code >= 500 or not hasattr(response, "data"):
+            claim.delete()
+        else:
+            claim.update(
+                status_code=response.status_code,
+                response_body=json.loads(json.dumps(response.data, default=str)),
+            )
+        return response
+
+    return wrapper
+
+
+def purge_expired_keys():
+    """Delete idempotency keys past their TTL."""
+    deleted, _ = IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).delete()
+    if deleted:
+        logger.info(f"Purged {deleted} expired idempotency keys")
+    return deleted
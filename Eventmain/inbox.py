@@ -0,0 +1,120 @@
+"""
+Per-user notification inbox.
+
+Clients page through their notifications newest first with an opaque
+cursor holding the `(created_at, id)` of the last row they got. Each page is
+one range scan of the (user, created_at, id) index that stops after the
+page, so neither deep pages nor a large table make it slower, and no
+COUNT(*) is run.
+
+The unread count is cached per user for INBOX_UNREAD_CACHE_TIMEOUT seconds
+and dropped with `forget_unread` whenever notifications are recorded for
+or read by a user, once the write commits: dropping it earlier would let a
+recount cache the count from before the write. The timeout bounds how stale
+it can get if a write races with a recount. Notifications are recorded by
+outbox workers and other processes, so the count is only cached when the
+default cache is shared between processes (settings.CACHE_URL); a local
+memory cache would keep serving counts those processes never drop.
+
+Notifications waiting for a digest are left out: they are replaced by the
+digest's summary when it is sent.
+"""
+
+import base64
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Notification
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def notifications_of(user_id):
+    return Notification.objects.filter(user_id=user_id).exclude(status="digest")
+
+
+def encode_cursor(notification):
+    position = f"{notification.created_at.isoformat()}|{notification.pk}"
+    return base64.urlsafe_b64encode(position.encode()).rstrip(b"=").decode()
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, pk = base64.urlsafe_b64decode(padded).decode().split("|")
+        return datetime.fromisoformat(created_at), int(pk)
+    except ValueError as exc:
+        raise InvalidCursor("Invalid cursor") from exc
+
+
+def page(user_id, cursor=None, size=20):
+    """
+    Return `(notifications, next_cursor)`: the `size` notifications of
+    `user_id` that follow `cursor`, newest first. `next_cursor` is None on
+    the last page.
+    """
+    notifications = notifications_of(user_id)
+    if cursor:
+        created_at, pk = decode_cursor(cursor)
+        notifications = notifications.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=pk)
+        )
+    # One extra row tells whether there is a next page
+    rows = list(notifications.order_by("-created_at", "-id")[: size + 1])
+    if len(rows) > size:
+        return rows[:size], encode_cursor(rows[size - 1])
+    return rows, None
+
+
+def _unread_key(user_id):
+    return f"notification-unread:{user_id}"
+
+
+def _cached():
+    return not isinstance(caches["default"], LocMemCache)
+
+
+def unread_count(user_id):
+    def count():
+        return notifications_of(user_id).filter(read_at__isnull=True).count()
+
+    if not _cached():
+        return count()
+    key = _unread_key(user_id)
+    unread = cache.get(key)
+    if unread is None:
+        unread = count()
+        cache.set(key, unread, timeout=settings.INBOX_UNREAD_CACHE_TIMEOUT)
+    return unread
+
+
+def forget_unread(user_ids):
+    """
+    Drop the cached unread counts of `user_ids` when the current
+    transaction commits, or right away outside of one.
+    """
+    keys = [_unread_key(user_id) for user_id in user_ids]
+    transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def mark_read(user_id, ids=None):
+    """
+    Mark the unread notifications of `user_id` with an id in `ids` read,
+    or all of them when `ids` is None, with one UPDATE. Returns the number
+    of notifications marked.
+    """
+    notifications = notifications_of(user_id).filter(read_at__isnull=True)
+    if ids is not None:
+        notifications = notifications.filter(pk__in=ids)
+    marked = notifications.update(read_at=timezone.now())
+    if marked:
+        forget_unread([user_id])
+    return marked
@@ -0,0 +1,214 @@
+"""
+Ticket inventory reservation.
+
+Every ticket has one TicketInventory row holding `total`, `reserved` and
+`sold` counters. Seats are reserved with a single conditional UPDATE on that
+row, so availability checks never aggregate over the Booking table and two
+concurrent buyers cannot both take the last seat: the database serialises
+the UPDATEs on the row and the second one simply matches zero rows.
+
+Callers that create or change bookings should run these helpers inside the
+same `transaction.atomic()` block as the booking write.
+"""
+
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
+
+from .models import Booking, Event, Ticket, TicketInventory
+
+# Booking statuses that hold seats, and which counter they are held in
+HELD_STATUSES = {"pending": "reserved", "paid": "sold", "refunding": "sold"}
+
+
+class InsufficientInventory(Exception):
+    """Raised when a ticket does not have enough seats left."""
+
+    def __init__(self, available):
+        self.available = available
+        super().__init__(
+            f"Only {available} tickets are available for this ticket type."
+        )
+
+
+class CapacityExceeded(Exception):
+    """Raised when ticket quantities would exceed the event capacity."""
+
+    def __init__(self, requested, capacity):
+        self.requested = requested
+        self.capacity = capacity
+        super().__init__(
+            f"Total ticket quantity ({requested}) exceeds event capacity ({capacity})."
+        )
+
+
+def _build_inventory(ticket):
+    """
+    Create the inventory row for a ticket that predates the counters,
+    seeding it from the existing bookings.
+    """
+    counts = dict(
+        Booking.objects.filter(ticket_id=ticket.pk, status__in=HELD_STATUSES)
+        .values_list("status")
+        .annotate(total=models.Sum("quantity"))
+    )
+    try:
+        with transaction.atomic():
+            inventory, _ = TicketInventory.objects.get_or_create(
+                ticket_id=ticket.pk,
+                defaults={
+                    "total": ticket.quantity,
+                    "reserved": counts.get("pending") or 0,
+                    "sold": counts.get("paid") or 0,
+                },
+            )
+    except IntegrityError:
+        inventory = TicketInventory.objects.get(ticket_id=ticket.pk)
+    return inventory
+
+
+def get_inventory(ticket):
+    try:
+        return TicketInventory.objects.get(ticket_id=ticket.pk)
+    except TicketInventory.DoesNotExist:
+        return _build_inventory(ticket)
+
+
+def available(ticket):
+    """Return the number of seats still available for a ticket."""
+    return get_inventory(ticket).available
+
+
+def reserve(ticket, quantity):
+    """
+    Hold `quantity` seats of `ticket` for a pending booking.
+
+    Returns the number of seats remaining after the reservation, or raises
+    InsufficientInventory if the ticket cannot cover the request.
+    """
+    for _ in range(2):
+        updated = TicketInventory.objects.filter(
+            ticket_id=ticket.pk,
+            total__gte=F("reserved") + F("sold") + quantity,
+        ).update(reserved=F("reserved") + quantity)
+        inventory = get_inventory(ticket)
+        if updated:
+            return inventory.available
+        if inventory.available < quantity:
+            raise InsufficientInventory(inventory.available)
+        # The row was only just created by get_inventory, try once more
+    raise InsufficientInventory(get_inventory(ticket).available)
+
+
+def release(ticket_id, quantity):
+    """Return seats held by a pending booking to the pool."""
+    TicketInventory.objects.filter(ticket_id=ticket_id, reserved__gte=quantity).update(
+        reserved=F("reserved") - quantity
+    )
+
+
+def confirm(ticket_id, quantity, held=True):
+    """
+    Mark seats as sold. `held` says whether they were reserved by a pending
+    booking first (they are not when a late payment revives a dead hold).
+
+    Unheld seats are taken with the same conditional UPDATE as `reserve`,
+    as they may have been sold to someone else since. Returns whether the
+    seats were confirmed.
+    """
+    if held:
+        return bool(
+            TicketInventory.objects.filter(
+                ticket_id=ticket_id, reserved__gte=quantity
+            ).update(reserved=F("reserved") - quantity, sold=F("sold") + quantity)
+        )
+    return bool(
+        TicketInventory.objects.filter(
+            ticket_id=ticket_id, total__gte=F("reserved") + F("sold") + quantity
+        ).update(sold=F("sold") + quantity)
+    )
+
+
+def restock(ticket_id, quantity):
+    """Return sold seats to the pool, e.g. after a refund."""
+    TicketInventory.objects.filter(ticket_id=ticket_id, sold__gte=quantity).update(
+        sold=F("sold") - quantity
+    )
+
+
+def apply_status_change(ticket_id, quantity, old_status, new_status):
+    """Move a booking's seats between counters after a status change."""
+    old_counter = HELD_STATUSES.get(old_status)
+    new_counter = HELD_STATUSES.get(new_status)
+    if old_counter == new_counter:
+        return
+    if new_counter == "sold":
+        confirm(ticket_id, quantity, held=old_counter == "reserved")
+    elif old_counter == "reserved":
+        release(ticket_id, quantity)
+    elif old_counter == "sold":
+        restock(ticket_id, quantity)
+
+
+# ===== EVENT CAPACITY =====
+
+
+def count_allocated_capacity(event_id):
+    """Aggregate the ticket quantities of an event in the database."""
+    return (
+        Ticket.objects.filter(event_id=event_id).aggregate(
+            total=models.Sum("quantity")
+        )["total"]
+        or 0
+    )
+
+
+def allocated_capacity(event):
+    """
+    Return the capacity already given to tickets of `event`, falling back to
+    an aggregate when the counter has not been computed yet.
+    """
+    if event.allocated_capacity is not None:
+        return event.allocated_capacity
+    return count_allocated_capacity(event.pk)
+
+
+def allocate_capacity(event, delta):
+    """
+    Add `delta` to the event's allocated capacity (negative to free it).
+
+    Growth is applied with a conditional UPDATE so concurrent ticket edits
+    cannot push the event past its capacity; raises CapacityExceeded when
+    the new total does not fit. Must run inside the ticket's transaction.
+    """
+    if delta == 0:
+        return
+    counter = Event.objects.filter(pk=event.pk, allocated_capacity__isnull=False)
+    if delta < 0:
+        if counter.filter(allocated_capacity__gte=-delta).update(
+            allocated_capacity=F("allocated_capacity") + delta
+        ):
+            return
+    elif counter.filter(capacity__gte=F("allocated_capacity") + delta).update(
+        allocated_capacity=F("allocated_capacity") + delta
+    ):
+        return
+
+    # Either the counter is full or it was never computed; settle it under
+    # the event row lock.
+    locked = (
+        Event.objects.select_for_update()
+        .only("capacity", "allocated_capacity")
+        .get(pk=event.pk)
+    )
+    current = locked.allocated_capacity
+    if current is None:
+        current = count_allocated_capacity(event.pk)
+    requested = max(current + delta, 0)
+    if delta > 0 and requested > locked.capacity:
+        raise CapacityExceeded(requested, locked.capacity)
+    Event.objects.filter(pk=event.pk).update(allocated_capacity=requested)
+
+
+def reset_allocated_capacity(event_id):
+    """Forget the counter so it is recomputed from the tickets on next use."""
+    Event.objects.filter(pk=event_id).update(allocated_capacity=None)
@@ -0,0 +1,246 @@
+"""
+Shared HTTP client for the Khalti e-payment API.
+
+All Khalti calls go through one pooled `requests.Session` with connect/read
+timeouts, so TCP/TLS connections are reused and a slow gateway cannot pin a
+worker forever. Lookups are idempotent and are retried with exponential
+backoff; initiations and refunds are not retried. A circuit breaker stops
+calling Khalti for a while after repeated failures, and every call records
+its latency in `metrics`.
+"""
+
+import logging
+import threading
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class KhaltiError(Exception):
+    """Khalti answered with an error response."""
+
+    def __init__(self, message, status_code=None, details=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.details = details
+
+
+class KhaltiUnavailable(KhaltiError):
+    """Khalti could not be reached, timed out, or the circuit is open."""
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures and rejects calls
+    for `reset_timeout` seconds, then lets a single trial call through.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial_running:
+                return False
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning("Khalti circuit opened after repeated failures")
+                self._opened_at = time.monotonic()
+
+
+class CallMetrics:
+    """Per-operation call counts, errors and latency."""
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, operation, seconds, ok):
+        with self._lock:
+            stats = self._stats.setdefault(
+                operation,
+                {"calls": 0, "errors": 0, "total_seconds": 0.0, "max_seconds": 0.0},
+            )
+            stats["calls"] += 1
+            stats["errors"] += 0 if ok else 1
+            stats["total_seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                operation: {
+                    **stats,
+                    "avg_seconds": stats["total_seconds"] / stats["calls"],
+                }
+                for operation, stats in self._stats.items()
+            }
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+class KhaltiClient:
+    def __init__(
+        self,
+        base_url,
+        secret_key,
+        connect_timeout=3.0,
+        read_timeout=10.0,
+        lookup_retries=3,
+        backoff=0.5,
+        pool_size=20,
+        breaker=None,
+    ):
+        self.base_url = base_url.rstrip("/") + "/"
+        self.timeout = (connect_timeout, read_timeout)
+        self.lookup_retries = lookup_retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.metrics = CallMetrics()
+
+        self.session = requests.Session()
+        self.session.headers.update(
+            {
+                "Authorization": f"key {secret_key}",
+                "Content-Type": "application/json",
+            }
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def initiate(self, payload):
+        """Start an e-payment; returns Khalti's `pidx`/`payment_url` data."""
+        return self._post("initiate", "epayment/initiate/", payload)
+
+    def lookup(self, pidx):
+        """Fetch the current state of a payment. Retried on transient errors."""
+        return self._post(
+            "lookup", "epayment/lookup/", {"pidx": pidx}, retries=self.lookup_retries
+        )
+
+    def refund(self, pidx, amount):
+        """Refund `amount` paisa of a completed payment."""
+        return self._post(
+            "refund", "epayment/refund/", {"pidx": pidx, "amount": amount}
+        )
+
+    def _post(self, operation, path, payload, retries=0):
+        attempt = 0
+        while True:
+            try:
+                return self._post_once(operation, path, payload)
+            except KhaltiUnavailable:
+                if attempt >= retries or self.breaker.is_open:
+                    raise
+            except KhaltiError as exc:
+                # Only server side errors are worth retrying
+                if attempt >= retries or (exc.status_code or 0) < 500:
+                    raise
+            time.sleep(self.backoff * 2**attempt)
+            attempt += 1
+
+    def _post_once(self, operation, path, payload):
+        if not self.breaker.allow():
+            raise KhaltiUnavailable("Khalti is temporarily unavailable (circuit open)")
+
+        started = time.monotonic()
+        try:
+            response = self.session.post(
+                self.base_url + path, json=payload, timeout=self.timeout
+            )
+        except requests.RequestException as exc:
+            self._finish(operation, started, ok=False)
+            raise KhaltiUnavailable(f"Khalti {operation} failed: {exc}")
+
+        if response.status_code >= 500:
+            self._finish(operation, started, ok=False)
+            raise KhaltiError(
+                f"Khalti {operation} failed",
+                status_code=response.status_code,
+                details=response.text,
+            )
+
+        # 4xx responses mean Khalti is up, the request itself was refused
+        self._finish(operation, started, ok=True)
+        if response.status_code != 200:
+            raise KhaltiError(
+                f"Khalti {operation} failed",
+                status_code=response.status_code,
+                details=response.text,
+            )
+        return response.json()
+
+    def _finish(self, operation, started, ok):
+        elapsed = time.monotonic() - started
+        self.metrics.record(operation, elapsed, ok)
+        if ok:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+        logger.debug(f"Khalti {operation} took {elapsed * 1000:.0f}ms (ok={ok})")
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the process-wide Khalti client, built from settings."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = KhaltiClient(
+                    base_url=settings.KHALTI_BASE_URL,
+                    secret_key=settings.KHALTI_SECRET_KEY,
+                    connect_timeout=settings.KHALTI_CONNECT_TIMEOUT,
+                    read_timeout=settings.KHALTI_READ_TIMEOUT,
+                    lookup_retries=settings.KHALTI_LOOKUP_RETRIES,
+                    pool_size=settings.KHALTI_POOL_SIZE,
+                    breaker=CircuitBreaker(
+                        failure_threshold=settings.KHALTI_CIRCUIT_FAILURE_THRESHOLD,
+                        reset_timeout=settings.KHALTI_CIRCUIT_RESET_SECONDS,
+                    ),
+                )
+    return _client
+
+
+def reset_client():
+    """Drop the shared client so the next call rebuilds it from settings."""
+    global _client
+    with _client_lock:
+        _client = None
@@ -0,0 +1,135 @@
+"""
+Local stand-in for the Khalti e-payment API.
+
+Runs a small HTTP server on localhost that speaks the initiate, lookup and
+refund endpoints, for tests and load experiments. It can add latency and
+fail a number of calls to simulate a slow or flaky gateway:
+
+    with KhaltiStub(delay=0.2) as stub:
+        client = KhaltiClient(stub.base_url, "test_secret_key")
+        data = client.initiate({...})
+        stub.set_status(data["pidx"], "Completed")
+"""
+
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class KhaltiStub:
+    def __init__(self, delay=0.0, fail_status=503):
+        self.delay = delay
+        self.fail_status = fail_status
+        self.failures_remaining = 0
+        self.payments = {}
+        self.calls = []
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/api/v2/"
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+                status, data = stub.handle(self.path, body)
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def fail_next(self, count, status=None):
+        """Answer the next `count` calls with an error status."""
+        with self._lock:
+            self.failures_remaining = count
+            if status is not None:
+                self.fail_status = status
+
+    def set_status(self, pidx, status):
+        """Set the status a lookup reports, e.g. "Completed" or "Expired"."""
+        with self._lock:
+            self.payments[pidx]["status"] = status
+            if status == "Completed":
+                self.payments[pidx].setdefault("transaction_id", uuid.uuid4().hex)
+
+    def add_payment(self, pidx, amount, status="Initiated", purchase_order_id=""):
+        """Register a payment without going through initiate."""
+        with self._lock:
+            self.payments[pidx] = {
+                "pidx": pidx,
+                "total_amount": amount,
+                "status": status,
+                "purchase_order_id": purchase_order_id,
+            }
+        if status == "Completed":
+            self.set_status(pidx, status)
+
+    def handle(self, path, body):
+        if self.delay:
+            time.sleep(self.delay)
+        with self._lock:
+            self.calls.append((path, body))
+            if self.failures_remaining > 0:
+                self.failures_remaining -= 1
+                return self.fail_status, {"detail": "Simulated gateway failure"}
+
+            if path.endswith("/epayment/initiate/"):
+                pidx = uuid.uuid4().hex
+                self.payments[pidx] = {
+                    "pidx": pidx,
+                    "total_amount": body.get("amount"),
+                    "status": "Initiated",
+                    "purchase_order_id": body.get("purchase_order_id"),
+                }
+                return 200, {
+                    "pidx": pidx,
+                    "payment_url": f"https://test-pay.khalti.com/?pidx={pidx}",
+                }
+
+            payment = self.payments.get(body.get("pidx"))
+            if payment is None:
+                return 404, {"detail": "Not found."}
+            if path.endswith("/epayment/lookup/"):
+                return 200, {
+                    "pidx": payment["pidx"],
+                    "total_amount": payment["total_amount"],
+                    "status": payment["status"],
+                    "transaction_id": payment.get("transaction_id"),
+                    "refunded": payment["status"] == "Refunded",
+                }
+            if path.endswith("/epayment/refund/"):
+                payment["status"] = "Refunded"
+                return 200, {"detail": "Refund successful.", "pidx": payment["pidx"]}
+        return 404, {"detail": "Not found."}
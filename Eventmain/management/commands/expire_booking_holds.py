@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from Eventmain.holds import expire_stale_holds
+
+
+class Command(BaseCommand):
+    help = "Expire pending bookings whose hold deadline has passed and release their seats."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of bookings expired per transaction.",
+        )
+
+    def handle(self, *args, **options):
+        expired = expire_stale_holds(batch_size=options["batch_size"])
+        self.stdout.write(self.style.SUCCESS(f"Expired {expired} booking holds."))
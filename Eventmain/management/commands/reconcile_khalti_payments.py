@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from Eventmain.reconciliation import reconcile_payments
+
+
+class Command(BaseCommand):
+    help = "Look up initiated Khalti payments and settle orders whose callback never arrived."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=200,
+            help="Number of payments looked up per page.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=8,
+            help="Number of concurrent Khalti lookups.",
+        )
+        parser.add_argument(
+            "--min-age",
+            type=int,
+            default=5,
+            help="Only check payments initiated at least this many minutes ago.",
+        )
+
+    def handle(self, *args, **options):
+        stats = reconcile_payments(
+            batch_size=options["batch_size"],
+            workers=options["workers"],
+            min_age_minutes=options["min_age"],
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Checked {stats['checked']} payments: "
+                f"{stats['paid']} bookings paid, {stats['expired']} expired."
+            )
+        )
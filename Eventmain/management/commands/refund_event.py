@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from Eventmain.refunds import refund_event
+
+
+class Command(BaseCommand):
+    help = "Refund every paid booking of an event through Khalti."
+
+    def add_arguments(self, parser):
+        parser.add_argument("event_id", type=int)
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=200,
+            help="Number of bookings refunded per chunk.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=8,
+            help="Number of concurrent Khalti refunds.",
+        )
+
+    def handle(self, *args, **options):
+        stats = refund_event(
+            options["event_id"],
+            chunk_size=options["chunk_size"],
+            workers=options["workers"],
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Refunded {stats['refunded']} bookings, {stats['failed']} failed."
+            )
+        )
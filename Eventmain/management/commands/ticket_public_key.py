@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from Eventmain import signing, tickets
+
+
+class Command(BaseCommand):
+    help = (
+        "Print the public key gate scanners need to verify ticket QR codes "
+        "offline (the public half of TICKET_SIGNING_KEY)."
+    )
+
+    def handle(self, *args, **options):
+        self.stdout.write(signing.public_key_text(tickets.signing_key()))
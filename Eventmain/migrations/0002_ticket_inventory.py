@@ -0,0 +1,81 @@
+# Generated by Django 5.2 on 2026-10-18 16:34
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def build_inventory(apps, schema_editor):
+    Ticket = apps.get_model("Eventmain", "Ticket")
+    Booking = apps.get_model("Eventmain", "Booking")
+    TicketInventory = apps.get_model("Eventmain", "TicketInventory")
+
+    counts = {}
+    held = (
+        Booking.objects.filter(status__in=["pending", "paid"])
+        .values_list("ticket_id", "status")
+        .annotate(total=models.Sum("quantity"))
+    )
+    for ticket_id, status, total in held:
+        counts[(ticket_id, status)] = total
+
+    TicketInventory.objects.bulk_create(
+        [
+            TicketInventory(
+                ticket_id=ticket_id,
+                total=quantity,
+                reserved=counts.get((ticket_id, "pending"), 0),
+                sold=counts.get((ticket_id, "paid"), 0),
+            )
+            for ticket_id, quantity in Ticket.objects.values_list("id", "quantity")
+        ],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Eventmain", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="booking",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("paid", "Paid"),
+                    ("cancelled", "Cancelled"),
+                    ("refunded", "Refunded"),
+                ],
+                max_length=10,
+            ),
+        ),
+        migrations.CreateModel(
+            name="TicketInventory",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("total", models.PositiveIntegerField()),
+                ("reserved", models.PositiveIntegerField(default=0)),
+                ("sold", models.PositiveIntegerField(default=0)),
+                (
+                    "ticket",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="inventory",
+                        to="Eventmain.ticket",
+                    ),
+                ),
+            ],
+        ),
+        migrations.RunPython(build_inventory, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2 on 2026-10-18 16:36
+
+from django.db import migrations, models
+
+
+def count_allocated_capacity(apps, schema_editor):
+    Event = apps.get_model("Eventmain", "Event")
+    Ticket = apps.get_model("Eventmain", "Ticket")
+
+    allocated = dict(
+        Ticket.objects.values_list("event_id").annotate(total=models.Sum("quantity"))
+    )
+    events = list(Event.objects.only("id"))
+    for event in events:
+        event.allocated_capacity = allocated.get(event.id, 0)
+    Event.objects.bulk_update(events, ["allocated_capacity"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Eventmain", "0003_booking_hold_expiry"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="event",
+            name="allocated_capacity",
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(count_allocated_capacity, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 16:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Eventmain", "0004_event_allocated_capacity"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="booking",
+            name="order_id",
+            field=models.CharField(blank=True, db_index=True, max_length=32, null=True),
+        ),
+    ]
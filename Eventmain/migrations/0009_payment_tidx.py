@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 16:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Eventmain", "0008_payment_reconciliation"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="payment",
+            name="tidx",
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
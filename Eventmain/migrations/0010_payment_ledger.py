@@ -0,0 +1,109 @@
+# Generated by Django 5.2 on 2026-10-18 16:45
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def fill_ledger(apps, schema_editor):
+    Booking = apps.get_model("Eventmain", "Booking")
+    Payment = apps.get_model("Eventmain", "Payment")
+
+    # Amount and event of the orders already in the ledger
+    orders = {}
+    for order_id, event_id, amount in Booking.objects.filter(
+        order_id__isnull=False
+    ).values_list("order_id", "ticket__event_id", "total_amount"):
+        total = orders.get(order_id, (event_id, 0))[1]
+        orders[order_id] = (event_id, total + amount)
+    payments = list(Payment.objects.filter(order_id__in=orders))
+    for payment in payments:
+        payment.event_id, payment.amount = orders[payment.order_id]
+    Payment.objects.bulk_update(payments, ["event", "amount"], batch_size=500)
+
+    # Single bookings paid before the ledger existed, keyed by booking id
+    Payment.objects.bulk_create(
+        [
+            Payment(
+                user_id=booking.user_id,
+                event_id=booking.ticket.event_id,
+                order_id=str(booking.id),
+                amount=booking.total_amount,
+                refunded_amount=(
+                    booking.total_amount if booking.status == "refunded" else 0
+                ),
+                status="completed" if booking.status == "paid" else "refunded",
+            )
+            for booking in Booking.objects.filter(
+                order_id__isnull=True, status__in=["paid", "refunded"]
+            ).select_related("ticket")
+        ],
+        batch_size=500,
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Eventmain", "0009_payment_tidx"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="payment",
+            name="amount",
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name="payment",
+            name="event",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                related_name="payments",
+                to="Eventmain.event",
+            ),
+        ),
+        migrations.AddField(
+            model_name="payment",
+            name="gateway",
+            field=models.CharField(
+                choices=[("khalti", "Khalti")], default="khalti", max_length=20
+            ),
+        ),
+        migrations.AddField(
+            model_name="payment",
+            name="refunded_amount",
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name="payment",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("initiating", "Initiating"),
+                    ("initiated", "Initiated"),
+                    ("completed", "Completed"),
+                    ("refunded", "Refunded"),
+                    ("expired", "Expired"),
+                    ("failed", "Failed"),
+                ],
+                default="initiating",
+                max_length=20,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(fields=["status", "id"], name="payment_status_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="payment",
+            index=models.Index(
+                fields=["event", "status"], name="payment_event_status_idx"
+            ),
+        ),
+        migrations.RunPython(fill_ledger, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2 on 2026-10-18 16:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Eventmain", "0011_notification_pending_status"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="qrcode",
+            name="content_hash",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+        migrations.AddField(
+            model_name="qrcode",
+            name="image",
+            field=models.BinaryField(default=b""),
+        ),
+        migrations.AddField(
+            model_name="qrcode",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
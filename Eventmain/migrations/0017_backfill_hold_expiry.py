@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations
+from django.db.models import F
+
+
+def backfill_hold_expiry(apps, schema_editor):
+    """Give pending bookings made before holds existed their hold deadline."""
+    Booking = apps.get_model("Eventmain", "Booking")
+    Booking.objects.filter(status="pending", hold_expires_at__isnull=True).update(
+        hold_expires_at=F("created_at")
+        + timedelta(minutes=settings.BOOKING_HOLD_MINUTES)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Eventmain", "0016_notification_inbox"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_hold_expiry, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2 on 2026-10-18 17:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Eventmain", "0017_backfill_hold_expiry"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="booking",
+            name="needs_refund",
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2 on 2026-10-18 18:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("Eventmain", "0019_notification_claimed_until"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="booking",
+            name="status",
+            field=models.CharField(
+                choices=[
+                    ("pending", "Pending"),
+                    ("paid", "Paid"),
+                    ("cancelled", "Cancelled"),
+                    ("refunding", "Refunding"),
+                    ("refunded", "Refunded"),
+                    ("expired", "Expired"),
+                ],
+                max_length=10,
+            ),
+        ),
+    ]
@@ -1,6 +1,53 @@
 from django.db import models
 from django.conf import settings
-
+from django.utils import timezone
+
+
+class StatusTrackingMixin:
+    """
+    Remembers the `status` an instance was loaded or last saved with, so
+    status transitions can be detected on save without re-reading the row.
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if "status" in field_names:
+            instance._saved_status = instance.status
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super().refresh_from_db(using=using, fields=fields, **kwargs)
+        # Loading a deferred field must not pick up an unsaved status
+        reloaded = fields is None or "status" in fields
+        if reloaded and "status" not in self.get_deferred_fields():
+            self._saved_status = self.status
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None or "status" in update_fields:
+            self._saved_status = self.status
+
+    def previous_status(self, update_fields=None):
+        """
+        Return the status stored in the database before the save about to
+        happen, or None for new instances. A save whose `update_fields`
+        leave out `status` keeps the current one. Only instances whose status
+        was never loaded (deferred, or built by hand) need a query.
+        """
+        if self._state.adding:
+            return None
+        if update_fields is not None and "status" not in update_fields:
+            return self.status
+        if hasattr(self, "_saved_status"):
+            return self._saved_status
+        return (
+            type(self)
+            ._default_manager.filter(pk=self.pk)
+            .values_list("status", flat=True)
+            .first()
+        )
 
 
 class Organizer(models.Model):
@@ -48,7 +95,7 @@ class Organizer(models.Model):
         return self.organization_name
 
 
-class Event(models.Model):
+class Event(StatusTrackingMixin, models.Model):
     CATEGORY_CHOICES = (
         ("music", "Music"),
         ("sports", "Sports"),
@@ -75,6 +122,9 @@ class Event(models.Model):
     start_date_time = models.DateTimeField()
     end_date_time = models.DateTimeField()
     capacity = models.PositiveIntegerField()
+    # Sum of ticket quantities, maintained by Eventmain.inventory.
+    # NULL until first computed from the tickets.
+    allocated_capacity = models.PositiveIntegerField(null=True, blank=True)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="draft")
     created_at = models.DateTimeField(auto_now_add=True)
@@ -83,6 +133,17 @@ class Event(models.Model):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # allocated_capacity is only changed by conditional UPDATEs, so a full
+        # save must not write back the possibly stale copy held in memory
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name
+                for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != "allocated_capacity"
+            ]
+        super().save(*args, **kwargs)
+
 
 class Ticket(models.Model):
 
@@ -105,12 +166,51 @@ class Ticket(models.Model):
     def __str__(self):
         return f"{self.name} - {self.event.name}"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Keep the inventory row's total in step with the ticket quantity
+        updated = TicketInventory.objects.filter(ticket=self).update(
+            total=self.quantity
+        )
+        if not updated:
+            TicketInventory.objects.get_or_create(
+                ticket=self, defaults={"total": self.quantity}
+            )
+
+
+class TicketInventory(models.Model):
+    """
+    Per-ticket stock counters.
+
+    `reserved` counts seats held by pending bookings and `sold` counts seats
+    of paid bookings. Both are only ever changed through conditional UPDATEs
+    in Eventmain.inventory so concurrent buyers cannot oversell a ticket.
+    """
+
+    ticket = models.OneToOneField(
+        "Ticket", on_delete=models.CASCADE, related_name="inventory"
+    )
+    total = models.PositiveIntegerField()
+    reserved = models.PositiveIntegerField(default=0)
+    sold = models.PositiveIntegerField(default=0)
+
+    @property
+    def available(self):
+        return max(self.total - self.reserved - self.sold, 0)
 
-class Booking(models.Model):
+    def __str__(self):
+        return f"Inventory for {self.ticket_id}: {self.available}/{self.total}"
+
+
+class Booking(StatusTrackingMixin, models.Model):
     STATUS_CHOICES = [
+        ("pending", "Pending"),
         ("paid", "Paid"),
         ("cancelled", "Cancelled"),
+        # Claimed by a refund that was sent to Khalti, not settled yet
+        ("refunding", "Refunding"),
         ("refunded", "Refunded"),
+        ("expired", "Expired"),
     ]
     PAYMENT_METHOD_CHOICES = [
         ("esewa", "Esewa"),
@@ -125,7 +225,86 @@ class Booking(models.Model):
     total_amount = models.DecimalField(max_digits=10, decimal_places=2)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES)
     payment_method = models.CharField(max_length=10, choices=PAYMENT_METHOD_CHOICES)
+    # Bookings checked out together share an order id (Khalti purchase_order_id)
+    order_id = models.CharField(max_length=32, null=True, blank=True, db_index=True)
+    # Pending bookings hold their seats until this deadline
+    hold_expires_at = models.DateTimeField(null=True, blank=True)
+    # Paid after its hold expired and its seats were sold to someone else
+    needs_refund = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["status", "hold_expires_at"], name="booking_status_hold_idx"
+            ),
+        ]
+
+
+class Payment(models.Model):
+    """
+    Ledger entry for the payment of an order (the bookings sharing
+    `order_id`; older single bookings use their own id as order id).
+    """
+
+    STATUS_CHOICES = [
+        ("initiating", "Initiating"),
+        ("initiated", "Initiated"),
+        ("completed", "Completed"),
+        ("refunded", "Refunded"),
+        ("expired", "Expired"),
+        ("failed", "Failed"),
+    ]
+    GATEWAY_CHOICES = [
+        ("khalti", "Khalti"),
+    ]
+    # Statuses whose amount (less refunds) counts as revenue
+    SETTLED_STATUSES = ["completed", "refunded"]
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="payments"
+    )
+    event = models.ForeignKey(
+        Event,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="payments",
+    )
+    gateway = models.CharField(max_length=20, choices=GATEWAY_CHOICES, default="khalti")
+    order_id = models.CharField(max_length=32, unique=True)
+    pidx = models.CharField(max_length=64, unique=True, null=True, blank=True)
+    # Khalti transaction id, set once the payment is completed
+    tidx = models.CharField(max_length=64, null=True, blank=True)
+    amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    refunded_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    payment_url = models.URLField(max_length=500, null=True, blank=True)
+    status = models.CharField(
+        max_length=20, choices=STATUS_CHOICES, default="initiating"
+    )
+    error = models.TextField(blank=True, default="")
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "id"], name="payment_status_idx"),
+            models.Index(fields=["event", "status"], name="payment_event_status_idx"),
+        ]
+
+    def __str__(self):
+        return f"Payment {self.order_id} ({self.status})"
+
+
+class JobCheckpoint(models.Model):
+    """Resume position of a long-running batch job, keyed by job name."""
+
+    name = models.CharField(max_length=100, unique=True)
+    position = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} @ {self.position}"
 
 
 class Media(models.Model):
@@ -170,8 +349,11 @@ class Notification(models.Model):
         ("push", "Push"),
     ]
     STATUS_CHOICES = [
+        ("pending", "Pending"),
         ("sent", "Sent"),
         ("failed", "Failed"),
+        ("coalesced", "Coalesced"),
+        ("digest", "Digest"),
     ]
 
     user = models.ForeignKey(
@@ -182,18 +364,89 @@ class Notification(models.Model):
     medium = models.CharField(max_length=10, choices=MEDIUM_CHOICES)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES)
     created_at = models.DateTimeField(auto_now_add=True)
+    read_at = models.DateTimeField(null=True, blank=True)
+    # user:event:kind:medium[:window] of notifications sent at most once
+    dedup_key = models.CharField(max_length=200, null=True, blank=True)
+    # Lease of the worker flushing a coalesced or digest notification
+    claimed_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["dedup_key"], name="unique_notification_dedup_key"
+            ),
+        ]
+        indexes = [
+            # Coalesced and digest notifications are flushed by status
+            models.Index(fields=["status", "user"], name="notification_status_idx"),
+            # Keyset pages of a user's inbox (see Eventmain.inbox)
+            models.Index(
+                fields=["user", "created_at", "id"], name="notification_inbox_idx"
+            ),
+            models.Index(
+                fields=["user"],
+                condition=models.Q(read_at__isnull=True),
+                name="notification_unread_idx",
+            ),
+        ]
 
 
 class QRCode(models.Model):
+    """
+    Ticket QR code of a paid booking, rendered once by `Eventmain.tickets`.
+    `qr_code` holds the encoded payload and `content_hash` its SHA-256, so
+    the PNG is only rendered again when the payload changes.
+    """
+
     booking = models.OneToOneField(
         "Booking", on_delete=models.CASCADE, db_column="booking_id"
     )
     qr_code = models.TextField()
+    content_hash = models.CharField(max_length=64, blank=True, default="")
+    image = models.BinaryField(default=b"")
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"QRCode for Booking {self.booking.id}"
 
 
+class CheckIn(models.Model):
+    """
+    Admission of a booking at the gate. A booking can only be checked in
+    once; later scans of it are counted in `reentry_attempts`.
+    """
+
+    booking = models.ForeignKey(
+        "Booking", on_delete=models.CASCADE, related_name="check_ins"
+    )
+    event = models.ForeignKey(
+        "Event", on_delete=models.CASCADE, related_name="check_ins"
+    )
+    gate = models.CharField(max_length=50, blank=True, default="")
+    # Scans checked in by the same request share a batch id
+    batch_id = models.UUIDField(db_index=True)
+    checked_in_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="check_ins",
+    )
+    checked_in_at = models.DateTimeField(auto_now_add=True)
+    reentry_attempts = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["booking"], name="unique_booking_check_in"),
+        ]
+        indexes = [
+            models.Index(fields=["event", "checked_in_at"], name="checkin_event_idx"),
+        ]
+
+    def __str__(self):
+        return f"Check-in of booking {self.booking_id}"
+
+
 class EventAnalytics(models.Model):
     event = models.ForeignKey("Event", on_delete=models.CASCADE)
     user = models.ForeignKey(
@@ -214,3 +467,37 @@ class EventReview(models.Model):
     rating = models.IntegerField(choices=[(i, str(i)) for i in range(1, 6)])
     comment = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
+
+
+class IdempotencyKey(models.Model):
+    """
+    Stored response of a request made with an `Idempotency-Key` header, so a
+    retried request replays it instead of running the view again.
+    """
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name="idempotency_keys",
+    )
+    endpoint = models.CharField(max_length=100)
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    # NULL while the original request is still being processed
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # When the request processing it started; a retry takes over a claim
+    # older than IDEMPOTENCY_CLAIM_TIMEOUT_SECONDS
+    claimed_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "endpoint", "key"], name="unique_idempotency_key"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.endpoint} {self.key}"
@@ -0,0 +1,340 @@
+"""
+Khalti payment lifecycle of an order.
+
+The view creates the order (pending bookings plus an "initiating" Payment)
+and then calls `initiate_payment`, either inline or on the background pool
+when the client asked for asynchronous initiation and polls the payment
+status instead.
+
+`complete_payment` settles one order from the Khalti callback, and
+`complete_orders` and `expire_orders` settle many orders at once. All of
+them move payments and bookings with conditional bulk updates, so a replayed
+callback or a concurrent reconciliation run changes nothing twice, and
+announce the booking transitions through `bookings_status_changed` in the
+same transaction, so their notifications are queued atomically with them.
+"""
+
+import logging
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from . import checkout, inventory, tickets
+from .khalti_client import KhaltiError, get_client
+from .models import Booking, Event, Payment
+from .signals import bookings_status_changed
+
+logger = logging.getLogger(__name__)
+
+
+def initiate_payment(order_id):
+    """
+    Initiate the Khalti payment of an order and store its pidx/payment_url.
+
+    On failure the payment is marked failed, the order's bookings are
+    discarded so their seats return to the pool, and KhaltiError is raised.
+    """
+    payment = Payment.objects.select_related("user").get(order_id=order_id)
+    bookings = list(
+        Booking.objects.filter(order_id=order_id)
+        .select_related("ticket__event")
+        .order_by("id")
+    )
+    payload = checkout.khalti_payload(
+        order_id,
+        bookings,
+        payment.user,
+        return_url=f"{settings.BASE_URL}/api/bookings/khalti_callback/",
+        website_url=settings.BASE_URL,
+    )
+
+    try:
+        data = get_client().initiate(payload)
+        if not data.get("payment_url"):
+            raise KhaltiError("Payment URL not received from Khalti")
+    except KhaltiError as exc:
+        payment.status = "failed"
+        payment.error = str(exc.details or exc)
+        payment.save(update_fields=["status", "error", "updated_at"])
+        checkout.discard_order(bookings)
+        raise
+
+    payment.pidx = data.get("pidx")
+    payment.payment_url = data["payment_url"]
+    payment.status = "initiated"
+    payment.save(update_fields=["pidx", "payment_url", "status", "updated_at"])
+    return payment
+
+
+class PaymentMismatch(Exception):
+    """Raised when a callback's pidx does not belong to the order."""
+
+
+def _transition_bookings(bookings, from_statuses, new_status):
+    """
+    Move the `bookings` (a queryset) that are in `from_statuses` to
+    `new_status`, adjusting the ticket inventory per ticket. Must run in a
+    transaction; returns the `(booking, old_status)` changes.
+    """
+    bookings = list(
+        bookings.select_for_update()
+        .filter(status__in=from_statuses)
+        .select_related("user", "ticket__event")
+        .order_by("id")
+    )
+    if not bookings:
+        return []
+
+    Booking.objects.filter(pk__in=[booking.pk for booking in bookings]).update(
+        status=new_status
+    )
+
+    moved = defaultdict(int)
+    changes = []
+    for booking in bookings:
+        moved[(booking.ticket_id, booking.status)] += booking.quantity
+        changes.append((booking, booking.status))
+        booking.status = new_status
+    for (ticket_id, old_status), quantity in sorted(moved.items()):
+        inventory.apply_status_change(ticket_id, quantity, old_status, new_status)
+    return changes
+
+
+def _confirm_bookings(bookings):
+    """
+    Mark the pending and expired `bookings` (a queryset) paid. Must run in a
+    transaction; returns the `(booking, old_status)` changes.
+
+    Expired bookings lost their hold, so each one takes its seats back with
+    a conditional update. When they were sold to someone else meanwhile the
+    booking stays expired and is flagged `needs_refund` instead, so a late
+    payment never oversells the ticket.
+    """
+    changes = _transition_bookings(bookings, ["pending"], "paid")
+    late = list(
+        bookings.select_for_update()
+        .filter(status="expired")
+        .select_related("user", "ticket__event")
+        .order_by("id")
+    )
+    revived, oversold = [], []
+    for booking in late:
+        if inventory.confirm(booking.ticket_id, booking.quantity, held=False):
+            revived.append(booking)
+        else:
+            oversold.append(booking)
+
+    if revived:
+        Booking.objects.filter(pk__in=[booking.pk for booking in revived]).update(
+            status="paid"
+        )
+        for booking in revived:
+            changes.append((booking, booking.status))
+            booking.status = "paid"
+    if oversold:
+        Booking.objects.filter(pk__in=[booking.pk for booking in oversold]).update(
+            needs_refund=True
+        )
+        logger.warning(
+            "Late payment for sold out bookings %s, flagged for refund",
+            [booking.pk for booking in oversold],
+        )
+    return changes
+
+
+def _announce(changes):
+    if changes:
+        bookings_status_changed.send(sender=Booking, changes=changes)
+
+
+def completed_payment(pidx):
+    """Return the completed Payment recorded for `pidx`, if any."""
+    return Payment.objects.filter(pidx=pidx, status="completed").first()
+
+
+def complete_payment(purchase_order_id, pidx, tidx=None):
+    """
+    Record the verified Khalti payment `pidx` of an order and mark its
+    bookings paid.
+
+    The payment row moves to "completed" with a conditional UPDATE, so only
+    the first of several concurrent or replayed callbacks confirms the
+    bookings and triggers their notifications. Returns `(payment, changed)`.
+
+    Raises Booking.DoesNotExist for unknown orders and PaymentMismatch when
+    the order was initiated with another pidx.
+    """
+    with transaction.atomic():
+        bookings = checkout.order_bookings(purchase_order_id)
+        first = bookings.select_related("ticket").order_by("id").first()
+        if first is None:
+            raise Booking.DoesNotExist
+        # Bookings created before the ledger existed have no payment row yet
+        payment, _ = Payment.objects.select_for_update().get_or_create(
+            order_id=purchase_order_id,
+            defaults={
+                "user_id": first.user_id,
+                "event_id": first.ticket.event_id,
+                "amount": first.total_amount,
+                "status": "initiated",
+            },
+        )
+        if payment.pidx and payment.pidx != pidx:
+            raise PaymentMismatch(f"pidx {pidx} does not belong to this order")
+
+        changed = (
+            Payment.objects.filter(pk=payment.pk)
+            .exclude(status="completed")
+            .update(status="completed", pidx=pidx, tidx=tidx, updated_at=timezone.now())
+        )
+        if changed:
+            changes = _confirm_bookings(bookings)
+            _announce(changes)
+            tickets.generate_after_commit(booking.pk for booking, _ in changes)
+    payment.refresh_from_db()
+    return payment, bool(changed)
+
+
+def complete_orders(order_ids):
+    """
+    Mark the payments of `order_ids` completed and their pending (or already
+    expired, if their seats are still free) bookings paid. Returns the
+    number of bookings confirmed.
+    """
+    with transaction.atomic():
+        Payment.objects.filter(order_id__in=order_ids).exclude(
+            status="completed"
+        ).update(status="completed", updated_at=timezone.now())
+        changes = _confirm_bookings(Booking.objects.filter(order_id__in=order_ids))
+        _announce(changes)
+        tickets.generate_after_commit(booking.pk for booking, _ in changes)
+    return len(changes)
+
+
+def expire_orders(order_ids):
+    """
+    Mark abandoned payments of `order_ids` expired and release the seats of
+    their pending bookings. Returns the number of bookings expired.
+    """
+    with transaction.atomic():
+        Payment.objects.filter(
+            order_id__in=order_ids, status__in=["initiating", "initiated"]
+        ).update(status="expired", updated_at=timezone.now())
+        changes = _transition_bookings(
+            Booking.objects.filter(order_id__in=order_ids), ["pending"], "expired"
+        )
+    return len(changes)
+
+
+def payment_for_booking(booking):
+    """Return the ledger entry of the order `booking` belongs to, if any."""
+    return Payment.objects.filter(order_id=checkout.booking_order_id(booking)).first()
+
+
+def claim_refunds(booking_ids):
+    """
+    Move the paid `booking_ids` to "refunding" before their refund is sent
+    to Khalti, so no other request or job refunds them too. Returns the ids
+    actually claimed; the others were not paid or already claimed.
+
+    Claimed bookings keep their seats sold. Settle them with
+    `settle_refunds` once Khalti refunded them, or give them back with
+    `release_refunds` when it refused. Bookings left "refunding" by a crash
+    are not retried: Khalti may have refunded them, so they have to be
+    checked there first.
+    """
+    with transaction.atomic():
+        changes = _transition_bookings(
+            Booking.objects.filter(pk__in=booking_ids), ["paid"], "refunding"
+        )
+    return [booking.pk for booking, _ in changes]
+
+
+def release_refunds(booking_ids):
+    """Give claimed `booking_ids` whose refund Khalti refused back as paid."""
+    with transaction.atomic():
+        _transition_bookings(
+            Booking.objects.filter(pk__in=booking_ids), ["refunding"], "paid"
+        )
+
+
+def settle_refunds(booking_ids):
+    """
+    Mark the `booking_ids` claimed with `claim_refunds` and refunded on
+    Khalti refunded: their seats are restocked and their amounts added to
+    the ledger in bulk, and the refund notifications go out as one batch.
+    Returns the number of bookings refunded.
+    """
+    with transaction.atomic():
+        changes = _transition_bookings(
+            Booking.objects.filter(pk__in=booking_ids), ["refunding"], "refunded"
+        )
+        refunded = defaultdict(int)
+        for booking, _ in changes:
+            refunded[checkout.booking_order_id(booking)] += booking.total_amount
+
+        now = timezone.now()
+        ledger = list(Payment.objects.select_for_update().filter(order_id__in=refunded))
+        for payment in ledger:
+            payment.refunded_amount += refunded[payment.order_id]
+            if payment.refunded_amount >= payment.amount:
+                payment.status = "refunded"
+            payment.updated_at = now
+        Payment.objects.bulk_update(
+            ledger, ["refunded_amount", "status", "updated_at"], batch_size=500
+        )
+        _announce(changes)
+    return len(changes)
+
+
+# ===== REVENUE =====
+
+
+def _revenue(payments, group_by):
+    return (
+        payments.filter(status__in=Payment.SETTLED_STATUSES)
+        .values(group_by)
+        .annotate(
+            gross=Sum("amount"),
+            refunded=Sum("refunded_amount"),
+            net=Sum(F("amount") - F("refunded_amount")),
+            orders=Count("id"),
+        )
+        .order_by(group_by)
+    )
+
+
+def event_revenue(event_ids=None):
+    """
+    Return revenue rows `{"event_id", "gross", "refunded", "net", "orders"}`
+    per event from the ledger, optionally for `event_ids` only.
+    """
+    payments = Payment.objects.all()
+    if event_ids is not None:
+        payments = payments.filter(event_id__in=event_ids)
+    return list(_revenue(payments, "event_id"))
+
+
+def organizer_revenue(organizer_id):
+    """Return the revenue totals of all events of an organizer."""
+    totals = Payment.objects.filter(
+        event__organizer_id=organizer_id, status__in=Payment.SETTLED_STATUSES
+    ).aggregate(
+        gross=Sum("amount"),
+        refunded=Sum("refunded_amount"),
+        net=Sum(F("amount") - F("refunded_amount")),
+        orders=Count("id"),
+    )
+    return {
+        "organizer_id": organizer_id,
+        "gross": totals["gross"] or 0,
+        "refunded": totals["refunded"] or 0,
+        "net": totals["net"] or 0,
+        "orders": totals["orders"],
+        "events": event_revenue(
+            Event.objects.filter(organizer_id=organizer_id).values("id")
+        ),
+    }
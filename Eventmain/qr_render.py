@@ -0,0 +1,16 @@
+"""
+QR code rendering for `Eventmain.tickets`.
+
+Kept apart from the Django code on purpose: the render processes of
+`tickets` import this module only, so they start without setting up Django.
+"""
+
+import io
+
+import qrcode
+
+
+def render_png(payload):
+    buffer = io.BytesIO()
+    qrcode.make(payload).save(buffer)
+    return buffer.getvalue()
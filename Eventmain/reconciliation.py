@@ -0,0 +1,110 @@
+"""
+Reconciliation of Khalti payments whose callback never arrived.
+
+When the browser does not come back to `khalti_callback`, the order stays
+"initiated" and its bookings stay pending. `reconcile_payments` pages
+through those payments by id, looks each pidx up on Khalti concurrently and
+settles the orders in bulk through `payments.complete_orders` and
+`payments.expire_orders`.
+
+The id of the last payment handled is stored in a JobCheckpoint after every
+page, so an interrupted run picks up where it stopped. The checkpoint is
+reset once a run reaches the end of the backlog.
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from . import payments
+from .khalti_client import KhaltiError, KhaltiUnavailable, get_client
+from .models import JobCheckpoint, Payment
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_NAME = "reconcile-khalti-payments"
+
+# Khalti lookup statuses that settle an order.
+COMPLETED_STATUSES = {"Completed"}
+ABANDONED_STATUSES = {"Expired", "User canceled"}
+
+
+def _lookup(client, pidx):
+    """Return the Khalti status of `pidx`, or None when Khalti refused it."""
+    try:
+        return client.lookup(pidx).get("status")
+    except KhaltiUnavailable:
+        raise
+    except KhaltiError as exc:
+        # Server side errors abort the run; the checkpoint keeps this page
+        if (exc.status_code or 0) >= 500:
+            raise
+        logger.warning(f"Khalti lookup failed for pidx {pidx}: {exc}")
+        return None
+    finally:
+        close_old_connections()
+
+
+def reconcile_payments(batch_size=200, workers=8, min_age_minutes=5, client=None):
+    """
+    Settle initiated Khalti payments older than `min_age_minutes`.
+
+    Each page of `batch_size` payments is looked up with `workers` parallel
+    requests. Stops early, keeping the checkpoint, when Khalti is
+    unavailable or failing. Returns a dict with the number of payments
+    checked and of bookings marked paid and expired.
+    """
+    client = client or get_client()
+    cutoff = timezone.now() - timedelta(minutes=min_age_minutes)
+    checkpoint, _ = JobCheckpoint.objects.get_or_create(name=CHECKPOINT_NAME)
+    stats = {"checked": 0, "paid": 0, "expired": 0}
+
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="reconcile"
+    ) as executor:
+        while True:
+            page = list(
+                Payment.objects.filter(
+                    status="initiated",
+                    pidx__isnull=False,
+                    created_at__lte=cutoff,
+                    id__gt=checkpoint.position,
+                )
+                .order_by("id")
+                .values_list("id", "order_id", "pidx")[:batch_size]
+            )
+            if not page:
+                checkpoint.position = 0
+                checkpoint.save(update_fields=["position", "updated_at"])
+                break
+
+            try:
+                statuses = list(executor.map(lambda row: _lookup(client, row[2]), page))
+            except KhaltiError as exc:
+                logger.warning(f"Stopping reconciliation, Khalti lookup failed: {exc}")
+                break
+
+            completed, abandoned = [], []
+            for (_, order_id, _), status in zip(page, statuses):
+                if status in COMPLETED_STATUSES:
+                    completed.append(order_id)
+                elif status in ABANDONED_STATUSES:
+                    abandoned.append(order_id)
+
+            if completed:
+                stats["paid"] += payments.complete_orders(completed)
+            if abandoned:
+                stats["expired"] += payments.expire_orders(abandoned)
+            stats["checked"] += len(page)
+
+            checkpoint.position = page[-1][0]
+            checkpoint.save(update_fields=["position", "updated_at"])
+
+    logger.info(
+        f"Reconciled {stats['checked']} Khalti payments: "
+        f"{stats['paid']} bookings paid, {stats['expired']} expired"
+    )
+    return stats
@@ -0,0 +1,135 @@
+"""
+Mass refunds for cancelled events.
+
+`refund_event` walks the paid bookings of an event in chunks of ids,
+claims each chunk with `payments.claim_refunds`, asks Khalti to refund each
+order's share of the claimed bookings on a bounded thread pool, and records
+the successful refunds with `payments.settle_refunds`, which updates
+bookings, inventory and the ledger in bulk and sends the refund
+notifications as one batch per chunk.
+
+Claiming first means a concurrent run or `refund_booking` request never
+refunds the same bookings again. Bookings whose refund Khalti refused are
+released back to paid, so running the job again retries only those.
+"""
+
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+from . import payments
+from .khalti_client import KhaltiError, KhaltiUnavailable, get_client
+from .models import Booking, Payment
+
+logger = logging.getLogger(__name__)
+
+
+def _refund(client, pidx, amount):
+    """Refund `amount` paisa of `pidx`; returns False when Khalti refused."""
+    try:
+        client.refund(pidx, amount)
+        return True
+    except KhaltiUnavailable:
+        raise
+    except KhaltiError as exc:
+        logger.warning(f"Khalti refund failed for pidx {pidx}: {exc}")
+        return False
+    finally:
+        close_old_connections()
+
+
+def refund_event(event_id, chunk_size=200, workers=8, client=None):
+    """
+    Refund every paid booking of an event.
+
+    Returns a dict with the number of bookings refunded and failed. Stops
+    after the current chunk when Khalti is unavailable; the remaining
+    bookings stay paid. Bookings claimed by another refund are skipped.
+    """
+    client = client or get_client()
+    stats = {"refunded": 0, "failed": 0}
+    last_id = 0
+
+    with ThreadPoolExecutor(
+        max_workers=workers, thread_name_prefix="refund"
+    ) as executor:
+        while True:
+            chunk = list(
+                Booking.objects.filter(
+                    ticket__event_id=event_id, status="paid", id__gt=last_id
+                )
+                .order_by("id")
+                .values_list("id", "order_id", "total_amount")[:chunk_size]
+            )
+            if not chunk:
+                break
+            last_id = chunk[-1][0]
+
+            # One Khalti refund per order, covering its bookings in the chunk
+            orders = defaultdict(list)
+            for booking_id, order_id, total_amount in chunk:
+                orders[order_id or str(booking_id)].append((booking_id, total_amount))
+            pidxs = dict(
+                Payment.objects.filter(
+                    order_id__in=orders, pidx__isnull=False
+                ).values_list("order_id", "pidx")
+            )
+
+            refundable = [order_id for order_id in orders if order_id in pidxs]
+            stats["failed"] += sum(
+                len(orders[order_id]) for order_id in orders if order_id not in pidxs
+            )
+            # Only refund the bookings nobody else claimed meanwhile
+            claimed = set(
+                payments.claim_refunds(
+                    [
+                        booking_id
+                        for order_id in refundable
+                        for booking_id, _ in orders[order_id]
+                    ]
+                )
+            )
+            for order_id in refundable:
+                orders[order_id] = [
+                    booking for booking in orders[order_id] if booking[0] in claimed
+                ]
+            refundable = [order_id for order_id in refundable if orders[order_id]]
+
+            def refund_order(order_id):
+                amount = sum(total for _, total in orders[order_id])
+                return _refund(client, pidxs[order_id], int(amount * 100))
+
+            futures = [
+                (order_id, executor.submit(refund_order, order_id))
+                for order_id in refundable
+            ]
+            unavailable = None
+            refunded_ids, refused_ids = [], []
+            for order_id, future in futures:
+                booking_ids = [booking_id for booking_id, _ in orders[order_id]]
+                try:
+                    ok = future.result()
+                except KhaltiUnavailable as exc:
+                    unavailable, ok = exc, False
+                if ok:
+                    refunded_ids.extend(booking_ids)
+                else:
+                    refused_ids.extend(booking_ids)
+
+            # Refunds Khalti accepted are recorded even when stopping early
+            if refunded_ids:
+                stats["refunded"] += payments.settle_refunds(refunded_ids)
+            if refused_ids:
+                payments.release_refunds(refused_ids)
+                stats["failed"] += len(refused_ids)
+            if unavailable is not None:
+                logger.warning(f"Stopping refunds of event {event_id}: {unavailable}")
+                break
+
+    logger.info(
+        f"Refunded {stats['refunded']} bookings of event {event_id}, "
+        f"{stats['failed']} failed"
+    )
+    return stats
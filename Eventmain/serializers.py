@@ -1,6 +1,8 @@
+from django.db import transaction
 from rest_framework import serializers
 
 from user.models import User
+from . import holds, inventory
 from .models import *
 from .models import Ticket
 
@@ -51,17 +53,26 @@ class EventSerializer(serializers.ModelSerializer):
     class Meta:
         model = Event
         fields = "__all__"
-        read_only_fields = ["organizer"]
+        read_only_fields = ["organizer", "allocated_capacity"]
 
     def validate(self, data):
         if data["start_date_time"] >= data["end_date_time"]:
             raise serializers.ValidationError(
                 "end_date_time must be after start_date_time."
             )
+        capacity = data.get("capacity")
+        if self.instance and capacity is not None:
+            allocated = inventory.allocated_capacity(self.instance)
+            if capacity < allocated:
+                raise serializers.ValidationError(
+                    f"Capacity cannot be lower than the {allocated} already allocated to tickets."
+                )
         return data
 
 
 class TicketSerializer(serializers.ModelSerializer):
+    available_quantity = serializers.SerializerMethodField()
+
     class Meta:
         model = Ticket
         fields = [
@@ -70,11 +81,16 @@ class TicketSerializer(serializers.ModelSerializer):
             "name",
             "price",
             "quantity",
+            "available_quantity",
             "ticket_type",
             "created_at",
         ]
         read_only_fields = ["created_at"]
 
+    def get_available_quantity(self, obj):
+        stock = getattr(obj, "inventory", None)
+        return stock.available if stock else None
+
     def validate(self, data):
         # For PATCH: Use existing instance values if not provided in data
         instance = getattr(self, "instance", None)
@@ -90,26 +106,70 @@ class TicketSerializer(serializers.ModelSerializer):
         if not event:
             raise serializers.ValidationError("Event must be specified.")
 
-        # Calculate total quantity of existing tickets for this event excluding the current instance if updating
-        existing_tickets = Ticket.objects.filter(event=event)
-        if instance:
-            existing_tickets = existing_tickets.exclude(pk=instance.pk)
+        # Capacity already given to the event's tickets, without this one
+        allocated = inventory.allocated_capacity(event)
+        if instance and instance.event_id == event.pk:
+            allocated -= instance.quantity
 
-        total_quantity = sum(ticket.quantity for ticket in existing_tickets) + quantity
+        total_quantity = allocated + quantity
 
         if total_quantity > event.capacity:
             raise serializers.ValidationError(
                 f"Total ticket quantity ({total_quantity}) exceeds event capacity ({event.capacity})."
             )
 
+        # Seats already held or sold cannot be taken away from the ticket
+        if instance:
+            stock = inventory.get_inventory(instance)
+            committed = stock.reserved + stock.sold
+            if quantity < committed:
+                raise serializers.ValidationError(
+                    f"Quantity cannot be lower than the {committed} tickets already booked."
+                )
+
         return data
 
+    def create(self, validated_data):
+        # Claim the event capacity and insert the ticket together; the
+        # conditional counter update guards against concurrent edits
+        with transaction.atomic():
+            try:
+                inventory.allocate_capacity(
+                    validated_data["event"], validated_data["quantity"]
+                )
+            except inventory.CapacityExceeded as exc:
+                raise serializers.ValidationError(str(exc))
+            return super().create(validated_data)
+
+    def update(self, instance, validated_data):
+        old_event, old_quantity = instance.event, instance.quantity
+        new_event = validated_data.get("event", old_event)
+        new_quantity = validated_data.get("quantity", old_quantity)
+
+        with transaction.atomic():
+            try:
+                if new_event.pk == old_event.pk:
+                    inventory.allocate_capacity(old_event, new_quantity - old_quantity)
+                else:
+                    inventory.allocate_capacity(old_event, -old_quantity)
+                    inventory.allocate_capacity(new_event, new_quantity)
+            except inventory.CapacityExceeded as exc:
+                raise serializers.ValidationError(str(exc))
+            return super().update(instance, validated_data)
+
 
 class BookingSerializer(serializers.ModelSerializer):
     class Meta:
         model = Booking
         fields = "__all__"
-        read_only_fields = ["total_amount", "status", "created_at"]
+        read_only_fields = [
+            "total_amount",
+            "status",
+            "order_id",
+            "hold_expires_at",
+            "needs_refund",
+            "created_at",
+        ]
 
     def validate(self, data):
         ticket = data.get("ticket")
@@ -118,15 +178,8 @@ class BookingSerializer(serializers.ModelSerializer):
         if quantity is None or quantity <= 0:
             raise serializers.ValidationError("Quantity must be a positive integer.")
 
-        # Count both pending and paid bookings
-        booked_quantity = (
-            Booking.objects.filter(
-                ticket=ticket, status__in=["pending", "paid"]
-            ).aggregate(total=models.Sum("quantity"))["total"]
-            or 0
-        )
-
-        available_quantity = ticket.quantity - booked_quantity
+        # Pending and paid bookings are both counted by the inventory row
+        available_quantity = inventory.available(ticket)
 
         if quantity > available_quantity:
             raise serializers.ValidationError(
@@ -149,8 +202,15 @@ class BookingSerializer(serializers.ModelSerializer):
 
         # Set initial status as 'pending' or similar, to be updated after payment confirmation
         validated_data["status"] = "pending"
+        validated_data["hold_expires_at"] = holds.hold_deadline()
 
-        booking = super().create(validated_data)
+        # Reserve the seats and insert the booking in one transaction
+        with transaction.atomic():
+            try:
+                inventory.reserve(ticket, quantity)
+            except inventory.InsufficientInventory as exc:
+                raise serializers.ValidationError(str(exc))
+            booking = super().create(validated_data)
 
         # You can trigger payment process here or in the view
 
@@ -172,13 +232,14 @@ class AuditLogSerializer(serializers.ModelSerializer):
 class NotificationSerializer(serializers.ModelSerializer):
     class Meta:
         model = Notification
-        fields = "__all__"
+        exclude = ["dedup_key"]
 
 
 class QRCodeSerializer(serializers.ModelSerializer):
     class Meta:
         model = QRCode
-        fields = "__all__"
+        # The PNG is served by /api/bookings/{id}/qr_code/
+        exclude = ["image"]
 
 
 class EventAnalyticsSerializer(serializers.ModelSerializer):
@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+# Sent inside the transaction in which bookings changed status through bulk
+# queryset updates, which do not fire post_save. Receivers get `changes`, a
+# list of `(booking, old_status)` pairs where `booking.status` is the new
+# status.
+bookings_status_changed = Signal()
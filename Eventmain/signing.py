@@ -0,0 +1,54 @@
+"""
+Ed25519 keys of the ticket QR signatures.
+
+Keys are written as the unpadded base64url of their 32 raw bytes. This
+module does not import Django, so `python -m Eventmain.signing` prints a
+fresh TICKET_SIGNING_KEY before the project can even start without one.
+"""
+
+import base64
+
+from cryptography.hazmat.primitives.asymmetric.ed25519 import (
+    Ed25519PrivateKey,
+    Ed25519PublicKey,
+)
+from cryptography.hazmat.primitives.serialization import (
+    Encoding,
+    NoEncryption,
+    PrivateFormat,
+    PublicFormat,
+)
+
+
+def encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def load_private_key(text):
+    """Raises ValueError when `text` is not an encoded Ed25519 private key."""
+    return Ed25519PrivateKey.from_private_bytes(decode(text))
+
+
+def load_public_key(text):
+    """Raises ValueError when `text` is not an encoded Ed25519 public key."""
+    return Ed25519PublicKey.from_public_bytes(decode(text))
+
+
+def private_key_text(private_key):
+    return encode(
+        private_key.private_bytes(Encoding.Raw, PrivateFormat.Raw, NoEncryption())
+    )
+
+
+def public_key_text(private_key):
+    return encode(private_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw))
+
+
+if __name__ == "__main__":
+    key = Ed25519PrivateKey.generate()
+    print(f"TICKET_SIGNING_KEY={private_key_text(key)}")
+    print(f"# Public key for the gate scanners: {public_key_text(key)}")
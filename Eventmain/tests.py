@@ -1,3 +1,1076 @@
-from django.test import TestCase
+import tempfile
+from datetime import timedelta
+from importlib import import_module
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from django.apps import apps as django_apps
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import IntegrityError
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import (
+    background,
+    checkout,
+    checks,
+    holds,
+    idempotency,
+    inbox,
+    inventory,
+    payments,
+    signing,
+    tickets,
+)
+from .khalti_client import (
+    CircuitBreaker,
+    KhaltiClient,
+    KhaltiError,
+    KhaltiUnavailable,
+    reset_client,
+)
+from .khalti_stub import KhaltiStub
+from .models import (
+    Booking,
+    CheckIn,
+    Event,
+    IdempotencyKey,
+    JobCheckpoint,
+    Notification,
+    Organizer,
+    Payment,
+    QRCode,
+    Ticket,
+)
+from .reconciliation import CHECKPOINT_NAME, reconcile_payments
+from .refunds import refund_event
+from .views import BookingViewSet
+from user.models import User
+
+
+class KhaltiClientTests(SimpleTestCase):
+    def setUp(self):
+        self.stub = KhaltiStub().start()
+        self.addCleanup(self.stub.stop)
+
+    def make_client(self, **kwargs):
+        kwargs.setdefault("backoff", 0)
+        return KhaltiClient(self.stub.base_url, "test_secret_key", **kwargs)
+
+    def test_initiate_and_lookup(self):
+        client = self.make_client()
+        data = client.initiate({"amount": 1000, "purchase_order_id": "order-1"})
+        self.stub.set_status(data["pidx"], "Completed")
+
+        self.assertEqual(client.lookup(data["pidx"])["status"], "Completed")
+        self.assertEqual(client.metrics.snapshot()["lookup"]["calls"], 1)
+
+    def test_lookup_retries_transient_failures(self):
+        client = self.make_client(lookup_retries=2)
+        self.stub.add_payment("pidx-1", 1000, status="Completed")
+        self.stub.fail_next(2)
+
+        self.assertEqual(client.lookup("pidx-1")["status"], "Completed")
+        self.assertEqual(client.metrics.snapshot()["lookup"]["errors"], 2)
+
+    def test_initiate_is_not_retried(self):
+        client = self.make_client(lookup_retries=2)
+        self.stub.fail_next(1)
+
+        with self.assertRaises(KhaltiError):
+            client.initiate({"amount": 1000})
+        self.assertEqual(len(self.stub.calls), 1)
+
+    def test_slow_gateway_times_out(self):
+        self.stub.delay = 0.5
+        client = self.make_client(read_timeout=0.1, lookup_retries=0)
+
+        with self.assertRaises(KhaltiUnavailable):
+            client.initiate({"amount": 1000})
+
+    def test_circuit_opens_after_repeated_failures(self):
+        client = self.make_client(
+            breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        )
+        self.stub.fail_next(5)
+        for _ in range(2):
+            with self.assertRaises(KhaltiError):
+                client.initiate({"amount": 1000})
+
+        with self.assertRaises(KhaltiUnavailable):
+            client.initiate({"amount": 1000})
+        self.assertEqual(len(self.stub.calls), 2)
+
+
+class PaymentTestCase(TestCase):
+    def setUp(self):
+        self.stub = KhaltiStub().start()
+        self.addCleanup(self.stub.stop)
+        self.client = KhaltiClient(self.stub.base_url, "test_secret_key", backoff=0)
+
+        self.user = User.objects.create_user(
+            email="buyer@example.com", password="secret", phone_number="9812345678"
+        )
+        organizer = Organizer.objects.create(
+            user=self.user, organization_name="Organizer"
+        )
+        event = Event.objects.create(
+            organizer=organizer,
+            name="Festival",
+            description="Festival",
+            category="music",
+            location="Kathmandu",
+            start_date_time=timezone.now(),
+            end_date_time=timezone.now(),
+            capacity=100,
+            price=500,
+        )
+        self.ticket = Ticket.objects.create(
+            event=event, name="GA", price=500, quantity=50, ticket_type="GA"
+        )
+
+    def make_order(self, khalti_status, quantity=1):
+        order_id, bookings, _ = checkout.reserve_order(
+            self.user, [(self.ticket.id, quantity)]
+        )
+        pidx = f"pidx-{order_id}"
+        Payment.objects.filter(order_id=order_id).update(
+            pidx=pidx,
+            status="initiated",
+            created_at=timezone.now() - timedelta(minutes=10),
+        )
+        self.stub.add_payment(pidx, quantity * 50000, status=khalti_status)
+        return order_id
+
+    def order_statuses(self, order_id):
+        return set(
+            Booking.objects.filter(order_id=order_id).values_list("status", flat=True)
+        )
+
+
+class InventoryTests(PaymentTestCase):
+    def test_reserve_never_oversells_the_last_seats(self):
+        # Availability read earlier does not matter: the UPDATE re-checks it
+        self.assertEqual(inventory.available(self.ticket), 50)
+        self.assertEqual(inventory.reserve(self.ticket, 49), 1)
+        self.assertEqual(inventory.reserve(self.ticket, 1), 0)
+        with self.assertRaises(inventory.InsufficientInventory) as raised:
+            inventory.reserve(self.ticket, 1)
+
+        self.assertEqual(raised.exception.available, 0)
+        stock = inventory.get_inventory(self.ticket)
+        self.assertEqual((stock.reserved, stock.sold), (50, 0))
+
+    def test_booking_endpoint_refuses_to_oversell(self):
+        api = APIClient()
+        api.force_authenticate(self.user)
+
+        def book(quantity):
+            return api.post(
+                "/api/bookings/",
+                {
+                    "user": self.user.id,
+                    "ticket": self.ticket.id,
+                    "quantity": quantity,
+                    "payment_method": "khalti",
+                },
+                format="json",
+            )
+
+        self.assertEqual(book(51).status_code, 400)
+        self.assertEqual(book(50).status_code, 201)
+        self.assertEqual(book(1).status_code, 400)
+        self.assertEqual(Booking.objects.count(), 1)
+
+    def test_counters_follow_the_booking_lifecycle(self):
+        paid = self.make_order("Completed", quantity=2)
+        abandoned = self.make_order("Pending", quantity=3)
+        stock = inventory.get_inventory(self.ticket)
+        self.assertEqual((stock.reserved, stock.sold), (5, 0))
+
+        with self.captureOnCommitCallbacks():
+            payments.complete_orders([paid])
+        payments.expire_orders([abandoned])
+        stock.refresh_from_db()
+        self.assertEqual((stock.reserved, stock.sold), (0, 2))
+
+        with self.captureOnCommitCallbacks():
+            payments.settle_refunds(
+                payments.claim_refunds(
+                    Booking.objects.filter(order_id=paid).values_list("id", flat=True)
+                )
+            )
+        stock.refresh_from_db()
+        self.assertEqual((stock.reserved, stock.sold), (0, 0))
+        self.assertEqual(inventory.available(self.ticket), 50)
+
+    def test_deleted_bookings_give_their_seats_back(self):
+        pending = self.make_order("Pending", quantity=2)
+        paid = self.make_order("Completed", quantity=3)
+        with self.captureOnCommitCallbacks():
+            payments.complete_orders([paid])
+        stock = inventory.get_inventory(self.ticket)
+        self.assertEqual((stock.reserved, stock.sold), (2, 3))
+
+        api = APIClient()
+        api.force_authenticate(self.user)
+        for order_id in (pending, paid):
+            booking = Booking.objects.get(order_id=order_id)
+            response = api.delete(f"/api/bookings/{booking.id}/")
+            self.assertEqual(response.status_code, 204)
+
+        stock.refresh_from_db()
+        self.assertEqual((stock.reserved, stock.sold), (0, 0))
+        self.assertEqual(inventory.available(self.ticket), 50)
+
+
+class EventCapacityTests(PaymentTestCase):
+    def setUp(self):
+        super().setUp()
+        self.api = APIClient()
+        self.api.force_authenticate(self.user)
+        self.event = self.ticket.event
+
+    def add_ticket(self, quantity):
+        return self.api.post(
+            "/api/tickets/",
+            {
+                "event": self.event.id,
+                "name": "VIP",
+                "price": "1000.00",
+                "quantity": quantity,
+                "ticket_type": "VIP",
+            },
+            format="json",
+        )
+
+    def allocated(self):
+        self.event.refresh_from_db()
+        return self.event.allocated_capacity
+
+    def test_counter_follows_ticket_changes(self):
+        response = self.add_ticket(40)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.allocated(), 90)
+
+        # 50 + 40 + 20 is over the capacity of 100
+        self.assertEqual(self.add_ticket(20).status_code, 400)
+        self.assertEqual(self.allocated(), 90)
+
+        url = f"/api/tickets/{response.data['id']}/"
+        response = self.api.patch(url, {"quantity": 30}, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.allocated(), 80)
+
+        self.assertEqual(self.api.delete(url).status_code, 204)
+        self.assertEqual(self.allocated(), 50)
+        self.assertEqual(
+            self.allocated(), inventory.count_allocated_capacity(self.event.id)
+        )
+
+    def test_counter_cannot_be_pushed_past_capacity(self):
+        inventory.allocate_capacity(self.event, 40)
+        with self.assertRaises(inventory.CapacityExceeded):
+            inventory.allocate_capacity(self.event, 11)
+        self.assertEqual(self.allocated(), 90)
+
+
+class HoldExpiryTests(PaymentTestCase):
+    def test_sweeper_expires_holds_and_releases_seats(self):
+        order_id = self.make_order("Pending", quantity=3)
+        self.assertEqual(inventory.available(self.ticket), 47)
+
+        self.assertEqual(holds.expire_stale_holds(), 0)
+        later = timezone.now() + timedelta(minutes=16)
+        self.assertEqual(holds.expire_stale_holds(now=later), 1)
+        self.assertEqual(self.order_statuses(order_id), {"expired"})
+        self.assertEqual(inventory.available(self.ticket), 50)
+
+    def test_bookings_without_a_deadline_expire_from_creation(self):
+        booking = Booking.objects.create(
+            user=self.user,
+            ticket=self.ticket,
+            quantity=1,
+            total_amount=500,
+            status="pending",
+            payment_method="khalti",
+        )
+        self.assertIsNone(booking.hold_expires_at)
+
+        self.assertEqual(holds.expire_stale_holds(), 0)
+        later = timezone.now() + timedelta(minutes=16)
+        self.assertEqual(holds.expire_stale_holds(now=later), 1)
+        booking.refresh_from_db()
+        self.assertEqual(booking.status, "expired")
+
+    def test_migration_backfills_pending_holds(self):
+        backfill = import_module(
+            "Eventmain.migrations.0017_backfill_hold_expiry"
+        ).backfill_hold_expiry
+        booking = Booking.objects.create(
+            user=self.user,
+            ticket=self.ticket,
+            quantity=1,
+            total_amount=500,
+            status="pending",
+            payment_method="khalti",
+        )
+        backfill(django_apps, None)
+
+        booking.refresh_from_db()
+        self.assertEqual(
+            booking.hold_expires_at, holds.hold_deadline(booking.created_at)
+        )
+
+    def test_late_payment_retakes_free_seats(self):
+        order_id = self.make_order("Completed", quantity=2)
+        holds.expire_stale_holds(now=timezone.now() + timedelta(minutes=16))
+
+        with self.captureOnCommitCallbacks():
+            self.assertEqual(payments.complete_orders([order_id]), 1)
+        self.assertEqual(self.order_statuses(order_id), {"paid"})
+        stock = inventory.get_inventory(self.ticket)
+        self.assertEqual((stock.reserved, stock.sold), (0, 2))
+
+    def test_late_payment_never_oversells(self):
+        order_id = self.make_order("Completed", quantity=2)
+        holds.expire_stale_holds(now=timezone.now() + timedelta(minutes=16))
+        # The released seats are bought by someone else
+        inventory.reserve(self.ticket, 49)
+
+        with self.captureOnCommitCallbacks():
+            self.assertEqual(payments.complete_orders([order_id]), 0)
+        booking = Booking.objects.get(order_id=order_id)
+        self.assertEqual(booking.status, "expired")
+        self.assertTrue(booking.needs_refund)
+        self.assertEqual(Payment.objects.get(order_id=order_id).status, "completed")
+        stock = inventory.get_inventory(self.ticket)
+        self.assertEqual((stock.reserved, stock.sold), (49, 0))
+
+
+class ReconcilePaymentsTests(PaymentTestCase):
+    def test_settles_orders_by_lookup_status(self):
+        paid = self.make_order("Completed", quantity=2)
+        abandoned = self.make_order("Expired")
+        waiting = self.make_order("Pending")
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            stats = reconcile_payments(batch_size=2, workers=2, client=self.client)
+
+        self.assertEqual(stats, {"checked": 3, "paid": 1, "expired": 1})
+        self.assertEqual(self.order_statuses(paid), {"paid"})
+        self.assertEqual(self.order_statuses(abandoned), {"expired"})
+        self.assertEqual(self.order_statuses(waiting), {"pending"})
+        self.assertEqual(Payment.objects.get(order_id=paid).status, "completed")
+        self.assertEqual(Payment.objects.get(order_id=abandoned).status, "expired")
+        # Notification drain and ticket QR rendering
+        self.assertEqual(len(callbacks), 2)
+
+        stock = inventory.get_inventory(self.ticket)
+        self.assertEqual((stock.sold, stock.reserved), (2, 1))
+        self.assertEqual(JobCheckpoint.objects.get(name=CHECKPOINT_NAME).position, 0)
+
+    def test_resumes_from_checkpoint_when_gateway_is_down(self):
+        first = self.make_order("Completed")
+        second = self.make_order("Completed")
+        self.stub.fail_next(100)
+        self.client.lookup_retries = 0
+
+        with self.captureOnCommitCallbacks():
+            stats = reconcile_payments(batch_size=1, workers=1, client=self.client)
+        self.assertEqual(stats["checked"], 0)
+        checkpoint = JobCheckpoint.objects.get(name=CHECKPOINT_NAME)
+        self.assertEqual(checkpoint.position, 0)
+
+        checkpoint.position = Payment.objects.get(order_id=first).id
+        checkpoint.save()
+        self.stub.fail_next(0)
+
+        with self.captureOnCommitCallbacks():
+            stats = reconcile_payments(batch_size=1, workers=1, client=self.client)
+        self.assertEqual(stats["paid"], 1)
+        self.assertEqual(self.order_statuses(first), {"pending"})
+        self.assertEqual(self.order_statuses(second), {"paid"})
+
+
+class KhaltiApiTestCase(PaymentTestCase):
+    """Calls the booking API with the shared Khalti client on the stub."""
+
+    def setUp(self):
+        super().setUp()
+        settings_override = override_settings(KHALTI_BASE_URL=self.stub.base_url)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        reset_client()
+        self.addCleanup(reset_client)
+        self.api = APIClient()
+        self.api.force_authenticate(self.user)
+
+
+class CartCheckoutTests(KhaltiApiTestCase):
+    def setUp(self):
+        super().setUp()
+        self.student = Ticket.objects.create(
+            event=self.ticket.event,
+            name="Student",
+            price=200,
+            quantity=2,
+            ticket_type="STUDENT",
+        )
+
+    def checkout(self, items):
+        return self.api.post("/api/bookings/checkout/", {"items": items}, format="json")
+
+    def test_cart_is_booked_and_paid_as_one_order(self):
+        response = self.checkout(
+            [
+                {"ticket_id": self.ticket.id, "quantity": 2},
+                {"ticket_id": self.student.id, "quantity": 1},
+            ]
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data["payment_url"])
+        bookings = Booking.objects.filter(order_id=response.data["order_id"])
+        self.assertEqual(bookings.count(), 2)
+        self.assertEqual(
+            response.data["tickets_remaining"],
+            {self.ticket.id: 48, self.student.id: 1},
+        )
+        initiations = [body for path, body in self.stub.calls if "initiate" in path]
+        self.assertEqual(len(initiations), 1)
+        self.assertEqual(initiations[0]["amount"], (2 * 500 + 200) * 100)
+        self.assertEqual(len(initiations[0]["product_details"]), 2)
+
+    def test_cart_is_all_or_nothing(self):
+        response = self.checkout(
+            [
+                {"ticket_id": self.ticket.id, "quantity": 2},
+                {"ticket_id": self.student.id, "quantity": 3},
+            ]
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["ticket_id"], self.student.id)
+        self.assertFalse(Booking.objects.exists())
+        self.assertFalse(Payment.objects.exists())
+        self.assertEqual(inventory.available(self.ticket), 50)
+        self.assertEqual(self.stub.calls, [])
+
+    def test_cart_must_stay_within_one_event(self):
+        other_event = Event.objects.create(
+            organizer=self.ticket.event.organizer,
+            name="Other",
+            description="Other",
+            category="music",
+            location="Pokhara",
+            start_date_time=timezone.now(),
+            end_date_time=timezone.now(),
+            capacity=10,
+            price=100,
+        )
+        other = Ticket.objects.create(
+            event=other_event, name="GA", price=100, quantity=10, ticket_type="GA"
+        )
+
+        response = self.checkout(
+            [
+                {"ticket_id": self.ticket.id, "quantity": 1},
+                {"ticket_id": other.id, "quantity": 1},
+            ]
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Booking.objects.exists())
+
+
+class AsyncPaymentInitiationTests(KhaltiApiTestCase):
+    def book(self):
+        return self.api.post(
+            "/api/bookings/create_with_payment/?async=true",
+            {"ticket_id": self.ticket.id, "quantity": 2},
+            format="json",
+        )
+
+    def status(self, order_id):
+        return self.api.get("/api/bookings/payment-status/", {"order_id": order_id})
+
+    def test_client_polls_for_the_payment_url(self):
+        with mock.patch.object(background, "submit") as submit:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.book()
+
+        self.assertEqual(response.status_code, 202)
+        order_id = response.data["order_id"]
+        self.assertEqual(inventory.available(self.ticket), 48)
+        self.assertEqual(self.stub.calls, [])
+
+        polled = self.status(order_id)
+        self.assertEqual(polled.data["status"], "initiating")
+        self.assertEqual(polled["Retry-After"], "1")
+
+        # The background worker initiates the payment
+        func, *args = submit.call_args.args
+        func(*args)
+        polled = self.status(order_id)
+        self.assertEqual(polled.data["status"], "initiated")
+        self.assertTrue(polled.data["payment_url"])
+
+    def test_failed_initiation_releases_the_seats(self):
+        with mock.patch.object(background, "submit") as submit:
+            with self.captureOnCommitCallbacks(execute=True):
+                order_id = self.book().data["order_id"]
+        self.stub.fail_next(1, status=400)
+        func, *args = submit.call_args.args
+        with self.assertRaises(KhaltiError):
+            func(*args)
+
+        polled = self.status(order_id)
+        self.assertEqual(polled.data["status"], "failed")
+        self.assertFalse(Booking.objects.filter(order_id=order_id).exists())
+        self.assertEqual(inventory.available(self.ticket), 50)
+
+    def test_status_is_private_to_the_buyer(self):
+        with mock.patch.object(background, "submit"):
+            order_id = self.book().data["order_id"]
+        stranger = User.objects.create_user(
+            email="stranger@example.com", password="secret", phone_number="9812345678"
+        )
+        self.api.force_authenticate(stranger)
+
+        self.assertEqual(self.status(order_id).status_code, 404)
+        self.assertEqual(self.api.get("/api/bookings/payment-status/").status_code, 400)
+
+
+class IdempotencyKeyTests(KhaltiApiTestCase):
+    ENDPOINT = "booking-create_with_payment"
+
+    def book(self, quantity=1, key="key-1"):
+        return self.api.post(
+            "/api/bookings/create_with_payment/",
+            {"ticket_id": self.ticket.id, "quantity": quantity},
+            format="json",
+            HTTP_IDEMPOTENCY_KEY=key,
+        )
+
+    def request_hash(self, quantity=1):
+        request = SimpleNamespace(
+            method="POST", data={"ticket_id": self.ticket.id, "quantity": quantity}
+        )
+        return idempotency._request_hash(request)
+
+    def initiations(self):
+        return [path for path, _ in self.stub.calls if "initiate" in path]
+
+    def test_retry_replays_the_first_response(self):
+        first = self.book()
+        second = self.book()
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second["Idempotent-Replayed"], "true")
+        self.assertEqual(Booking.objects.count(), 1)
+        self.assertEqual(len(self.initiations()), 1)
+        self.assertEqual(inventory.available(self.ticket), 49)
+
+    def test_key_in_flight_is_a_conflict(self):
+        idempotency._claim(self.user, self.ENDPOINT, "key-1", self.request_hash())
+
+        response = self.book()
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response["Retry-After"], "1")
+        self.assertFalse(Booking.objects.exists())
+
+    def test_stale_claim_is_taken_over_by_a_retry(self):
+        record, _ = idempotency._claim(
+            self.user, self.ENDPOINT, "key-1", self.request_hash()
+        )
+        # The first request died without storing its response
+        IdempotencyKey.objects.filter(pk=record.pk).update(
+            claimed_at=timezone.now() - timedelta(minutes=10)
+        )
+
+        response = self.book()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Booking.objects.count(), 1)
+        self.assertEqual(IdempotencyKey.objects.get().status_code, 200)
+        self.assertEqual(self.book()["Idempotent-Replayed"], "true")
+
+        # A stale claim of a different request is not taken over
+        IdempotencyKey.objects.update(
+            status_code=None, claimed_at=timezone.now() - timedelta(minutes=10)
+        )
+        self.assertEqual(self.book(quantity=2).status_code, 422)
+
+    def test_key_reused_for_another_request_is_rejected(self):
+        self.book(quantity=1)
+        response = self.book(quantity=2)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Booking.objects.count(), 1)
+
+    def test_expired_key_is_replaced(self):
+        record, created = idempotency._claim(
+            self.user, self.ENDPOINT, "key-1", self.request_hash(quantity=2)
+        )
+        IdempotencyKey.objects.filter(pk=record.pk).update(
+            expires_at=timezone.now() - timedelta(minutes=1)
+        )
+
+        response = self.book(quantity=1)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("Idempotent-Replayed", response)
+        self.assertEqual(IdempotencyKey.objects.get().request_hash, self.request_hash())
+
+    def test_claim_retries_when_the_conflicting_row_vanishes(self):
+        create = IdempotencyKey.objects.create
+        attempts = []
+
+        def flaky_create(**fields):
+            attempts.append(fields)
+            if len(attempts) == 1:
+                # Another request held the key and was deleted meanwhile
+                raise IntegrityError("unique_idempotency_key")
+            return create(**fields)
+
+        with mock.patch.object(IdempotencyKey.objects, "create", flaky_create):
+            record, created = idempotency._claim(
+                self.user, self.ENDPOINT, "key-1", self.request_hash()
+            )
+
+        self.assertTrue(created)
+        self.assertEqual(len(attempts), 2)
+        self.assertTrue(IdempotencyKey.objects.filter(pk=record.pk).exists())
+
+
+class KhaltiCallbackTests(KhaltiApiTestCase):
+    def callback(self, order_id):
+        return self.api.get(
+            "/api/bookings/khalti_callback/",
+            {
+                "purchase_order_id": order_id,
+                "status": "Completed",
+                "pidx": f"pidx-{order_id}",
+            },
+        )
+
+    def test_replayed_callback_is_processed_once(self):
+        order_id = self.make_order("Completed")
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            first = self.callback(order_id)
+            second = self.callback(order_id)
+
+        self.assertEqual(first.status_code, 302)
+        self.assertEqual(second.url, first.url)
+        self.assertEqual(self.order_statuses(order_id), {"paid"})
+        # Notification drain and QR rendering of the first callback only
+        self.assertEqual(len(callbacks), 2)
+        lookups = [path for path, _ in self.stub.calls if "lookup" in path]
+        self.assertEqual(len(lookups), 1)
+
+        payment = Payment.objects.get(order_id=order_id)
+        self.assertEqual(payment.status, "completed")
+        self.assertTrue(payment.tidx)
+        self.assertEqual(inventory.get_inventory(self.ticket).sold, 1)
+
+    def test_pidx_of_another_order_is_rejected(self):
+        order_id = self.make_order("Completed")
+        other_order_id = self.make_order("Completed")
+
+        response = self.api.get(
+            "/api/bookings/khalti_callback/",
+            {
+                "purchase_order_id": order_id,
+                "status": "Completed",
+                "pidx": f"pidx-{other_order_id}",
+            },
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.order_statuses(order_id), {"pending"})
+
+    def test_late_callback_never_oversells(self):
+        order_id = self.make_order("Completed")
+        holds.expire_stale_holds(now=timezone.now() + timedelta(minutes=16))
+        inventory.reserve(self.ticket, 50)
+
+        with self.captureOnCommitCallbacks():
+            response = self.callback(order_id)
+
+        self.assertEqual(response.status_code, 302)
+        booking = Booking.objects.get(order_id=order_id)
+        self.assertEqual(booking.status, "expired")
+        self.assertTrue(booking.needs_refund)
+        self.assertEqual(Payment.objects.get(order_id=order_id).status, "completed")
+        self.assertEqual(inventory.get_inventory(self.ticket).sold, 0)
+
+    def test_refund_is_recorded_in_ledger(self):
+        order_id = self.make_order("Completed", quantity=2)
+        self.callback(order_id)
+        booking = Booking.objects.get(order_id=order_id)
+
+        response = self.api.post(f"/api/bookings/{booking.id}/refund_booking/")
+
+        self.assertEqual(response.status_code, 200)
+        payment = Payment.objects.get(order_id=order_id)
+        self.assertEqual(payment.status, "refunded")
+        self.assertEqual(payment.refunded_amount, booking.total_amount)
+        refunds = [body for path, body in self.stub.calls if "refund" in path]
+        self.assertEqual(refunds, [{"pidx": payment.pidx, "amount": 100000}])
+
+        revenue = self.api.get(f"/api/events/{self.ticket.event_id}/revenue/")
+        self.assertEqual(revenue.status_code, 200)
+        self.assertEqual(revenue.json()["net"], 0)
+
+    def test_claimed_booking_is_not_refunded_again(self):
+        order_id = self.make_order("Completed")
+        self.callback(order_id)
+        booking = Booking.objects.get(order_id=order_id)
+        # Another request claimed it after this one loaded the booking
+        self.assertEqual(payments.claim_refunds([booking.pk]), [booking.pk])
+
+        with mock.patch.object(BookingViewSet, "get_object", return_value=booking):
+            response = self.api.post(f"/api/bookings/{booking.id}/refund_booking/")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse([path for path, _ in self.stub.calls if "refund" in path])
+        self.assertEqual(Payment.objects.get(order_id=order_id).refunded_amount, 0)
+
+    def test_refused_refund_gives_the_booking_back(self):
+        order_id = self.make_order("Completed")
+        self.callback(order_id)
+        booking = Booking.objects.get(order_id=order_id)
+        self.stub.payments.pop(f"pidx-{order_id}")
+
+        response = self.api.post(f"/api/bookings/{booking.id}/refund_booking/")
+
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.order_statuses(order_id), {"paid"})
+        self.assertEqual(inventory.get_inventory(self.ticket).sold, 1)
+
+
+class RefundEventTests(PaymentTestCase):
+    def test_refunds_paid_bookings_in_chunks(self):
+        paid = [self.make_order("Completed", quantity=2) for _ in range(3)]
+        for order_id in paid:
+            with self.captureOnCommitCallbacks():
+                payments.complete_orders([order_id])
+        unpaid = self.make_order("Initiated")
+        # Khalti no longer knows this payment, so its refund is refused
+        self.stub.payments.pop(f"pidx-{paid[1]}")
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            stats = refund_event(
+                self.ticket.event_id, chunk_size=2, workers=2, client=self.client
+            )
+
+        self.assertEqual(stats, {"refunded": 2, "failed": 1})
+        self.assertEqual(self.order_statuses(paid[0]), {"refunded"})
+        self.assertEqual(self.order_statuses(paid[1]), {"paid"})
+        self.assertEqual(self.order_statuses(paid[2]), {"refunded"})
+        self.assertEqual(self.order_statuses(unpaid), {"pending"})
+        self.assertEqual(len(callbacks), 2)
+
+        self.assertEqual(Payment.objects.get(order_id=paid[0]).status, "refunded")
+        stock = inventory.get_inventory(self.ticket)
+        self.assertEqual((stock.sold, stock.reserved), (2, 1))
+
+    def test_bookings_claimed_elsewhere_are_skipped(self):
+        order_id = self.make_order("Completed")
+        with self.captureOnCommitCallbacks():
+            payments.complete_orders([order_id])
+        payments.claim_refunds(
+            Booking.objects.filter(order_id=order_id).values_list("id", flat=True)
+        )
+
+        stats = refund_event(self.ticket.event_id, client=self.client)
+
+        self.assertEqual(stats, {"refunded": 0, "failed": 0})
+        self.assertFalse([path for path, _ in self.stub.calls if "refund" in path])
+        self.assertEqual(self.order_statuses(order_id), {"refunding"})
+
+
+class TicketQRCodeTests(PaymentTestCase):
+    def paid_bookings(self):
+        order_id = self.make_order("Completed", quantity=1)
+        with self.captureOnCommitCallbacks():
+            payments.complete_orders([order_id])
+        return order_id, list(
+            Booking.objects.filter(order_id=order_id).values_list("id", flat=True)
+        )
+
+    def test_codes_are_rendered_once_per_payload(self):
+        order_id, booking_ids = self.paid_bookings()
+
+        self.assertEqual(tickets.generate_qr_codes(booking_ids), 1)
+        code = QRCode.objects.get(booking_id=booking_ids[0])
+        self.assertTrue(bytes(code.image).startswith(b"\x89PNG"))
+        self.assertEqual(code.content_hash, tickets.content_hash(code.qr_code))
+        self.assertEqual(tickets.generate_qr_codes(booking_ids), 0)
+
+        # A changed payload renders the code again
+        Booking.objects.filter(order_id=order_id).update(quantity=3)
+        self.assertEqual(tickets.generate_qr_codes(booking_ids), 1)
+        code = QRCode.objects.get()
+        self.assertEqual(tickets.verify_ticket(code.qr_code)["quantity"], 3)
+
+    @override_settings(QR_RENDER_WORKERS=2)
+    def test_batches_render_on_processes(self):
+        booking_ids = self.paid_bookings()[1] + self.paid_bookings()[1]
+        self.addCleanup(tickets.shutdown_render_pool)
+
+        self.assertEqual(tickets.generate_qr_codes(booking_ids), 2)
+        for code in QRCode.objects.all():
+            self.assertEqual(bytes(code.image), tickets.render_png(code.qr_code))
+
+    def test_owner_downloads_stored_code(self):
+        _, booking_ids = self.paid_bookings()
+        tickets.generate_qr_codes(booking_ids)
+        api = APIClient()
+        api.force_authenticate(self.user)
+        url = f"/api/bookings/{booking_ids[0]}/qr_code/"
+
+        # booking, its ticket and event for the payload, then the code
+        with self.assertNumQueries(4):
+            response = api.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/png")
+        self.assertEqual(
+            response.content, bytes(QRCode.objects.get(booking_id=booking_ids[0]).image)
+        )
+
+        # A client holding the current code does not download it again
+        with self.assertNumQueries(3):
+            cached = api.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.content, b"")
+
+    def test_missing_code_is_rendered_off_the_request(self):
+        _, booking_ids = self.paid_bookings()
+        api = APIClient()
+        api.force_authenticate(self.user)
+
+        with mock.patch.object(background, "submit") as submit:
+            response = api.get(f"/api/bookings/{booking_ids[0]}/qr_code/")
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response["Retry-After"], "2")
+        submit.assert_called_once_with(tickets.generate_qr_codes, booking_ids)
+        self.assertFalse(QRCode.objects.exists())
+
+
+class CheckInTests(PaymentTestCase):
+    def setUp(self):
+        super().setUp()
+        order_id = self.make_order("Completed", quantity=2)
+        with self.captureOnCommitCallbacks():
+            payments.complete_orders([order_id])
+        self.booking = Booking.objects.get(order_id=order_id)
+        self.api = APIClient()
+        self.api.force_authenticate(self.user)
+
+    def scan(self, scans):
+        return self.api.post(
+            "/api/check-ins/batch/",
+            {"event": self.ticket.event_id, "gate": "North", "scans": scans},
+            format="json",
+        )
+
+    def test_signed_payload_is_verified_offline(self):
+        payload = tickets.qr_payload(self.booking)
+        self.assertEqual(tickets.verify_ticket(payload)["booking"], self.booking.id)
+
+        forged = payload.replace(f"T2:{self.booking.id}:", "T2:999:")
+        with self.assertRaisesMessage(tickets.InvalidTicket, "bad_signature"):
+            tickets.verify_ticket(forged)
+        expires = tickets.verify_ticket(payload)["expires"]
+        with self.assertRaisesMessage(tickets.InvalidTicket, "expired"):
+            tickets.verify_ticket(payload, now=expires + 1)
+
+    def test_scanners_verify_with_the_public_key_only(self):
+        payload = tickets.qr_payload(self.booking)
+        out = StringIO()
+        call_command("ticket_public_key", stdout=out)
+        public_key = signing.load_public_key(out.getvalue().strip())
+        self.assertEqual(
+            tickets.verify_ticket(payload, public_key=public_key)["booking"],
+            self.booking.id,
+        )
+
+        other = signing.load_private_key(
+            signing.private_key_text(Ed25519PrivateKey.generate())
+        )
+        with self.assertRaisesMessage(tickets.InvalidTicket, "bad_signature"):
+            tickets.verify_ticket(payload, public_key=other.public_key())
+
+    @override_settings(TICKET_SIGNING_KEY=None)
+    def test_signing_key_is_required(self):
+        with mock.patch.object(tickets, "_signing_key", None):
+            with self.assertRaises(ImproperlyConfigured):
+                tickets.signing_key()
+            errors = checks.check_ticket_signing_key(None)
+        self.assertEqual([error.id for error in errors], ["Eventmain.E001"])
+        self.assertEqual(checks.check_ticket_signing_key(None), [])
+
+    def test_batch_admits_once_and_reports_reentries(self):
+        payload = tickets.qr_payload(self.booking)
+        response = self.scan([payload, "garbage", payload])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["admitted"], [self.booking.id])
+        self.assertEqual(
+            response.data["rejected"], [{"scan": 1, "reason": "malformed"}]
+        )
+        self.assertEqual(len(response.data["reentries"]), 1)
+
+        # A second gate scanning the same ticket does not admit it again
+        response = self.scan([payload])
+        self.assertEqual(response.data["admitted"], [])
+        self.assertEqual(response.data["reentries"][0]["gate"], "North")
+        check_in = CheckIn.objects.get()
+        self.assertEqual(check_in.reentry_attempts, 2)
+
+    def test_only_the_organizer_checks_in(self):
+        other = User.objects.create_user(
+            email="other@example.com", password="secret", phone_number="9812345678"
+        )
+        self.api.force_authenticate(other)
+        response = self.scan([tickets.qr_payload(self.booking)])
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(CheckIn.objects.exists())
+
+
+class NotificationInboxTests(TestCase):
+    def setUp(self):
+        # Unread counts are only cached in a cache shared between processes
+        directory = self.enterContext(tempfile.TemporaryDirectory())
+        self.enterContext(
+            override_settings(
+                CACHES={
+                    "default": {
+                        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+                        "LOCATION": directory,
+                    }
+                }
+            )
+        )
+        self.user = User.objects.create_user(
+            email="reader@example.com", password="secret", phone_number="9812345678"
+        )
+        other = User.objects.create_user(
+            email="other@example.com", password="secret", phone_number="9812345678"
+        )
+        organizer = Organizer.objects.create(user=other, organization_name="Org")
+        event = Event.objects.create(
+            organizer=organizer,
+            name="Festival",
+            description="Festival",
+            category="music",
+            location="Kathmandu",
+            start_date_time=timezone.now(),
+            end_date_time=timezone.now(),
+            capacity=100,
+            price=500,
+        )
+        now = timezone.now()
+        notifications = Notification.objects.bulk_create(
+            [
+                Notification(
+                    user=user,
+                    event=event,
+                    message=f"{user.email} {index}",
+                    medium="push",
+                    status=status,
+                )
+                for user, index, status in [
+                    (self.user, 0, "sent"),
+                    (self.user, 1, "sent"),
+                    (self.user, 2, "failed"),
+                    (self.user, 3, "sent"),
+                    (self.user, 4, "sent"),
+                    (self.user, 5, "digest"),
+                    (other, 0, "sent"),
+                ]
+            ]
+        )
+        # Two notifications share a timestamp, so pages must break ties on id
+        for notification, minutes in zip(notifications, [50, 40, 30, 30, 10, 0, 0]):
+            Notification.objects.filter(pk=notification.pk).update(
+                created_at=now - timedelta(minutes=minutes)
+            )
+        self.api = APIClient()
+        self.api.force_authenticate(self.user)
+
+    def test_keyset_pages_cover_the_inbox_once(self):
+        messages = []
+        url = "/api/notifications/?page_size=2"
+        while url:
+            response = self.api.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data["unread_count"], 5)
+            messages += [item["message"] for item in response.data["results"]]
+            url = response.data["next"]
+
+        self.assertEqual(
+            messages, [f"reader@example.com {index}" for index in [4, 3, 2, 1, 0]]
+        )
+
+        # With the unread count cached a page is a single query
+        _, cursor = inbox.page(self.user.id, size=2)
+        with self.assertNumQueries(1):
+            response = self.api.get(f"/api/notifications/?page_size=2&cursor={cursor}")
+        self.assertEqual(len(response.data["results"]), 2)
+
+        response = self.api.get("/api/notifications/?cursor=garbage")
+        self.assertEqual(response.status_code, 400)
+
+    def test_mark_read_updates_the_cached_count(self):
+        first, second = Notification.objects.filter(user=self.user).order_by("id")[:2]
+        self.assertEqual(inbox.unread_count(self.user.id), 5)
+
+        # The last notification belongs to another user and stays unread
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            response = self.api.post(
+                "/api/notifications/mark-read/",
+                {"ids": [first.id, second.id, Notification.objects.last().id]},
+                format="json",
+            )
+            # The count is only dropped once the update commits
+            self.assertEqual(inbox.unread_count(self.user.id), 5)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(response.data["marked"], 2)
+        self.assertEqual(inbox.unread_count(self.user.id), 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.api.post(
+                "/api/notifications/mark-read/", {"all": True}, format="json"
+            )
+        self.assertEqual(response.data["marked"], 3)
+        self.assertIsNotNone(Notification.objects.get(pk=first.pk).read_at)
+        response = self.api.get("/api/notifications/unread-count/")
+        self.assertEqual(response.data, {"unread_count": 0})
+
+        # A forgotten count is recomputed from the table
+        Notification.objects.filter(pk=first.pk).update(read_at=None)
+        with self.captureOnCommitCallbacks(execute=True):
+            inbox.forget_unread([self.user.id])
+        response = self.api.get("/api/notifications/unread-count/")
+        self.assertEqual(response.data, {"unread_count": 1})
+
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+    )
+    def test_count_is_not_cached_in_process_memory(self):
+        self.assertEqual(inbox.unread_count(self.user.id), 5)
+        Notification.objects.filter(user=self.user).update(read_at=timezone.now())
+        self.assertEqual(inbox.unread_count(self.user.id), 0)
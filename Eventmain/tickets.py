@@ -0,0 +1,236 @@
+"""
+Precomputed ticket QR codes.
+
+Rendering a QR PNG with qrcode/PIL is CPU heavy, and used to happen for
+every confirmation email. `generate_qr_codes` renders the codes of many
+bookings at once and stores them in QRCode with the SHA-256 of their
+payload; a code is only rendered again when its payload changes. Rendering
+holds the GIL, so batches are spread over a process pool of
+QR_RENDER_WORKERS processes rather than threads. Bookings are scheduled for
+rendering with `generate_after_commit` as soon as they are paid, so the
+confirmation email, re-sent tickets and the app all read the stored PNG.
+
+`stored_qr_code` returns the up to date stored code of a booking, if any,
+without rendering, for the request path. `qr_code_for` renders it on the
+spot if the background job has not got to it yet, for the outbox workers.
+
+Payloads carry the booking, ticket, quantity and expiry, signed with the
+Ed25519 private key settings.TICKET_SIGNING_KEY. Gate scanners verify
+tickets offline with the public half only (see the `ticket_public_key`
+command), so a lost scanner cannot be used to forge tickets.
+"""
+
+import hashlib
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+from cryptography.exceptions import InvalidSignature
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils import timezone
+
+from . import background, signing
+from .models import Booking, QRCode
+from .qr_render import render_png
+
+logger = logging.getLogger(__name__)
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+_signing_key = None
+
+PAYLOAD_VERSION = "T2"
+
+
+class InvalidTicket(Exception):
+    """Raised when a scanned QR payload is malformed, forged or expired."""
+
+
+def signing_key():
+    """
+    Return the private key of settings.TICKET_SIGNING_KEY, loaded once on
+    first use. Raises ImproperlyConfigured when it is missing or not a valid
+    key; `manage.py check --deploy` reports that up front.
+    """
+    global _signing_key
+    if _signing_key is None:
+        try:
+            _signing_key = signing.load_private_key(settings.TICKET_SIGNING_KEY or "")
+        except ValueError:
+            raise ImproperlyConfigured(
+                "TICKET_SIGNING_KEY must be set to an Ed25519 private key; "
+                "generate one with `python -m Eventmain.signing`"
+            )
+    return _signing_key
+
+
+def sign_ticket(booking_id, ticket_id, quantity, expires):
+    """
+    Build the signed QR payload of a booking. `expires` is a Unix
+    timestamp; the payload reads
+    `T2:<booking>:<ticket>:<quantity>:<expires>:<Ed25519 signature>`.
+    """
+    message = f"{PAYLOAD_VERSION}:{booking_id}:{ticket_id}:{quantity}:{expires}"
+    return f"{message}:{signing.encode(signing_key().sign(message.encode()))}"
+
+
+def verify_ticket(payload, now=None, public_key=None):
+    """
+    Check the signature and expiry of a scanned payload without touching
+    the database, with `public_key` (defaults to the public half of the
+    signing key). Returns a dict of booking, ticket, quantity and expires.
+    """
+    try:
+        message, signature = payload.rsplit(":", 1)
+        version, *fields = message.split(":")
+        booking_id, ticket_id, quantity, expires = map(int, fields)
+    except (AttributeError, ValueError):
+        raise InvalidTicket("malformed")
+    if version != PAYLOAD_VERSION:
+        raise InvalidTicket("malformed")
+    public_key = public_key or signing_key().public_key()
+    try:
+        public_key.verify(signing.decode(signature), message.encode())
+    except (InvalidSignature, ValueError):
+        raise InvalidTicket("bad_signature")
+    if expires < (now or time.time()):
+        raise InvalidTicket("expired")
+    return {
+        "booking": booking_id,
+        "ticket": ticket_id,
+        "quantity": quantity,
+        "expires": expires,
+    }
+
+
+def qr_payload(booking):
+    """Signed payload of `booking`, valid until its event ended plus the grace."""
+    expires = booking.ticket.event.end_date_time + timedelta(
+        hours=settings.TICKET_VALID_HOURS_AFTER_EVENT
+    )
+    return sign_ticket(
+        booking.id, booking.ticket_id, booking.quantity, int(expires.timestamp())
+    )
+
+
+def content_hash(payload):
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _get_render_pool():
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            # Spawned, not forked: the web and worker processes run threads
+            _render_pool = ProcessPoolExecutor(
+                max_workers=settings.QR_RENDER_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _render_pool
+
+
+def shutdown_render_pool():
+    """Stop the render processes; the next batch starts new ones."""
+    global _render_pool
+    with _render_pool_lock:
+        pool, _render_pool = _render_pool, None
+    if pool is not None:
+        pool.shutdown()
+
+
+def render_all(payloads, inline=False):
+    """
+    Render the PNG of every payload, in order. More than one is spread over
+    the render processes unless `inline` or QR_RENDER_WORKERS is 1.
+    """
+    if inline or len(payloads) < 2 or settings.QR_RENDER_WORKERS <= 1:
+        return [render_png(payload) for payload in payloads]
+    return list(_get_render_pool().map(render_png, payloads, chunksize=16))
+
+
+def _payloads(booking_ids):
+    """Map the id of each booking in `booking_ids` to its QR payload."""
+    bookings = (
+        Booking.objects.filter(pk__in=booking_ids)
+        .select_related("ticket__event")
+        .order_by("id")
+    )
+    return {booking.id: qr_payload(booking) for booking in bookings}
+
+
+def generate_qr_codes(booking_ids, inline=False):
+    """
+    Render and store the QR codes of `booking_ids` whose stored code is
+    missing or outdated, on the render processes unless `inline`. Returns
+    the number of codes rendered.
+    """
+    payloads = _payloads(booking_ids)
+    stored = {
+        code.booking_id: code
+        for code in QRCode.objects.filter(booking_id__in=payloads).only(
+            "id", "booking_id", "content_hash"
+        )
+    }
+    pending = [
+        (booking_id, payload)
+        for booking_id, payload in payloads.items()
+        if booking_id not in stored
+        or stored[booking_id].content_hash != content_hash(payload)
+    ]
+    if not pending:
+        return 0
+
+    images = render_all([payload for _, payload in pending], inline=inline)
+
+    now = timezone.now()
+    created, updated = [], []
+    for (booking_id, payload), image in zip(pending, images):
+        code = stored.get(booking_id) or QRCode(booking_id=booking_id)
+        code.qr_code = payload
+        code.content_hash = content_hash(payload)
+        code.image = image
+        code.updated_at = now
+        (updated if code.pk else created).append(code)
+    # A concurrent run may have stored the same code meanwhile
+    QRCode.objects.bulk_create(created, ignore_conflicts=True)
+    if updated:
+        QRCode.objects.bulk_update(
+            updated, ["qr_code", "content_hash", "image", "updated_at"]
+        )
+
+    logger.info(f"Rendered {len(pending)} ticket QR codes")
+    return len(pending)
+
+
+def generate_soon(booking_ids):
+    """Render the QR codes of `booking_ids` on the background pool."""
+    return background.submit(generate_qr_codes, list(booking_ids))
+
+
+def generate_after_commit(booking_ids):
+    """Render the QR codes of `booking_ids` on the background pool after commit."""
+    booking_ids = list(booking_ids)
+    if booking_ids:
+        transaction.on_commit(lambda: generate_soon(booking_ids))
+
+
+def stored_qr_code(booking, payload=None):
+    """
+    Return the stored QRCode of `booking` if it matches its current payload
+    (`payload` when already computed), or None.
+    """
+    payload = payload or qr_payload(booking)
+    return QRCode.objects.filter(
+        booking_id=booking.pk, content_hash=content_hash(payload)
+    ).first()
+
+
+def qr_code_for(booking):
+    """Return the up to date QRCode of `booking`, rendering it if needed."""
+    generate_qr_codes([booking.pk], inline=True)
+    return QRCode.objects.get(booking_id=booking.pk)
@@ -10,8 +10,9 @@ router.register(r"tickets", TicketViewSet)
 router.register(r"bookings", BookingViewSet)
 router.register(r"media", MediaViewSet)
 router.register(r"auditlogs", AuditLogViewSet)
-router.register(r"notifications", NotificationViewSet)
+router.register(r"notifications", NotificationViewSet, basename="notification")
 router.register(r"qrcodes", QRCodeViewSet)
+router.register(r"check-ins", CheckInViewSet, basename="check-in")
 router.register(r"analytics", EventAnalyticsViewSet)
 router.register(r"reviews", EventReviewViewSet)
 
@@ -1,5 +1,4 @@
 from datetime import timezone
-import requests
 import base64
 import io
 import qrcode
@@ -9,6 +8,9 @@ from django.core.files.storage import default_storage
 from rest_framework import status, viewsets
 from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
 from django.shortcuts import redirect, render
 from rest_framework.parsers import MultiPartParser, FormParser
 from rest_framework.exceptions import PermissionDenied
@@ -23,6 +25,19 @@ from .serializers import *
 from rest_framework import status, permissions
 from .models import AuditLog
 from rest_framework.exceptions import ValidationError
+from rest_framework.utils.urls import replace_query_param
+from . import (
+    background,
+    checkin,
+    checkout,
+    inbox,
+    inventory,
+    payments,
+    refunds,
+    tickets,
+)
+from .khalti_client import KhaltiError, KhaltiUnavailable, get_client
+from .idempotency import idempotent
 
 
 class OrganizerViewSet(viewsets.ModelViewSet):
@@ -39,8 +54,8 @@ class OrganizerViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         user = self.request.user
-        if self.action == "list":
-            # Only admins can list all organizers
+        if self.action == "list" or (self.action == "revenue" and user.is_staff):
+            # Only admins can list all organizers or see their revenue
             return Organizer.objects.all()
         else:
             # Other actions: restrict to own organizer
@@ -121,6 +136,12 @@ class OrganizerViewSet(viewsets.ModelViewSet):
         )
         return Response({"detail": "Organizer rejected."}, status=status.HTTP_200_OK)
 
+    @action(detail=True, methods=["get"])
+    def revenue(self, request, pk=None):
+        """Revenue of the organizer's events, from the payment ledger."""
+        organizer = self.get_object()
+        return Response(payments.organizer_revenue(organizer.id))
+
 
 # class OrganizerViewSet(viewsets.ModelViewSet):
 #     queryset = Organizer.objects.all()
@@ -283,6 +304,7 @@ class EventViewSet(viewsets.ModelViewSet):
             )
         event.status = "cancelled"
         event.save()
+        self._refund_bookings(event)
         AuditLog.objects.create(
             admin=request.user,
             action="Rejected event",
@@ -305,6 +327,8 @@ class EventViewSet(viewsets.ModelViewSet):
         old_status = event.status
         event.status = new_status
         event.save()
+        if new_status == "cancelled" and old_status != "cancelled":
+            self._refund_bookings(event)
         AuditLog.objects.create(
             admin=request.user,
             action=f"Changed event status from {old_status} to {new_status}",
@@ -316,6 +340,21 @@ class EventViewSet(viewsets.ModelViewSet):
             status=status.HTTP_200_OK,
         )
 
+    def _refund_bookings(self, event):
+        """Refund the paid bookings of a cancelled event in the background."""
+        transaction.on_commit(lambda: background.submit(refunds.refund_event, event.id))
+
+    @action(detail=True, methods=["get"])
+    def revenue(self, request, pk=None):
+        """Revenue of the event, from the payment ledger."""
+        event = self.get_object()
+        rows = payments.event_revenue([event.id])
+        return Response(
+            rows[0]
+            if rows
+            else {"event_id": event.id, "gross": 0, "refunded": 0, "net": 0, "orders": 0}
+        )
+
     @action(detail=True, methods=["get"])
     def media(self, request, pk=None):
         event = self.get_object()
@@ -325,136 +364,172 @@ class EventViewSet(viewsets.ModelViewSet):
 
 
 class TicketViewSet(viewsets.ModelViewSet):
-    queryset = Ticket.objects.all()
+    queryset = Ticket.objects.select_related("inventory")
     serializer_class = TicketSerializer
 
+    def perform_destroy(self, instance):
+        # Give the ticket's quantity back to the event capacity
+        with transaction.atomic():
+            inventory.allocate_capacity(instance.event, -instance.quantity)
+            instance.delete()
+
 
 class BookingViewSet(viewsets.ModelViewSet):
     queryset = Booking.objects.all()
     serializer_class = BookingSerializer
     # permission_classes = [IsAuthenticated]
 
+    @idempotent
+    def create(self, request, *args, **kwargs):
+        return super().create(request, *args, **kwargs)
+
+    def perform_destroy(self, instance):
+        # Give the seats held or sold to the booking back to its ticket,
+        # going by the status it has now rather than the one it was loaded with
+        with transaction.atomic():
+            current = (
+                Booking.objects.select_for_update()
+                .filter(pk=instance.pk)
+                .values_list("status", flat=True)
+                .first()
+            )
+            if current is not None:
+                inventory.apply_status_change(
+                    instance.ticket_id, instance.quantity, current, None
+                )
+            instance.delete()
+
     @action(detail=False, methods=["post"])
+    @idempotent
     def create_with_payment(self, request):
         """
         Create booking and initiate Khalti E-Payment.
         This replaces the widget-based approach.
         """
-        try:
-            # Extract booking data
-            print("Khalti Secret Key:", settings.KHALTI_SECRET_KEY)
-            ticket_id = request.data.get("ticket_id")
-            quantity = request.data.get("quantity")
-
-            if not ticket_id or not quantity:
-                return Response(
-                    {"error": "ticket_id and quantity are required"},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
+        # Extract booking data
+        ticket_id = request.data.get("ticket_id")
+        quantity = request.data.get("quantity")
 
-            # Get ticket and calculate total
-            from .models import Ticket
-
-            ticket = Ticket.objects.get(id=ticket_id)
-            total_amount = ticket.price * quantity
-
-            # Count how many tickets are already booked (only for 'paid' bookings)
-            booked_quantity = (
-                Booking.objects.filter(ticket=ticket, status="paid").aggregate(
-                    total=models.Sum("quantity")
-                )["total"]
-                or 0
+        if not ticket_id or not quantity:
+            return Response(
+                {"error": "ticket_id and quantity are required"},
+                status=status.HTTP_400_BAD_REQUEST,
             )
 
-            remaining_quantity = ticket.quantity - booked_quantity
+        return self._checkout(
+            request, [{"ticket_id": ticket_id, "quantity": quantity}]
+        )
+
+    @action(detail=False, methods=["post"], url_path="checkout")
+    @idempotent
+    def checkout_cart(self, request):
+        """
+        Book several ticket lines of one event and pay for them with a
+        single Khalti E-Payment.
 
-            # Ensure requested quantity does not exceed remaining
-            if quantity > remaining_quantity:
-                return Response(
-                    {"error": f"Only {remaining_quantity} tickets available."},
-                    status=status.HTTP_400_BAD_REQUEST,
-                )
+        Payload: {"items": [{"ticket_id": 1, "quantity": 2}, ...]}
+        """
+        return self._checkout(request, request.data.get("items"))
 
-            # Create booking (status = pending until payment)
-            booking = Booking.objects.create(
-                user=request.user,
-                ticket=ticket,
-                quantity=quantity,
-                total_amount=total_amount,
-                status="pending",  # Will change to 'paid' after callback
-                payment_method="khalti",
-            )
-
-            # Prepare Khalti E-Payment payload
-            payload = {
-                "return_url": f"{settings.BASE_URL}/api/bookings/khalti_callback/",
-                "website_url": settings.BASE_URL,
-                "amount": int(total_amount * 100),  # Convert Rs to paisa
-                "purchase_order_id": str(booking.id),
-                "purchase_order_name": f"Ticket for {ticket.event.name}",
-                "customer_info": {
-                    "name": request.user.get_full_name() or request.user.username,
-                    "email": request.user.email,
+    def _checkout(self, request, items):
+        """Reserve the cart lines, then initiate one Khalti payment for them."""
+        try:
+            lines = checkout.parse_lines(items)
+            order_id, bookings, remaining = checkout.reserve_order(
+                request.user, lines
+            )
+        except checkout.CheckoutError as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        except inventory.InsufficientInventory as exc:
+            return Response(
+                {
+                    "error": f"Only {exc.available} tickets available.",
+                    "ticket_id": exc.ticket.id,
                 },
-                "amount_breakdown": [
-                    {
-                        "label": f"{ticket.name} x {quantity}",
-                        "amount": int(total_amount * 100),
-                    }
-                ],
-                "product_details": [
-                    {
-                        "identity": str(ticket.id),
-                        "name": ticket.name,
-                        "total_price": int(total_amount * 100),
-                        "quantity": quantity,
-                        "unit_price": int(ticket.price * 100),
-                    }
-                ],
-            }
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-            headers = {
-                "Authorization": f"key {settings.KHALTI_SECRET_KEY}",
-                "Content-Type": "application/json",
-            }
+        if self._wants_async(request):
+            # Commit the booking now and initiate the payment in the
+            # background; the client polls payment_status for the URL
+            transaction.on_commit(
+                lambda: background.submit(payments.initiate_payment, order_id)
+            )
+            return Response(
+                {
+                    "booking_id": bookings[0].id,
+                    "booking_ids": [booking.id for booking in bookings],
+                    "order_id": order_id,
+                    "status": "initiating",
+                    "status_url": f"/api/bookings/payment-status/?order_id={order_id}",
+                    "tickets_remaining": remaining,
+                    "message": "Booking created. Poll status_url for the payment URL.",
+                },
+                status=status.HTTP_202_ACCEPTED,
+            )
 
+        try:
             # Initiate payment with Khalti
-            response = requests.post(
-                "https://a.khalti.com/api/v2/epayment/initiate/",
-                headers=headers,
-                json=payload,
-            )
-
-            if response.status_code == 200:
-                data = response.json()
-                payment_url = data.get("payment_url")
-
-                if payment_url:
-                    return Response(
-                        {
-                            "booking_id": booking.id,
-                            "payment_url": payment_url,
-                            "message": "Booking created. Please complete payment.",
-                        }
-                    )
-                else:
-                    booking.delete()  # Clean up on failure
-                    return Response(
-                        {"error": "Payment URL not received from Khalti"},
-                        status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    )
-            else:
-                booking.delete()  # Clean up on failure
-                return Response(
-                    {"error": "Failed to initiate payment", "details": response.text},
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                )
+            payment = payments.initiate_payment(order_id)
+
+            return Response(
+                {
+                    "booking_id": bookings[0].id,
+                    "booking_ids": [booking.id for booking in bookings],
+                    "order_id": order_id,
+                    "payment_url": payment.payment_url,
+                    "tickets_remaining": remaining,
+                    "message": "Booking created. Please complete payment.",
+                }
+            )
 
+        except KhaltiError as exc:
+            return Response(
+                {"error": "Failed to initiate payment", "details": exc.details},
+                status=(
+                    status.HTTP_503_SERVICE_UNAVAILABLE
+                    if isinstance(exc, KhaltiUnavailable)
+                    else status.HTTP_500_INTERNAL_SERVER_ERROR
+                ),
+            )
         except Exception as e:
             return Response(
                 {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    def _wants_async(self, request):
+        value = request.query_params.get("async", request.data.get("async"))
+        if value is None:
+            return settings.KHALTI_ASYNC_INITIATION
+        return str(value).lower() in ("true", "1", "yes")
+
+    @action(detail=False, methods=["get"], url_path="payment-status")
+    def payment_status(self, request):
+        """
+        Lightweight status of an order's payment for polling clients.
+        Returns the payment_url once the background initiation has finished.
+        """
+        order_id = request.query_params.get("order_id")
+        if not order_id:
+            return Response(
+                {"error": "order_id is required"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        payment = (
+            Payment.objects.filter(order_id=order_id, user_id=request.user.pk)
+            .values("status", "payment_url", "error")
+            .first()
+        )
+        if payment is None:
+            return Response(
+                {"error": "Payment not found"}, status=status.HTTP_404_NOT_FOUND
+            )
+
+        response = Response({"order_id": order_id, **payment})
+        if payment["status"] == "initiating":
+            response["Retry-After"] = "1"
+        return response
+
     @action(detail=False, methods=["get"])
     def khalti_callback(self, request):
         """
@@ -480,50 +555,47 @@ class BookingViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        try:
-            # Verify payment with Khalti
-            verification_response = requests.post(
-                "https://dev.khalti.com/api/v2/epayment/lookup/",
-                json={"pidx": pidx},
-                headers={
-                    "Authorization": f"key {settings.KHALTI_SECRET_KEY}",
-                    "Content-Type": "application/json",
-                },
-            )
-
-            if verification_response.status_code == 200:
-                verification_data = verification_response.json()
+        frontend_url = getattr(
+            settings.FRONTEND_URL, "FRONTEND_URL", "http://localhost:3000"
+        )
 
-                # Check if payment is actually not completed
-                if verification_data.get("status") != "Completed":
-                    return Response(
-                        {"error": "Payment verification failed"},
-                        status=status.HTTP_400_BAD_REQUEST,
-                    )
+        def success_redirect(order_id):
+            first_booking = checkout.order_bookings(order_id).order_by("id").first()
+            return redirect(
+                f"{frontend_url}/booking-success?booking_id={first_booking.id}"
+                f"&order_id={order_id}"
+            )
 
-                # Update booking status
-                booking = Booking.objects.get(id=booking_id)
-                booking.status = "paid"
-                booking.transaction_id = pidx  # Store pidx as transaction_id
-                booking.save()
+        # Replayed callbacks are answered from the payment ledger without
+        # calling Khalti or touching the bookings again
+        payment = payments.completed_payment(pidx)
+        if payment is not None:
+            return success_redirect(payment.order_id)
 
-                frontend_url = getattr(
-                    settings.FRONTEND_URL, "FRONTEND_URL", "http://localhost:3000"
-                )
-
-                return redirect(
-                    f"{frontend_url}/booking-success?booking_id={booking.id}"
-                )
+        try:
+            # Verify payment with Khalti
+            verification_data = get_client().lookup(pidx)
 
-            else:
+            # Check if payment is actually not completed
+            if verification_data.get("status") != "Completed":
                 return Response(
-                    {
-                        "error": "Payment verification failed",
-                        "details": verification_response.text,
-                    },
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    {"error": "Payment verification failed"},
+                    status=status.HTTP_400_BAD_REQUEST,
                 )
 
+            # Mark the order's bookings paid, once
+            payment, _ = payments.complete_payment(
+                booking_id, pidx, tidx=verification_data.get("transaction_id") or tidx
+            )
+            return success_redirect(payment.order_id)
+
+        except KhaltiError as exc:
+            return Response(
+                {"error": "Payment verification failed", "details": exc.details},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            )
+        except payments.PaymentMismatch as exc:
+            return Response({"error": str(exc)}, status=status.HTTP_400_BAD_REQUEST)
         except Booking.DoesNotExist:
             return Response(
                 {"error": "Booking not found"}, status=status.HTTP_404_NOT_FOUND
@@ -533,6 +605,42 @@ class BookingViewSet(viewsets.ModelViewSet):
                 {"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
 
+    @action(detail=True, methods=["get"])
+    def qr_code(self, request, pk=None):
+        """Serve the stored ticket QR code of a paid booking as a PNG."""
+        booking = self.get_object()
+        if booking.user_id != request.user.id and not request.user.is_staff:
+            raise PermissionDenied("You can only view your own tickets.")
+        if booking.status != "paid":
+            return Response(
+                {"error": "Only paid bookings have a ticket"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        # The image only depends on the payload, so a client holding the
+        # code of the current payload gets a 304 without it being loaded
+        payload = tickets.qr_payload(booking)
+        etag = f'"{tickets.content_hash(payload)}"'
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            not_modified["Cache-Control"] = "private, max-age=3600"
+            return not_modified
+
+        code = tickets.stored_qr_code(booking, payload)
+        if code is None:
+            # Rendering is left to the background pool, off the request path
+            tickets.generate_soon([booking.pk])
+            return Response(
+                {"detail": "The ticket is being generated, retry shortly"},
+                status=status.HTTP_202_ACCEPTED,
+                headers={"Retry-After": "2"},
+            )
+
+        response = HttpResponse(bytes(code.image), content_type="image/png")
+        response["ETag"] = etag
+        response["Cache-Control"] = "private, max-age=3600"
+        return response
+
     @action(detail=True, methods=["post"])
     def refund_booking(self, request, pk=None):
         """
@@ -546,28 +654,38 @@ class BookingViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        try:
-            # For E-Payment, use the refund endpoint (if available)
-            # Note: You may need to check Khalti's E-Payment refund documentation
-            refund_url = "https://dev.khalti.com/api/v2/epayment/refund/"
-            headers = {"Authorization": f"key {settings.KHALTI_SECRET_KEY}"}
-            payload = {
-                "pidx": booking.transaction_id,  # Use pidx for E-Payment refunds
-                "amount": int(booking.total_amount * 100),  # Amount in paisa
-            }
+        payment = payments.payment_for_booking(booking)
+        if payment is None or not payment.pidx:
+            return Response(
+                {"error": "No Khalti payment recorded for this booking"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-            response = requests.post(refund_url, headers=headers, json=payload)
+        # Claim the booking first, so concurrent requests refund it only once
+        if not payments.claim_refunds([booking.pk]):
+            return Response(
+                {"error": "Only paid bookings can be refunded"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
 
-            if response.status_code == 200:
-                booking.status = "refunded"
-                booking.save()  # This will trigger refund notification signals
+        try:
+            # E-Payment refunds are made against the pidx of the order
+            get_client().refund(
+                payment.pidx,
+                int(booking.total_amount * 100),  # Amount in paisa
+            )
+        except KhaltiError as exc:
+            payments.release_refunds([booking.pk])
+            return Response(
+                {"error": "Refund failed", "details": exc.details},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            )
 
-                return Response({"message": "Booking refunded successfully"})
-            else:
-                return Response(
-                    {"error": "Refund failed", "details": response.text},
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                )
+        try:
+            # Restocks the seats, records the refund in the ledger and sends
+            # the refund notifications
+            payments.settle_refunds([booking.pk])
+            return Response({"message": "Booking refunded successfully"})
 
         except Exception as e:
             return Response(
@@ -619,9 +737,77 @@ class AuditLogViewSet(viewsets.ModelViewSet):
     serializer_class = AuditLogSerializer
 
 
-class NotificationViewSet(viewsets.ModelViewSet):
-    queryset = Notification.objects.all()
+class NotificationViewSet(viewsets.ReadOnlyModelViewSet):
+    """The requesting user's notification inbox, newest first."""
+
     serializer_class = NotificationSerializer
+    permission_classes = [IsAuthenticated]
+    PAGE_SIZE = 20
+    MAX_PAGE_SIZE = 100
+    MAX_MARK_READ = 1000
+
+    def get_queryset(self):
+        return inbox.notifications_of(self.request.user.id)
+
+    def list(self, request, *args, **kwargs):
+        """
+        One page of notifications. Pass the returned `next` cursor as
+        ?cursor= to get the following page; it is null on the last one.
+        """
+        try:
+            size = min(
+                int(request.query_params.get("page_size", self.PAGE_SIZE)),
+                self.MAX_PAGE_SIZE,
+            )
+            notifications, cursor = inbox.page(
+                request.user.id, request.query_params.get("cursor"), max(size, 1)
+            )
+        except ValueError:
+            return Response(
+                {"error": "Invalid cursor or page_size"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        next_url = None
+        if cursor:
+            next_url = replace_query_param(
+                request.build_absolute_uri(), "cursor", cursor
+            )
+        return Response(
+            {
+                "next": next_url,
+                "unread_count": inbox.unread_count(request.user.id),
+                "results": self.get_serializer(notifications, many=True).data,
+            }
+        )
+
+    @action(detail=False, methods=["get"], url_path="unread-count")
+    def unread_count(self, request):
+        return Response({"unread_count": inbox.unread_count(request.user.id)})
+
+    @action(detail=False, methods=["post"], url_path="mark-read")
+    def mark_read(self, request):
+        """
+        Mark notifications read. Body: {"ids": [1, 2, ...]}, or {"all": true}
+        for every unread notification.
+        """
+        ids = request.data.get("ids")
+        if request.data.get("all") is True:
+            ids = None
+        elif not isinstance(ids, list) or len(ids) > self.MAX_MARK_READ:
+            return Response(
+                {"error": f"ids must be a list of at most {self.MAX_MARK_READ} ids"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        try:
+            marked = inbox.mark_read(request.user.id, ids)
+        except (TypeError, ValueError):
+            return Response(
+                {"error": "ids must be notification ids"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return Response(
+            {"marked": marked, "unread_count": inbox.unread_count(request.user.id)}
+        )
 
 
 class QRCodeViewSet(viewsets.ModelViewSet):
@@ -629,6 +815,53 @@ class QRCodeViewSet(viewsets.ModelViewSet):
     serializer_class = QRCodeSerializer
 
 
+class CheckInViewSet(viewsets.ViewSet):
+    """Gate check-in of scanned ticket QR codes, in batches."""
+
+    permission_classes = [IsAuthenticated]
+    MAX_BATCH_SIZE = 1000
+
+    @action(detail=False, methods=["post"])
+    def batch(self, request):
+        """
+        Check in a batch of scanned QR payloads for one event.
+
+        Body: {"event": <id>, "gate": "<name>", "scans": ["T1:...", ...]}.
+        Only staff and the event's organizer can check tickets in.
+        """
+        event_id = request.data.get("event")
+        scans = request.data.get("scans")
+        if not event_id or not isinstance(scans, list):
+            return Response(
+                {"error": "event and a list of scans are required"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        if len(scans) > self.MAX_BATCH_SIZE:
+            return Response(
+                {"error": f"At most {self.MAX_BATCH_SIZE} scans per batch"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        event = Event.objects.filter(pk=event_id).only("id", "organizer_id").first()
+        if event is None:
+            return Response(
+                {"error": "Event not found"}, status=status.HTTP_404_NOT_FOUND
+            )
+        organizer = getattr(request.user, "organizer_profile", None)
+        if not request.user.is_staff and (
+            organizer is None or organizer.id != event.organizer_id
+        ):
+            raise PermissionDenied("Only the event's organizer can check tickets in.")
+
+        result = checkin.check_in_batch(
+            event.id,
+            [str(scan) for scan in scans],
+            gate=str(request.data.get("gate", ""))[:50],
+            user=request.user,
+        )
+        return Response(result)
+
+
 class EventReviewViewSet(viewsets.ModelViewSet):
     queryset = EventReview.objects.all()
     serializer_class = EventReviewSerializer
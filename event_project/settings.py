@@ -71,6 +71,17 @@ MIDDLEWARE = [
 ROOT_URLCONF = "event_project.urls"
 
 FIREBASE_CONFIG = os.getenv("FIREBASE_CONFIG")
+# Service account key, read when the fcm push backend first sends
+FIREBASE_CREDENTIAL_PATH = os.path.join(
+    BASE_DIR, os.getenv("FIREBASE_CREDENTIAL_PATH", "firebase_key.json")
+)
+# Push backend: "fcm", "memory" (kept in memory, for tests) or "log"
+PUSH_BACKEND = os.getenv("PUSH_BACKEND", "fcm")
+# Behaviour of the "fake" push backend used by `manage.py benchmark_push`:
+# seconds per FCM call and the fractions of failed sends and invalid tokens
+PUSH_FAKE_LATENCY = float(os.getenv("PUSH_FAKE_LATENCY", "0.05"))
+PUSH_FAKE_FAILURE_RATE = float(os.getenv("PUSH_FAKE_FAILURE_RATE", "0.01"))
+PUSH_FAKE_INVALID_RATE = float(os.getenv("PUSH_FAKE_INVALID_RATE", "0.02"))
 
 TEMPLATES = [
     {
@@ -219,6 +230,16 @@ KHALTI_SECRET_KEY = os.getenv("KHALTI_SECRET_KEY", "test_secret_key")
 KHALTI_VERIFY_URL = os.getenv(
     "KHALTI_VERIFY_URL", "https://test-pay.khalti.com/api/v2/payment/verify/"
 )
+# E-payment API used by Eventmain.khalti_client (sandbox by default)
+KHALTI_BASE_URL = os.getenv("KHALTI_BASE_URL", "https://dev.khalti.com/api/v2/")
+KHALTI_CONNECT_TIMEOUT = float(os.getenv("KHALTI_CONNECT_TIMEOUT", "3"))
+KHALTI_READ_TIMEOUT = float(os.getenv("KHALTI_READ_TIMEOUT", "10"))
+KHALTI_LOOKUP_RETRIES = int(os.getenv("KHALTI_LOOKUP_RETRIES", "3"))
+KHALTI_POOL_SIZE = int(os.getenv("KHALTI_POOL_SIZE", "20"))
+KHALTI_CIRCUIT_FAILURE_THRESHOLD = int(
+    os.getenv("KHALTI_CIRCUIT_FAILURE_THRESHOLD", "5")
+)
+KHALTI_CIRCUIT_RESET_SECONDS = int(os.getenv("KHALTI_CIRCUIT_RESET_SECONDS", "30"))
 
 # Email SMTP settings for MailHog
 
@@ -230,6 +251,10 @@ EMAIL_USE_SSL = os.getenv("EMAIL_USE_SSL").lower() in ("true", "1", "yes")
 EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER")
 EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD")
 DEFAULT_FROM_EMAIL = os.getenv("DEFAULT_FROM_EMAIL")
+# Batched emails (firebase.mailer) go out EMAIL_BATCH_SIZE at a time over a
+# shared connection, or once the oldest waited EMAIL_FLUSH_INTERVAL seconds
+EMAIL_BATCH_SIZE = int(os.getenv("EMAIL_BATCH_SIZE", "100"))
+EMAIL_FLUSH_INTERVAL = float(os.getenv("EMAIL_FLUSH_INTERVAL", "5"))
 
 # # Email settings for MailTrap
 
@@ -240,3 +265,85 @@ DEFAULT_FROM_EMAIL = os.getenv("DEFAULT_FROM_EMAIL")
 # EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER")
 # EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD")
 # DEFAULT_FROM_EMAIL = os.getenv("DEFAULT_FROM_EMAIL")
+
+# Booking holds
+# Pending bookings keep their seats for BOOKING_HOLD_MINUTES; the sweeper
+# expires stale holds every BOOKING_HOLD_SWEEP_INTERVAL seconds when
+# BACKGROUND_TASKS_ENABLED is on (or run `manage.py expire_booking_holds`).
+BOOKING_HOLD_MINUTES = int(os.getenv("BOOKING_HOLD_MINUTES", "15"))
+BOOKING_HOLD_SWEEP_INTERVAL = int(os.getenv("BOOKING_HOLD_SWEEP_INTERVAL", "60"))
+BACKGROUND_TASKS_ENABLED = os.getenv("BACKGROUND_TASKS_ENABLED", "False") == "True"
+
+# Idempotency-Key responses are replayed for this long
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_KEY_TTL_HOURS", "24"))
+IDEMPOTENCY_PURGE_INTERVAL = int(os.getenv("IDEMPOTENCY_PURGE_INTERVAL", "3600"))
+# A key whose request has not answered after this long is taken over by a
+# retry, as the request most likely crashed or timed out
+IDEMPOTENCY_CLAIM_TIMEOUT_SECONDS = int(
+    os.getenv("IDEMPOTENCY_CLAIM_TIMEOUT_SECONDS", "300")
+)
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", "4"))
+# Initiated Khalti payments whose callback never arrived are looked up every
+# KHALTI_RECONCILE_INTERVAL seconds (or run `manage.py reconcile_khalti_payments`).
+KHALTI_RECONCILE_INTERVAL = int(os.getenv("KHALTI_RECONCILE_INTERVAL", "600"))
+
+# Initiate Khalti payments on the background pool and let clients poll
+# /api/bookings/payment-status/ (clients can also opt in per request)
+KHALTI_ASYNC_INITIATION = os.getenv("KHALTI_ASYNC_INITIATION", "False") == "True"
+
+# Notification outbox: drained after each commit (OUTBOX_DRAIN_ON_COMMIT),
+# every OUTBOX_DRAIN_INTERVAL seconds, or by `manage.py drain_outbox`
+OUTBOX_DRAIN_ON_COMMIT = os.getenv("OUTBOX_DRAIN_ON_COMMIT", "True") == "True"
+OUTBOX_DRAIN_INTERVAL = int(os.getenv("OUTBOX_DRAIN_INTERVAL", "30"))
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_RETRY_BACKOFF = int(os.getenv("OUTBOX_RETRY_BACKOFF", "30"))
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "300"))
+
+# Processes rendering batches of ticket QR codes once bookings are paid
+QR_RENDER_WORKERS = int(os.getenv("QR_RENDER_WORKERS", "4"))
+# Ticket QR payloads are signed with this Ed25519 private key (generate one
+# with `python -m Eventmain.signing`; scanners only get its public half, see
+# `manage.py ticket_public_key`). It is required: start-up fails without it.
+# Payloads stay valid until TICKET_VALID_HOURS_AFTER_EVENT after the event
+TICKET_SIGNING_KEY = os.getenv("TICKET_SIGNING_KEY")
+TICKET_VALID_HOURS_AFTER_EVENT = int(os.getenv("TICKET_VALID_HOURS_AFTER_EVENT", "12"))
+
+# Notifications of the same kind are recorded once per user, event and
+# medium within NOTIFICATION_DEDUP_WINDOW seconds. Each user may get
+# NOTIFICATION_RATE_BURST notifications at once, refilled at
+# NOTIFICATION_RATE_PER_MINUTE; the rest are coalesced and sent as one
+# message every NOTIFICATION_COALESCE_INTERVAL seconds (or run
+# `manage.py flush_notifications`). Booking notifications are exempt.
+NOTIFICATION_DEDUP_WINDOW = int(os.getenv("NOTIFICATION_DEDUP_WINDOW", "300"))
+NOTIFICATION_RATE_BURST = int(os.getenv("NOTIFICATION_RATE_BURST", "10"))
+NOTIFICATION_RATE_PER_MINUTE = float(os.getenv("NOTIFICATION_RATE_PER_MINUTE", "10"))
+NOTIFICATION_COALESCE_INTERVAL = int(os.getenv("NOTIFICATION_COALESCE_INTERVAL", "60"))
+
+# How published events are pushed: "multicast" to every token, "targeted"
+# to the users interested in the event's category, or "topic" for one send
+# to the FCM category topics (run `manage.py sync_topic_subscriptions` once
+# before switching to it)
+PUSH_PUBLISH_MODE = os.getenv("PUSH_PUBLISH_MODE", "multicast")
+# User category interests used by the targeted mode are rebuilt every
+# INTEREST_REFRESH_INTERVAL seconds (or run `manage.py materialize_interests`)
+INTEREST_REFRESH_INTERVAL = int(os.getenv("INTEREST_REFRESH_INTERVAL", "3600"))
+# Users in digest notification mode get their pending event notifications
+# as one push and email every DIGEST_INTERVAL seconds (or run
+# `manage.py flush_digests`)
+DIGEST_INTERVAL = int(os.getenv("DIGEST_INTERVAL", "86400"))
+# Seconds a user's cached unread notification count is kept at most. The
+# count is only cached in a cache shared by every process (set CACHE_URL);
+# with the default per-process local memory cache it is counted every time.
+INBOX_UNREAD_CACHE_TIMEOUT = int(os.getenv("INBOX_UNREAD_CACHE_TIMEOUT", "300"))
+
+# Shared cache, e.g. redis://localhost:6379/0 (requires the redis package).
+# Without it Django's per-process local memory cache is used.
+CACHE_URL = os.getenv("CACHE_URL")
+if CACHE_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": CACHE_URL,
+        }
+    }
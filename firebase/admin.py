@@ -1,6 +1,7 @@
 # admin.py
 from django.contrib import admin
-from .models import FCMTokens, NotificationToken
+from django.utils import timezone
+from .models import FCMTokens, NotificationToken, OutboxMessage, UserCategoryInterest
 
 @admin.register(FCMTokens)
 class FCMTokensAdmin(admin.ModelAdmin):
@@ -12,3 +13,22 @@ class NotificationTokenAdmin(admin.ModelAdmin):
     list_display = ('id', 'owner', 'token')
     search_fields = ('token', 'owner__email')  # Adjust based on your User model
     autocomplete_fields = ['owner']
+
+@admin.register(OutboxMessage)
+class OutboxMessageAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'status', 'attempts', 'available_at', 'created_at')
+    list_filter = ('status', 'kind')
+    readonly_fields = ('created_at', 'sent_at')
+    actions = ['requeue']
+
+    @admin.action(description="Requeue selected messages")
+    def requeue(self, request, queryset):
+        queryset.exclude(status='sent').update(
+            status='pending', attempts=0, available_at=timezone.now()
+        )
+
+@admin.register(UserCategoryInterest)
+class UserCategoryInterestAdmin(admin.ModelAdmin):
+    list_display = ('user', 'category', 'score', 'updated_at')
+    list_filter = ('category',)
+    search_fields = ('user__email',)
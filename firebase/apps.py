@@ -5,4 +5,24 @@ class FirebaseConfig(AppConfig):
 
     def ready(self):
         import firebase.signals
+        from django.conf import settings
+        from Eventmain import background
+        from firebase import audience, digest, outbox, throttle
+
+        background.register_periodic(
+            "drain-outbox", settings.OUTBOX_DRAIN_INTERVAL, outbox.drain
+        )
+        background.register_periodic(
+            "flush-coalesced-notifications",
+            settings.NOTIFICATION_COALESCE_INTERVAL,
+            throttle.flush_coalesced,
+        )
+        background.register_periodic(
+            "materialize-interests",
+            settings.INTEREST_REFRESH_INTERVAL,
+            audience.materialize_interests,
+        )
+        background.register_periodic(
+            "flush-digests", settings.DIGEST_INTERVAL, digest.flush_digests
+        )
 
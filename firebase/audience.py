@@ -0,0 +1,103 @@
+"""
+Audience of published events.
+
+Instead of pushing every published event to every token, the targeted
+publish mode (PUSH_PUBLISH_MODE=targeted) only reaches users interested in
+the event's category. Interests are materialized into UserCategoryInterest
+by `materialize_interests`, every INTEREST_REFRESH_INTERVAL seconds or with
+the `materialize_interests` command, from paid bookings, reviews,
+EventAnalytics rows with views or clicks and followed categories, each
+weighted by INTEREST_WEIGHTS.
+
+`recipient_tokens` then selects the audience of a category with one range
+scan of the (category, user) index joined to the tokens.
+"""
+
+import logging
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from Eventmain.models import Booking, EventAnalytics, EventReview
+from firebase.models import (
+    CategorySubscription,
+    NotificationToken,
+    UserCategoryInterest,
+)
+
+logger = logging.getLogger(__name__)
+
+INTEREST_WEIGHTS = {"booking": 5, "review": 3, "view": 1, "subscription": 10}
+
+
+def _interest_counts():
+    """Yield `(source, user_id, category, count)` for every interest source."""
+    sources = [
+        (
+            "booking",
+            Booking.objects.filter(status="paid"),
+            "user_id",
+            "ticket__event__category",
+        ),
+        ("review", EventReview.objects.all(), "user_id", "event__category"),
+        (
+            "view",
+            EventAnalytics.objects.filter(Q(views__gt=0) | Q(clicks__gt=0)),
+            "user_id",
+            "event__category",
+        ),
+    ]
+    for source, queryset, user_field, category_field in sources:
+        rows = (
+            queryset.values_list(user_field, category_field)
+            .annotate(count=Count("pk"))
+            .order_by()
+        )
+        for user_id, category, count in rows:
+            yield source, user_id, category, count
+
+    for user_id, category in CategorySubscription.objects.values_list(
+        "user_id", "category"
+    ):
+        yield "subscription", user_id, category, 1
+
+
+def materialize_interests(batch_size=1000):
+    """
+    Rebuild UserCategoryInterest from the interest sources with one
+    aggregate query per source. Returns the number of interests stored.
+    """
+    scores = defaultdict(int)
+    for source, user_id, category, count in _interest_counts():
+        if category:
+            scores[(user_id, category)] += INTEREST_WEIGHTS[source] * count
+
+    now = timezone.now()
+    interests = [
+        UserCategoryInterest(
+            user_id=user_id, category=category, score=score, updated_at=now
+        )
+        for (user_id, category), score in scores.items()
+    ]
+    with transaction.atomic():
+        UserCategoryInterest.objects.bulk_create(
+            interests,
+            batch_size=batch_size,
+            update_conflicts=True,
+            unique_fields=["user", "category"],
+            update_fields=["score", "updated_at"],
+        )
+        # Interests no source backs any more
+        UserCategoryInterest.objects.filter(updated_at__lt=now).delete()
+
+    logger.info(f"Materialized {len(interests)} category interests")
+    return len(interests)
+
+
+def recipient_tokens(category):
+    """Notification tokens of the users interested in `category`."""
+    return NotificationToken.objects.filter(
+        owner__category_interests__category=category
+    )
@@ -0,0 +1,163 @@
+"""
+Notification digests.
+
+Users whose `notification_mode` is "digest" get no push per published
+event. The publish fan-out records their notifications with the "digest"
+status instead, and `flush_digests` (every DIGEST_INTERVAL seconds, or the
+`flush_digests` command) sends each of them one push and one email listing
+the events. Each user's accumulated rows are then replaced by a single
+summary Notification, so these users add one row per digest to the table
+instead of one per event.
+
+Like coalesced notifications, the items are claimed with
+`firebase.throttle.claim` before they are sent, so concurrent flushes
+never send a user the same digest twice. Items are only replaced once the
+digest's push or email went out; undelivered ones are released to the next
+flush.
+"""
+
+import logging
+from itertools import groupby
+
+from django.db import transaction
+
+from Eventmain import inbox
+from Eventmain.models import Notification
+from firebase import mailer, throttle
+
+logger = logging.getLogger(__name__)
+
+DIGEST_TITLE = "Your event digest"
+
+
+def accumulate(event, message, user_ids, batch_size=1000):
+    """
+    Record the publish notification of `event` as pending digest items of
+    `user_ids` (an iterable of ids), in bulk. Returns the number recorded.
+    """
+    recorded = 0
+    batch = []
+    for user_id in user_ids:
+        batch.append(
+            Notification(
+                user_id=user_id,
+                event=event,
+                message=message,
+                medium="push",
+                status="digest",
+            )
+        )
+        if len(batch) == batch_size:
+            Notification.objects.bulk_create(batch)
+            recorded += len(batch)
+            batch = []
+    if batch:
+        Notification.objects.bulk_create(batch)
+        recorded += len(batch)
+    return recorded
+
+
+def summary(notifications):
+    names = [notification.event.name for notification in notifications]
+    if len(names) == 1:
+        return f"New event: {names[0]}"
+    return f"{len(names)} new events: " + ", ".join(names)
+
+
+def _send(user, notifications, done):
+    """
+    Send `user` the digest of `notifications`, then call `done(delivered)`
+    once its email went out, which inside `mailer.batched()` is when its
+    batch is flushed.
+    """
+    from firebase.utils import send_email_notification, send_push_to_user
+
+    message = summary(notifications)
+    pushed = False
+    try:
+        pushed = bool(send_push_to_user(user, DIGEST_TITLE, message))
+    except Exception as e:
+        logger.exception(f"Digest push to user {user.id} failed: {e}")
+
+    settled = []
+
+    def email_sent(sent):
+        if not settled:
+            settled.append(sent)
+            done(pushed or sent)
+
+    event = notifications[-1].event
+    if not send_email_notification(user, message, event, DIGEST_TITLE, email_sent):
+        email_sent(False)
+
+
+def _settle(outcomes):
+    """
+    Replace the items of the delivered digests in `outcomes` (a list of
+    `(notifications, delivered)`) by their summaries, and release the others.
+    """
+    delivered = [items for items, ok in outcomes if ok]
+    undelivered = [item.pk for items, ok in outcomes if not ok for item in items]
+    with transaction.atomic():
+        Notification.objects.filter(
+            pk__in=[item.pk for items in delivered for item in items]
+        ).delete()
+        Notification.objects.bulk_create(
+            Notification(
+                user=items[0].user,
+                event=items[-1].event,
+                message=summary(items),
+                medium="push",
+                status="sent",
+            )
+            for items in delivered
+        )
+        Notification.objects.filter(pk__in=undelivered).update(claimed_until=None)
+    inbox.forget_unread({items[0].user_id for items in delivered})
+    if undelivered:
+        logger.warning(f"{len(outcomes) - len(delivered)} digests were not delivered")
+    return len(delivered)
+
+
+def flush_digests(users_per_batch=200):
+    """
+    Send every user with pending digest items their digest, walking the
+    users in batches of `users_per_batch`. Returns the number of digests
+    sent.
+    """
+    digests = Notification.objects.filter(status="digest")
+    flushed = 0
+    last_user_id = 0
+    with mailer.batched() as dispatcher:
+        while True:
+            user_ids = list(
+                digests.filter(user_id__gt=last_user_id)
+                .order_by("user_id")
+                .values_list("user_id", flat=True)
+                .distinct()[:users_per_batch]
+            )
+            if not user_ids:
+                break
+            last_user_id = user_ids[-1]
+
+            claimed = throttle.claim(digests.filter(user_id__in=user_ids))
+            items = list(
+                digests.filter(id__in=claimed)
+                .select_related("user", "event")
+                .order_by("user_id", "created_at", "id")
+            )
+            outcomes = []
+            for _, group in groupby(items, key=lambda item: item.user_id):
+                notifications = list(group)
+                _send(
+                    notifications[0].user,
+                    notifications,
+                    lambda ok, items=notifications: outcomes.append((items, ok)),
+                )
+            # Send the batch's emails before their items are replaced
+            dispatcher.flush()
+            flushed += _settle(outcomes)
+
+    if flushed:
+        logger.info(f"Sent {flushed} notification digests")
+    return flushed
@@ -0,0 +1,203 @@
+"""
+Bulk push fan-out.
+
+`publish_event` notifies every user with a notification token that an event
+was published. Tokens are streamed from the database in owner order and
+grouped into batches of at most FCM_MULTICAST_LIMIT tokens; each batch gets
+one FCM multicast call and then its Notification rows, with their outcome,
+in one bulk INSERT, instead of four round trips per user. Tokens FCM reports
+as unregistered or invalid are deleted with one more query. A multicast call
+that fails as a whole raises, after reporting the last owner of the previous
+batches through `progress`, so a retry can resume there. With `targeted`,
+only the users interested in the event's category are reached (see
+`firebase.audience`). Users in digest mode are not pushed to; their
+notifications are recorded for `firebase.digest` in bulk instead.
+
+`publish_event_to_topics` is the topic based alternative (see
+`firebase.topics`): one FCM send to the event's topic condition, plus the
+Notification rows of its recipients written in bulk once FCM accepted it.
+settings.PUSH_PUBLISH_MODE picks which one publishing uses.
+
+Both run from the notification outbox, never inside the request that
+published the event.
+"""
+
+import logging
+from itertools import groupby
+
+from django.db import transaction
+
+from Eventmain import inbox
+from Eventmain.models import Event, Notification
+from firebase.models import NotificationToken
+from firebase import audience, digest, topics
+from firebase.utils import (
+    prune_invalid_tokens,
+    send_fcm_multicast,
+    send_fcm_to_condition,
+)
+
+logger = logging.getLogger(__name__)
+
+# FCM accepts at most 500 tokens per multicast message
+FCM_MULTICAST_LIMIT = 500
+
+
+def _owner_batches(tokens, batch_size):
+    """
+    Group `(owner_id, token)` pairs, sorted by owner, into lists of
+    `(owner_id, [tokens])` holding at most `batch_size` tokens each. An
+    owner's tokens are only split when they alone exceed the batch size.
+    """
+    batch, size = [], 0
+    for owner_id, owner_tokens in groupby(tokens, key=lambda pair: pair[0]):
+        owner_tokens = [token for _, token in owner_tokens]
+        while owner_tokens:
+            if size and size + len(owner_tokens) > batch_size:
+                yield batch
+                batch, size = [], 0
+            chunk = owner_tokens[:batch_size]
+            owner_tokens = owner_tokens[batch_size:]
+            batch.append((owner_id, chunk))
+            size += len(chunk)
+    if batch:
+        yield batch
+
+
+def send_push_batch(event, owners, title, message):
+    """
+    Send and record one push notification to every owner in `owners`, a list
+    of `(owner_id, [tokens])`. Returns the number of users reached; raises
+    when the multicast call itself fails, recording nothing.
+    """
+    tokens = [token for _, owner_tokens in owners for token in owner_tokens]
+    responses = send_fcm_multicast(tokens, title, message).responses
+    prune_invalid_tokens(tokens, responses)
+    delivered = iter([response.success for response in responses])
+
+    notifications = []
+    for owner_id, owner_tokens in owners:
+        # next() for every token keeps the iterator aligned with `tokens`
+        results = [next(delivered, False) for _ in owner_tokens]
+        notifications.append(
+            Notification(
+                user_id=owner_id,
+                event=event,
+                message=message,
+                medium="push",
+                status="sent" if any(results) else "failed",
+            )
+        )
+    _record(notifications)
+    return sum(notification.status == "sent" for notification in notifications)
+
+
+def publish_event(
+    event_id,
+    batch_size=FCM_MULTICAST_LIMIT,
+    targeted=False,
+    after_owner=None,
+    progress=None,
+):
+    """
+    Push the "New Event" notification of a published event to every user
+    with a notification token, or with `targeted` only to the users
+    interested in its category (see `firebase.audience`). Returns the
+    number of users reached.
+
+    `progress(owner_id)` is called once the digest items are recorded (with
+    0) and after every batch sent (with its last owner). Passing the last
+    value as `after_owner` resumes an interrupted publish after that owner;
+    an owner whose tokens alone exceed a batch may then miss the rest of
+    their devices.
+    """
+    event = Event.objects.get(pk=event_id)
+    title = f"New Event: {event.name}"
+    message = event.description[:100] + "..."
+
+    if targeted:
+        tokens = audience.recipient_tokens(event.category)
+    else:
+        tokens = NotificationToken.objects.filter(owner__isnull=False)
+
+    progress = progress or (lambda owner_id: None)
+
+    digested = 0
+    if after_owner is None:
+        # Users in digest mode get the event in their next digest instead
+        digested = digest.accumulate(
+            event,
+            message,
+            tokens.filter(owner__notification_mode="digest")
+            .order_by("owner_id")
+            .values_list("owner_id", flat=True)
+            .distinct()
+            .iterator(chunk_size=2000),
+        )
+        after_owner = 0
+        progress(after_owner)
+
+    tokens = (
+        tokens.filter(owner__notification_mode="instant", owner_id__gt=after_owner)
+        .order_by("owner_id", "id")
+        .values_list("owner_id", "token")
+        .iterator(chunk_size=2000)
+    )
+    reached = 0
+    for owners in _owner_batches(tokens, min(batch_size, FCM_MULTICAST_LIMIT)):
+        reached += send_push_batch(event, owners, title, message)
+        progress(owners[-1][0])
+
+    logger.info(f"Published event {event_id} to {reached} users, {digested} digested")
+    return reached
+
+
+def _record(notifications):
+    Notification.objects.bulk_create(notifications)
+    inbox.forget_unread([notification.user_id for notification in notifications])
+
+
+def publish_event_to_topics(event_id, batch_size=1000, sent=False, on_sent=None):
+    """
+    Push the "New Event" notification of a published event with a single
+    FCM topic send and record it for every user it reaches. Returns the
+    number of users recorded.
+
+    A topic send has no per-device outcome: the rows are recorded as sent
+    once FCM accepted the message, and nothing is recorded when it raised.
+    `on_sent()` is called between the send and the rows; passing `sent`
+    records the rows of an earlier send without sending it again.
+    """
+    event = Event.objects.get(pk=event_id)
+    title = f"New Event: {event.name}"
+    message = event.description[:100] + "..."
+
+    if not sent:
+        send_fcm_to_condition(topics.event_condition(event), title, message)
+        if on_sent is not None:
+            on_sent()
+
+    recorded = 0
+    batch = []
+    # All or nothing, so recording again after a failure duplicates nothing
+    with transaction.atomic():
+        for user_id in topics.recipients(event):
+            batch.append(
+                Notification(
+                    user_id=user_id,
+                    event=event,
+                    message=message,
+                    medium="push",
+                    status="sent",
+                )
+            )
+            if len(batch) == batch_size:
+                _record(batch)
+                recorded += len(batch)
+                batch = []
+        if batch:
+            _record(batch)
+            recorded += len(batch)
+
+    logger.info(f"Published event {event_id} to topics, {recorded} users recorded")
+    return recorded
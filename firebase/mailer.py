@@ -0,0 +1,237 @@
+"""
+Batched email dispatch.
+
+Every email used to go out through its own `send_mail` / `message.send()`
+call, paying an SMTP connect, TLS handshake and login per message.
+`EmailDispatcher` queues messages and sends them in batches of
+EMAIL_BATCH_SIZE with `send_messages` over one connection that stays open
+until the dispatcher is closed. A batch also goes out once its oldest
+message has waited EMAIL_FLUSH_INTERVAL seconds. There is no timer thread,
+as the connection belongs to the thread using it: the wait is checked when
+a message is queued and whenever the owner calls `flush_if_due`, which the
+outbox does after each message.
+
+`send_email` is what the notification code calls: inside a `batched()`
+block the message joins the thread's dispatcher, otherwise it is sent
+straight away. The outbox workers run inside `batched()`, so bulk refund,
+cancellation and confirmation emails share their connection. A queued
+email has not been sent yet: callers learn the outcome from the callback
+passed to `send_email`, or for every email sent within a `group()` block at
+once.
+
+Throughput is logged when a dispatcher closes and added up in `metrics()`.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_metrics_lock = threading.Lock()
+_metrics = {"sent": 0, "failed": 0, "batches": 0, "connections": 0, "seconds": 0.0}
+
+
+def metrics():
+    """Totals of every dispatcher closed in this process, with emails/second."""
+    with _metrics_lock:
+        totals = dict(_metrics)
+    totals["rate"] = totals["sent"] / totals["seconds"] if totals["seconds"] else 0.0
+    return totals
+
+
+class EmailDispatcher:
+    """
+    Queue EmailMessages and send them in batches over a persistent
+    connection. Use it as a context manager, or call `close()`.
+    """
+
+    def __init__(self, batch_size=None, flush_interval=None, connection=None):
+        self.batch_size = batch_size or settings.EMAIL_BATCH_SIZE
+        if flush_interval is None:
+            flush_interval = settings.EMAIL_FLUSH_INTERVAL
+        self.flush_interval = flush_interval
+        self.connection = connection
+        self._queue = []
+        self._oldest = None
+        self._opened = False
+        self.stats = {"sent": 0, "failed": 0, "batches": 0, "connections": 0}
+        self.seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, message, callback=None):
+        """
+        Queue `message`. `callback(sent)` is called with the outcome once
+        its batch went out.
+        """
+        if not self._queue:
+            self._oldest = time.monotonic()
+        self._queue.append((message, callback))
+        if len(self._queue) >= self.batch_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        """Flush when the oldest queued message waited `flush_interval`."""
+        if self._queue and time.monotonic() - self._oldest >= self.flush_interval:
+            self.flush()
+
+    def _open(self):
+        if self.connection is None:
+            self.connection = get_connection(fail_silently=False)
+        if not self._opened:
+            self.connection.open()
+            self._opened = True
+            self.stats["connections"] += 1
+
+    def _close_connection(self):
+        if self._opened:
+            try:
+                self.connection.close()
+            except Exception:
+                logger.warning("Closing the email connection failed", exc_info=True)
+            self._opened = False
+
+    def flush(self):
+        """Send the queued messages as one batch; returns how many went out."""
+        if not self._queue:
+            return 0
+        batch, self._queue = self._queue, []
+        messages = [message for message, _ in batch]
+
+        started = time.monotonic()
+        try:
+            self._open()
+            sent = self.connection.send_messages(messages) or 0
+            ok = True
+        except Exception as e:
+            # The batch is reported failed as a whole; the connection is
+            # reopened for the next one
+            logger.exception(f"Sending a batch of {len(messages)} emails failed: {e}")
+            self._close_connection()
+            sent, ok = 0, False
+        self.seconds += time.monotonic() - started
+
+        self.stats["batches"] += 1
+        self.stats["sent"] += sent
+        self.stats["failed"] += len(messages) - sent
+        for _, callback in batch:
+            if callback is not None:
+                callback(ok)
+        return sent
+
+    def close(self):
+        """Send what is still queued, close the connection and record metrics."""
+        try:
+            self.flush()
+        finally:
+            self._close_connection()
+
+        if not self.stats["batches"]:
+            return
+        with _metrics_lock:
+            for key, value in self.stats.items():
+                _metrics[key] += value
+            _metrics["seconds"] += self.seconds
+        rate = self.stats["sent"] / self.seconds if self.seconds else 0.0
+        logger.info(
+            f"Sent {self.stats['sent']} emails in {self.stats['batches']} batches "
+            f"over {self.stats['connections']} connections "
+            f"({self.stats['failed']} failed, {rate:.1f}/s)"
+        )
+
+
+class EmailGroup:
+    """
+    Outcome of the emails sent within a `group()` block, which is only
+    known once the batches holding them went out.
+    """
+
+    def __init__(self):
+        self.pending = 0
+        self.failed = 0
+        self._then = None
+
+    def track(self, callback=None):
+        """Return a callback counting one more email of the group."""
+        self.pending += 1
+
+        def done(sent):
+            self.pending -= 1
+            if not sent:
+                self.failed += 1
+            if callback is not None:
+                callback(sent)
+            self._settle()
+
+        return done
+
+    def then(self, func):
+        """
+        Call `func(ok)` once every email of the group went out or failed,
+        right away when none is still queued.
+        """
+        self._then = func
+        self._settle()
+
+    def _settle(self):
+        if self._then is not None and not self.pending:
+            func, self._then = self._then, None
+            func(not self.failed)
+
+
+@contextmanager
+def group():
+    """Track the emails `send_email` sends in this block as one EmailGroup."""
+    previous = getattr(_local, "group", None)
+    _local.group = EmailGroup()
+    try:
+        yield _local.group
+    finally:
+        _local.group = previous
+
+
+@contextmanager
+def batched(batch_size=None, flush_interval=None):
+    """Route the `send_email` calls of this thread through one dispatcher."""
+    if getattr(_local, "dispatcher", None) is not None:
+        # Nested blocks share the outer dispatcher
+        yield _local.dispatcher
+        return
+    with EmailDispatcher(batch_size, flush_interval) as dispatcher:
+        _local.dispatcher = dispatcher
+        try:
+            yield dispatcher
+        finally:
+            _local.dispatcher = None
+
+
+def send_email(message, callback=None):
+    """
+    Send `message` through the thread's dispatcher, or right away outside
+    `batched()`. Returns False when a message sent right away failed; a
+    queued message reports its outcome to `callback` when its batch goes
+    out.
+    """
+    emails = getattr(_local, "group", None)
+    if emails is not None:
+        callback = emails.track(callback)
+    dispatcher = getattr(_local, "dispatcher", None)
+    if dispatcher is not None:
+        dispatcher.add(message, callback)
+        return True
+
+    with EmailDispatcher(batch_size=1) as dispatcher:
+        dispatcher.add(message, callback)
+    return dispatcher.stats["failed"] == 0
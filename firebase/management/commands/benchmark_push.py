@@ -0,0 +1,146 @@
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+
+from Eventmain.models import Booking, Event, Organizer, Ticket
+from firebase import outbox, push
+from firebase.models import NotificationToken
+from user.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure notification throughput against the fake push backend: seed "
+        "users and tokens, publish an event and pay bookings, then report "
+        "messages per second, queries and wall time. Everything runs in one "
+        "transaction that is rolled back."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--tokens-per-user", type=int, default=2)
+        parser.add_argument("--bookings", type=int, default=100)
+        parser.add_argument(
+            "--mode", choices=["multicast", "targeted", "topic"], default="multicast"
+        )
+        parser.add_argument(
+            "--latency", type=float, default=0.05, help="Seconds per FCM call."
+        )
+        parser.add_argument("--failure-rate", type=float, default=0.01)
+        parser.add_argument("--invalid-rate", type=float, default=0.02)
+
+    def handle(self, *args, **options):
+        with override_settings(
+            PUSH_BACKEND="fake",
+            PUSH_PUBLISH_MODE=options["mode"],
+            PUSH_FAKE_LATENCY=options["latency"],
+            PUSH_FAKE_FAILURE_RATE=options["failure_rate"],
+            PUSH_FAKE_INVALID_RATE=options["invalid_rate"],
+            EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+            OUTBOX_DRAIN_ON_COMMIT=False,
+        ):
+            push.reset_backends()
+            try:
+                with transaction.atomic():
+                    event, bookings = self.seed(options)
+                    self.stdout.write(
+                        f"Seeded {options['users']} users, "
+                        f"{options['users'] * options['tokens_per_user']} tokens "
+                        f"and {len(bookings)} bookings"
+                    )
+                    self.run("publish", self.publish, event)
+                    self.run("bookings", self.pay, bookings)
+                    transaction.set_rollback(True)
+            finally:
+                push.reset_backends()
+
+    def seed(self, options):
+        password = make_password(None)
+        prefix = f"bench-{int(time.time())}"
+        users = User.objects.bulk_create(
+            [
+                User(
+                    username=f"{prefix}-{index}@example.com",
+                    email=f"{prefix}-{index}@example.com",
+                    password=password,
+                    phone_number="9800000000",
+                )
+                for index in range(options["users"])
+            ],
+            batch_size=500,
+        )
+        NotificationToken.objects.bulk_create(
+            [
+                NotificationToken(owner=user, token=f"{prefix}-{user.pk}-{index}")
+                for user in users
+                for index in range(options["tokens_per_user"])
+            ],
+            batch_size=500,
+        )
+        organizer = Organizer.objects.create(
+            user=users[0], organization_name="Benchmark"
+        )
+        event = Event.objects.create(
+            organizer=organizer,
+            name="Benchmark",
+            description="Benchmark event",
+            category="music",
+            location="Kathmandu",
+            start_date_time=timezone.now(),
+            end_date_time=timezone.now(),
+            capacity=options["bookings"] or 1,
+            price=500,
+        )
+        ticket = Ticket.objects.create(
+            event=event,
+            name="GA",
+            price=500,
+            quantity=options["bookings"] or 1,
+            ticket_type="GA",
+        )
+        bookings = Booking.objects.bulk_create(
+            [
+                Booking(
+                    user=users[index % len(users)],
+                    ticket=ticket,
+                    quantity=1,
+                    total_amount=500,
+                    status="pending",
+                    payment_method="khalti",
+                )
+                for index in range(options["bookings"])
+            ]
+        )
+        return event, bookings
+
+    def publish(self, event):
+        event.status = "published"
+        event.save()
+
+    def pay(self, bookings):
+        for booking in bookings:
+            booking.status = "paid"
+            booking.save()
+
+    def run(self, name, change, *args):
+        """Make the change, fire its signals and deliver the outbox."""
+        backend = push.get_backend()
+        backend.clear()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            change(*args)
+            delivered, failed = outbox.deliver_due()
+            elapsed = time.perf_counter() - start
+
+        sent = len(backend.sent)
+        self.stdout.write(
+            f"{name}: {sent} pushes in {elapsed:.2f}s "
+            f"({sent / elapsed:.0f} messages/s), {backend.calls} FCM calls, "
+            f"{backend.failures} failed, {len(backend.invalid_tokens)} invalid "
+            f"tokens, {len(queries)} queries, outbox {delivered} delivered / "
+            f"{failed} failed"
+        )
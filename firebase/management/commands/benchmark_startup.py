@@ -0,0 +1,72 @@
+import json
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+# Run in a fresh interpreter so nothing is imported yet
+SCRIPT = """
+import json, os, sys, time
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", {settings_module!r})
+start = time.perf_counter()
+import django
+django.setup()
+import firebase.utils
+setup = time.perf_counter() - start
+imported = "firebase_admin" in sys.modules
+if {eager!r}:
+    from firebase.push import get_backend
+    get_backend().messaging
+total = time.perf_counter() - start
+print(json.dumps({{
+    "setup": setup,
+    "total": total,
+    "firebase_admin": imported,
+}}))
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure process start-up time (django.setup() and importing the "
+        "notification code) in fresh interpreters."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument(
+            "--eager",
+            action="store_true",
+            help="Also initialize the push backend, as every process used to.",
+        )
+
+    def handle(self, *args, **options):
+        script = SCRIPT.format(
+            settings_module=settings.SETTINGS_MODULE, eager=options["eager"]
+        )
+        runs = []
+        for _ in range(options["repeat"]):
+            output = subprocess.run(
+                [sys.executable, "-c", script],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+
+        setup = [run["setup"] for run in runs]
+        total = [run["total"] for run in runs]
+        self.stdout.write(
+            f"django.setup(): median {statistics.median(setup):.3f}s, "
+            f"min {min(setup):.3f}s over {len(runs)} runs"
+        )
+        if options["eager"]:
+            self.stdout.write(
+                f"with push backend initialized: median "
+                f"{statistics.median(total):.3f}s"
+            )
+        self.stdout.write(
+            f"firebase_admin imported at start-up: {runs[-1]['firebase_admin']}"
+        )
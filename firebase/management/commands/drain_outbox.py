@@ -0,0 +1,47 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from firebase.outbox import drain
+
+
+class Command(BaseCommand):
+    help = "Deliver pending notification outbox messages."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.OUTBOX_WORKERS,
+            help="Number of concurrent delivery workers.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=50,
+            help="Number of messages a worker claims at a time.",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep draining instead of exiting once the outbox is empty.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=1.0,
+            help="Seconds to wait between drains with --loop.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            delivered, failed = drain(
+                workers=options["workers"], batch_size=options["batch_size"]
+            )
+            if not options["loop"]:
+                break
+            time.sleep(options["interval"])
+        self.stdout.write(
+            self.style.SUCCESS(f"Delivered {delivered} messages, {failed} failed.")
+        )
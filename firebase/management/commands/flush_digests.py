@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from firebase.digest import flush_digests
+
+
+class Command(BaseCommand):
+    help = "Send the pending notification digests of users in digest mode."
+
+    def handle(self, *args, **options):
+        count = flush_digests()
+        self.stdout.write(self.style.SUCCESS(f"Sent {count} digests."))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from firebase.throttle import flush_coalesced
+
+
+class Command(BaseCommand):
+    help = "Send the notifications coalesced by the per-user rate limit."
+
+    def handle(self, *args, **options):
+        count = flush_coalesced()
+        self.stdout.write(self.style.SUCCESS(f"Flushed {count} notifications."))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from firebase.audience import materialize_interests
+
+
+class Command(BaseCommand):
+    help = "Rebuild the user category interests used to target publish notifications."
+
+    def handle(self, *args, **options):
+        count = materialize_interests()
+        self.stdout.write(self.style.SUCCESS(f"Materialized {count} interests."))
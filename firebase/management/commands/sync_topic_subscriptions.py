@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from firebase.topics import sync_all_tokens
+
+
+class Command(BaseCommand):
+    help = "Subscribe every notification token to its owner's FCM topics."
+
+    def handle(self, *args, **options):
+        count = sync_all_tokens()
+        self.stdout.write(self.style.SUCCESS(f"Synced {count} tokens."))
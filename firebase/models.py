@@ -1,10 +1,11 @@
 from django.db import models
-from  Eventmain.models import Notification
+from  Eventmain.models import Event, Notification
 # Create your models here.
 from django.db import models
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 User = get_user_model()
 
 class FCMTokens(models.Model):
@@ -18,4 +19,98 @@ class NotificationToken(models.Model):
    token = models.CharField(max_length=255, unique=True)
    
    def __str__(self):
-      return self.token
\ No newline at end of file
+      return self.token
+
+class CategorySubscription(models.Model):
+   """Event category a user wants push notifications about."""
+
+   user = models.ForeignKey(
+      User, on_delete=models.CASCADE, related_name="category_subscriptions"
+   )
+   category = models.CharField(max_length=50, choices=Event.CATEGORY_CHOICES)
+   created_at = models.DateTimeField(auto_now_add=True)
+
+   class Meta:
+      constraints = [
+         models.UniqueConstraint(
+            fields=["user", "category"], name="unique_category_subscription"
+         ),
+      ]
+
+   def __str__(self):
+      return f"{self.user} -> {self.category}"
+
+class UserCategoryInterest(models.Model):
+   """
+   Materialized interest of a user in an event category, derived from
+   bookings, reviews, event views and followed categories by
+   `firebase.audience.materialize_interests`.
+   """
+
+   user = models.ForeignKey(
+      User, on_delete=models.CASCADE, related_name="category_interests"
+   )
+   category = models.CharField(max_length=50, choices=Event.CATEGORY_CHOICES)
+   score = models.PositiveIntegerField(default=0)
+   updated_at = models.DateTimeField()
+
+   class Meta:
+      constraints = [
+         models.UniqueConstraint(
+            fields=["user", "category"], name="unique_category_interest"
+         ),
+      ]
+      indexes = [
+         # The audience of an event is one range scan of its category
+         models.Index(fields=["category", "user"], name="interest_category_idx"),
+      ]
+
+   def __str__(self):
+      return f"{self.user} ~ {self.category} ({self.score})"
+
+class OutboxMessage(models.Model):
+   """
+   Notification side effect recorded in the same transaction as the change
+   that caused it, and delivered after commit by `firebase.outbox`.
+   """
+
+   STATUS_CHOICES = [
+      ("pending", "Pending"),
+      ("sent", "Sent"),
+      ("dead", "Dead"),
+   ]
+
+   kind = models.CharField(max_length=50)
+   payload = models.JSONField(default=dict)
+   status = models.CharField(max_length=10, choices=STATUS_CHOICES, default="pending")
+   attempts = models.PositiveIntegerField(default=0)
+   # Not picked up before this time: retry backoff, or the lease of the
+   # worker currently delivering it
+   available_at = models.DateTimeField(default=timezone.now)
+   last_error = models.TextField(blank=True, default="")
+   created_at = models.DateTimeField(auto_now_add=True)
+   sent_at = models.DateTimeField(null=True, blank=True)
+
+   class Meta:
+      indexes = [
+         models.Index(fields=["status", "available_at"], name="outbox_due_idx"),
+      ]
+
+   def __str__(self):
+      return f"{self.kind} #{self.pk} ({self.status})"
+
+class NotificationBucket(models.Model):
+   """
+   Token bucket of a user's notification rate limit, kept in the database
+   so every process shares it (see `firebase.throttle.allow`).
+   """
+
+   user = models.OneToOneField(
+      User, on_delete=models.CASCADE, primary_key=True, related_name="notification_bucket"
+   )
+   tokens = models.FloatField()
+   # time.time() of the last update
+   updated_at = models.FloatField()
+
+   def __str__(self):
+      return f"{self.user}: {self.tokens:.1f} tokens"
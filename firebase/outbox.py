@@ -0,0 +1,262 @@
+"""
+Transactional outbox for notifications.
+
+Signal receivers do not talk to SMTP, FCM or the SMS gateway any more. They
+`enqueue` an OutboxMessage, which is written in the same transaction as the
+booking or event change, so a rolled back change sends nothing and a
+committed one cannot lose its notifications.
+
+`drain` delivers due messages with a pool of workers. A worker claims a
+batch by pushing its `available_at` OUTBOX_LEASE_SECONDS into the future,
+so a worker that crashes mid-batch only delays those messages until the
+lease runs out. Failed deliveries are retried with exponential backoff and
+dead-lettered after OUTBOX_MAX_ATTEMPTS. Delivery is at least once: only a
+crash between delivering a message and marking it sent repeats it.
+
+A handler fails by raising, so it must not swallow transport errors.
+Handlers doing their work in steps can `checkpoint` their progress, so a
+retry picks up where the failed attempt stopped. Each checkpoint also
+renews the worker's lease, so long handlers are not claimed again while
+they run; a worker that lost its lease anyway stops at its next
+checkpoint and leaves the message to the worker that took it over.
+
+After every commit that enqueued messages, a drain is started on the
+background pool when OUTBOX_DRAIN_ON_COMMIT is on. The `drain_outbox`
+command and the periodic task catch up on anything left behind.
+
+Each worker sends the emails of its run through one `mailer.batched()`
+dispatcher, so they share SMTP connections instead of opening one apiece. A
+message whose handler queued emails is marked sent, or failed, only once
+their batch went out.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from Eventmain import background
+from firebase import mailer
+from firebase.models import OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+_handlers = {}
+# Message being delivered on this thread, for `checkpoint`
+_local = threading.local()
+
+# A single on-commit drain runs at a time; commits arriving meanwhile make
+# it go round once more instead of starting another one.
+_drain_lock = threading.Lock()
+_drain_running = False
+_drain_requested = False
+
+
+class LeaseLost(Exception):
+    """Raised by `checkpoint` when another worker took the message over."""
+
+
+def handler(kind):
+    """Register the function delivering the payload of `kind` messages."""
+
+    def register(func):
+        _handlers[kind] = func
+        return func
+
+    return register
+
+
+def _request_drain():
+    global _drain_running, _drain_requested
+    with _drain_lock:
+        _drain_requested = True
+        if _drain_running:
+            return
+        _drain_running = True
+    background.submit(_drain_while_requested)
+
+
+def _drain_while_requested():
+    global _drain_running, _drain_requested
+    try:
+        while True:
+            with _drain_lock:
+                if not _drain_requested:
+                    return
+                _drain_requested = False
+            drain()
+    finally:
+        with _drain_lock:
+            _drain_running = False
+
+
+def _drain_after_commit():
+    if settings.OUTBOX_DRAIN_ON_COMMIT:
+        transaction.on_commit(_request_drain)
+
+
+def enqueue(kind, payload):
+    """Record one message in the current transaction."""
+    message = OutboxMessage.objects.create(kind=kind, payload=payload)
+    _drain_after_commit()
+    return message
+
+
+def enqueue_many(kind, payloads):
+    """Record one message per payload with a single INSERT."""
+    messages = OutboxMessage.objects.bulk_create(
+        [OutboxMessage(kind=kind, payload=payload) for payload in payloads],
+        batch_size=500,
+    )
+    if messages:
+        _drain_after_commit()
+    return messages
+
+
+def claim(batch_size):
+    """Lease up to `batch_size` due messages to the calling worker."""
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            OutboxMessage.objects.select_for_update(skip_locked=True)
+            .filter(status="pending", available_at__lte=now)
+            .order_by("available_at", "id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        if not ids:
+            return []
+        OutboxMessage.objects.filter(id__in=ids).update(
+            attempts=F("attempts") + 1,
+            available_at=now + timedelta(seconds=settings.OUTBOX_LEASE_SECONDS),
+        )
+    return list(OutboxMessage.objects.filter(id__in=ids).order_by("id"))
+
+
+def current():
+    """The message being delivered by the calling thread, or None."""
+    return getattr(_local, "message", None)
+
+
+def checkpoint(**progress):
+    """
+    Save `progress` into the payload of the message being delivered, so
+    that a retry of a handler that failed halfway resumes from it instead
+    of repeating the work already done, and renew the lease on it. Raises
+    LeaseLost when the lease ran out and another worker claimed the message.
+    """
+    message = _local.message
+    message.payload.update(progress)
+    # Every claim counts an attempt, so a changed count means another claim
+    renewed = OutboxMessage.objects.filter(
+        pk=message.pk, status="pending", attempts=message.attempts
+    ).update(
+        payload=message.payload,
+        available_at=timezone.now() + timedelta(seconds=settings.OUTBOX_LEASE_SECONDS),
+    )
+    if not renewed:
+        raise LeaseLost(f"Outbox message {message.pk} was claimed by another worker")
+
+
+def _record_outcome(message, error=None):
+    if error is None:
+        OutboxMessage.objects.filter(pk=message.pk).update(
+            status="sent", sent_at=timezone.now()
+        )
+        return True
+    if message.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+        logger.error(
+            f"Outbox message {message.pk} dead-lettered: {error}", exc_info=error
+        )
+        fields = {"status": "dead"}
+    else:
+        delay = settings.OUTBOX_RETRY_BACKOFF * 2 ** (message.attempts - 1)
+        logger.warning(f"Outbox message {message.pk} failed, retrying: {error}")
+        fields = {"available_at": timezone.now() + timedelta(seconds=delay)}
+    OutboxMessage.objects.filter(pk=message.pk).update(last_error=str(error), **fields)
+    return False
+
+
+def deliver(message, done=None):
+    """
+    Run the handler of one claimed message and record the outcome, then
+    call `done(ok)` with it.
+
+    A message is only sent once the emails its handler queued went out, so
+    inside `mailer.batched()` its outcome is recorded when their batch is
+    flushed. Until then it stays leased: a worker dying in between leaves it
+    to be delivered again.
+    """
+    done = done or (lambda ok: None)
+    _local.message = message
+    try:
+        with mailer.group() as emails:
+            _handlers[message.kind](message.payload)
+    except LeaseLost as e:
+        # The outcome is up to the worker holding the message now
+        logger.warning(str(e))
+        done(False)
+        return
+    except Exception as e:
+        done(_record_outcome(message, e))
+        return
+    finally:
+        _local.message = None
+
+    emails.then(
+        lambda sent: done(
+            _record_outcome(
+                message, None if sent else RuntimeError("Sending its emails failed")
+            )
+        )
+    )
+
+
+def deliver_due(batch_size=50):
+    """
+    Deliver due messages on the calling thread until none are left.
+    Returns `(delivered, failed)` counts.
+    """
+    outcomes = []
+    # Emails of the whole run share batches and one SMTP connection
+    with mailer.batched() as dispatcher:
+        while True:
+            messages = claim(batch_size)
+            if not messages:
+                break
+            for message in messages:
+                deliver(message, outcomes.append)
+                dispatcher.flush_if_due()
+    # Closing the dispatcher flushed the last emails and settled every message
+    return outcomes.count(True), outcomes.count(False)
+
+
+def _work(batch_size):
+    try:
+        return deliver_due(batch_size)
+    finally:
+        close_old_connections()
+
+
+def drain(workers=None, batch_size=50):
+    """
+    Deliver every due message with `workers` concurrent workers (defaults to
+    settings.OUTBOX_WORKERS). Returns `(delivered, failed)` counts.
+    """
+    workers = workers or settings.OUTBOX_WORKERS
+    if workers == 1:
+        results = [_work(batch_size)]
+    else:
+        with ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="outbox"
+        ) as pool:
+            results = list(pool.map(_work, [batch_size] * workers))
+    delivered = sum(result[0] for result in results)
+    failed = sum(result[1] for result in results)
+    if delivered or failed:
+        logger.info(f"Outbox drained: {delivered} delivered, {failed} failed")
+    return delivered, failed
@@ -0,0 +1,306 @@
+"""
+Push notification backends.
+
+The notification code sends through `get_backend()`, chosen by
+settings.PUSH_BACKEND:
+
+- "fcm": Firebase Cloud Messaging. firebase_admin is imported and the app
+  initialized from FIREBASE_CREDENTIAL_PATH on the first send, under a lock,
+  so processes that never push (migrations, most management commands) do
+  not pay for it and can start without credentials.
+- "memory": keeps every message in memory; tokens in `invalid_tokens` are
+  reported unregistered. For tests and local development.
+- "log": only logs what would have been sent.
+- "fake": emulates FCM for load tests (see `FakeFCMBackend`), without
+  sending anything.
+
+Every backend answers multicasts with a `BatchResult` whose `responses`
+follow the order of the tokens, like FCM's BatchResponse.
+"""
+
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class UnregisteredToken(Exception):
+    """Per-token error of the non-FCM backends for tokens that are gone."""
+
+
+class PushUnavailable(Exception):
+    """Transient per-token error of the fake backend; the token stays valid."""
+
+
+@dataclass
+class SendResult:
+    success: bool
+    exception: Exception = None
+    message_id: str = None
+
+
+@dataclass
+class BatchResult:
+    responses: list = field(default_factory=list)
+
+    @property
+    def success_count(self):
+        return sum(response.success for response in self.responses)
+
+    @property
+    def failure_count(self):
+        return len(self.responses) - self.success_count
+
+
+@dataclass
+class TopicResult:
+    success_count: int = 0
+    failure_count: int = 0
+
+
+class FCMBackend:
+    def __init__(self, credential_path=None):
+        self.credential_path = credential_path or settings.FIREBASE_CREDENTIAL_PATH
+        self._lock = threading.Lock()
+        self._messaging = None
+
+    @property
+    def messaging(self):
+        """firebase_admin.messaging, initializing the app on first use."""
+        if self._messaging is None:
+            with self._lock:
+                if self._messaging is None:
+                    import firebase_admin
+                    from firebase_admin import credentials, messaging
+
+                    if not firebase_admin._apps:
+                        firebase_admin.initialize_app(
+                            credentials.Certificate(self.credential_path)
+                        )
+                        logger.info("Initialized Firebase Admin")
+                    self._messaging = messaging
+        return self._messaging
+
+    def _notification(self, title, body):
+        return self.messaging.Notification(title=title, body=body)
+
+    def send(self, token, title, body):
+        message = self.messaging.Message(
+            notification=self._notification(title, body), token=token
+        )
+        return self.messaging.send(message)
+
+    def send_multicast(self, tokens, title, body):
+        message = self.messaging.MulticastMessage(
+            notification=self._notification(title, body), tokens=tokens
+        )
+        return self.messaging.send_each_for_multicast(message)
+
+    def send_to_condition(self, condition, title, body):
+        message = self.messaging.Message(
+            notification=self._notification(title, body), condition=condition
+        )
+        return self.messaging.send(message)
+
+    def subscribe(self, tokens, topic):
+        return self.messaging.subscribe_to_topic(tokens, topic)
+
+    def unsubscribe(self, tokens, topic):
+        return self.messaging.unsubscribe_from_topic(tokens, topic)
+
+    def is_invalid_token(self, exception):
+        """True for per-token errors meaning the token will never work again."""
+        if isinstance(exception, UnregisteredToken):
+            return True
+        # Only errors raised by firebase_admin need it imported
+        if not type(exception).__module__.startswith("firebase_admin"):
+            return False
+        from firebase_admin import exceptions, messaging
+
+        if isinstance(
+            exception, (messaging.UnregisteredError, messaging.SenderIdMismatchError)
+        ):
+            return True
+        # INVALID_ARGUMENT is also raised for malformed or oversized messages,
+        # which would otherwise prune every token of the batch
+        return isinstance(
+            exception, exceptions.InvalidArgumentError
+        ) and "registration token" in str(exception)
+
+
+class MemoryBackend:
+    """Keeps sent messages in `sent`; tokens in `invalid_tokens` fail."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sent = []
+        self.topics = {}
+        self.invalid_tokens = set()
+
+    def _deliver(self, token, title, body):
+        if token in self.invalid_tokens:
+            return SendResult(False, UnregisteredToken(f"{token} is not registered"))
+        with self._lock:
+            self.sent.append((token, title, body))
+            message_id = f"memory-{len(self.sent)}"
+        return SendResult(True, message_id=message_id)
+
+    def send(self, token, title, body):
+        result = self._deliver(token, title, body)
+        if not result.success:
+            raise result.exception
+        return result.message_id
+
+    def send_multicast(self, tokens, title, body):
+        return BatchResult([self._deliver(token, title, body) for token in tokens])
+
+    def send_to_condition(self, condition, title, body):
+        return self._deliver(condition, title, body).message_id
+
+    def subscribe(self, tokens, topic):
+        with self._lock:
+            self.topics.setdefault(topic, set()).update(tokens)
+        return TopicResult(success_count=len(tokens))
+
+    def unsubscribe(self, tokens, topic):
+        with self._lock:
+            self.topics.setdefault(topic, set()).difference_update(tokens)
+        return TopicResult(success_count=len(tokens))
+
+    def is_invalid_token(self, exception):
+        return isinstance(exception, UnregisteredToken)
+
+    def clear(self):
+        with self._lock:
+            self.sent.clear()
+            self.topics.clear()
+            self.invalid_tokens.clear()
+
+
+class LogBackend(MemoryBackend):
+    """Logs every push instead of sending it, and keeps nothing."""
+
+    def _deliver(self, token, title, body):
+        logger.info(f"Push to {token}: {title} - {body}")
+        return SendResult(True, message_id="logged")
+
+    def subscribe(self, tokens, topic):
+        logger.info(f"Subscribe {len(tokens)} tokens to {topic}")
+        return TopicResult(success_count=len(tokens))
+
+    def unsubscribe(self, tokens, topic):
+        logger.info(f"Unsubscribe {len(tokens)} tokens from {topic}")
+        return TopicResult(success_count=len(tokens))
+
+
+class FakeFCMBackend(MemoryBackend):
+    """
+    Emulates FCM for load tests. Every call takes `latency` seconds (plus up
+    to 20% jitter) however many tokens it carries, like one FCM HTTP
+    request; a `failure_rate` fraction of messages fails with
+    PushUnavailable and an `invalid_rate` fraction of the tokens seen is
+    reported unregistered from then on. Defaults come from the
+    PUSH_FAKE_* settings. FCM's limits of 500 tokens per multicast and 1000
+    per topic call are enforced.
+    """
+
+    def __init__(self, latency=None, failure_rate=None, invalid_rate=None, seed=None):
+        super().__init__()
+        self.latency = settings.PUSH_FAKE_LATENCY if latency is None else latency
+        self.failure_rate = (
+            settings.PUSH_FAKE_FAILURE_RATE if failure_rate is None else failure_rate
+        )
+        self.invalid_rate = (
+            settings.PUSH_FAKE_INVALID_RATE if invalid_rate is None else invalid_rate
+        )
+        self._random = random.Random(seed)
+        self._seen = set()
+        self.calls = 0
+        self.failures = 0
+
+    def _call(self):
+        with self._lock:
+            self.calls += 1
+            delay = self.latency * (1 + 0.2 * self._random.random())
+        time.sleep(delay)
+
+    def _deliver(self, token, title, body):
+        with self._lock:
+            if token not in self._seen:
+                self._seen.add(token)
+                if self._random.random() < self.invalid_rate:
+                    self.invalid_tokens.add(token)
+            failed = self._random.random() < self.failure_rate
+            if failed:
+                self.failures += 1
+        if failed:
+            return SendResult(False, PushUnavailable("Service unavailable"))
+        return super()._deliver(token, title, body)
+
+    def send(self, token, title, body):
+        self._call()
+        return super().send(token, title, body)
+
+    def send_multicast(self, tokens, title, body):
+        if len(tokens) > 500:
+            raise ValueError("tokens must not contain more than 500 tokens")
+        self._call()
+        return super().send_multicast(tokens, title, body)
+
+    def send_to_condition(self, condition, title, body):
+        self._call()
+        # Fails like a single send instead of returning no message id
+        return super().send(condition, title, body)
+
+    def subscribe(self, tokens, topic):
+        if len(tokens) > 1000:
+            raise ValueError("tokens must not contain more than 1000 tokens")
+        self._call()
+        return super().subscribe(tokens, topic)
+
+    def unsubscribe(self, tokens, topic):
+        if len(tokens) > 1000:
+            raise ValueError("tokens must not contain more than 1000 tokens")
+        self._call()
+        return super().unsubscribe(tokens, topic)
+
+    def clear(self):
+        super().clear()
+        with self._lock:
+            self._seen.clear()
+            self.calls = 0
+            self.failures = 0
+
+
+BACKENDS = {
+    "fcm": FCMBackend,
+    "memory": MemoryBackend,
+    "log": LogBackend,
+    "fake": FakeFCMBackend,
+}
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend():
+    """Return the process-wide backend named by settings.PUSH_BACKEND."""
+    name = settings.PUSH_BACKEND
+    backend = _backends.get(name)
+    if backend is None:
+        with _backends_lock:
+            backend = _backends.get(name)
+            if backend is None:
+                backend = _backends[name] = BACKENDS[name]()
+    return backend
+
+
+def reset_backends():
+    """Drop the shared backends so the next call rebuilds them from settings."""
+    with _backends_lock:
+        _backends.clear()
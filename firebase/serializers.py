@@ -4,4 +4,16 @@ from .models import *
 class NotificationTokenSerializer(serializers.ModelSerializer):
    class Meta:
       model = NotificationToken
-      fields = '__all__'
\ No newline at end of file
+      fields = '__all__'
+
+class CategorySubscriptionSerializer(serializers.ModelSerializer):
+   class Meta:
+      model = CategorySubscription
+      fields = ['id', 'category', 'created_at']
+      read_only_fields = ['created_at']
+
+   def validate_category(self, value):
+      user = self.context['request'].user
+      if CategorySubscription.objects.filter(user=user, category=value).exists():
+         raise serializers.ValidationError("You already follow this category.")
+      return value
@@ -1,23 +1,25 @@
-from django.db.models.signals import pre_save, post_save
+from django.conf import settings
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 from Eventmain.models import Event, Booking  # Add Booking import
-from firebase.models import NotificationToken
-from firebase.utils import create_and_send_notification, send_booking_confirmation_email
+from Eventmain.signals import bookings_status_changed
+from firebase import fanout, outbox, topics
+from firebase.models import CategorySubscription, NotificationToken
+from firebase.utils import (
+    booking_confirmation_email,
+    create_and_send_notification,
+    is_pruning,
+)
 
 
 @receiver(pre_save, sender=Event)
 def store_old_status(sender, instance, **kwargs):
     """
     Store the old status of the event before saving.
-    This is used to determine if the status has changed.
+    This is used to determine if the status has changed. The status is the
+    one the event was loaded with, so no extra query is needed.
     """
-    if instance.pk:
-        try:
-            instance._old_status = sender.objects.get(pk=instance.pk).status
-        except sender.DoesNotExist:
-            instance._old_status = None
-    else:
-        instance._old_status = None
+    instance._old_status = instance.previous_status(kwargs.get("update_fields"))
 
 
 @receiver(post_save, sender=Event)
@@ -25,9 +27,10 @@ def notify_users_on_publish(sender, instance, created, **kwargs):
     """
     Send notifications to all users when an event is published.
 
-    When an event status changes to 'published', this signal:
-    1. Creates a notification record for each user with a token
-    2. Sends a push notification to those users
+    When an event status changes to 'published', this signal records an
+    outbox message; its delivery runs `firebase.fanout.publish_event`, which
+    creates a notification record for each user with a token and sends the
+    push notifications in FCM multicast batches, outside the request.
 
     Args:
         sender: The model class (Event)
@@ -35,32 +38,80 @@ def notify_users_on_publish(sender, instance, created, **kwargs):
         created: Boolean indicating if this is a new instance
         **kwargs: Additional arguments
     """
-    # On creation and status is published
-    if created and instance.status == "published":
-        tokens = NotificationToken.objects.all()
-        for token_obj in tokens:
-            if token_obj.owner:
-                create_and_send_notification(
-                    user=token_obj.owner,
-                    event=instance,
-                    message=instance.description[:100] + "...",
-                    medium="push",
-                    title=f"New Event: {instance.name}",
-                )
-    # On update and status changed to published
-    elif not created:
+    if created:
+        old_status = None
+    else:
         old_status = getattr(instance, "_old_status", None)
-        if old_status != "published" and instance.status == "published":
-            tokens = NotificationToken.objects.all()
-            for token_obj in tokens:
-                if token_obj.owner:
-                    create_and_send_notification(
-                        user=token_obj.owner,
-                        event=instance,
-                        message=instance.description[:100] + "...",
-                        medium="push",
-                        title=f"New Event: {instance.name}",
-                    )
+
+    # On creation or update, when the status changed to published
+    if old_status != "published" and instance.status == "published":
+        outbox.enqueue("event_published", {"event_id": instance.id})
+
+
+@outbox.handler("event_published")
+def deliver_event_published(payload):
+    if settings.PUSH_PUBLISH_MODE == "topic":
+        fanout.publish_event_to_topics(
+            payload["event_id"],
+            sent=payload.get("topic_sent", False),
+            on_sent=lambda: outbox.checkpoint(topic_sent=True),
+        )
+    else:
+        # A retry resumes after the last batch that went out
+        fanout.publish_event(
+            payload["event_id"],
+            targeted=settings.PUSH_PUBLISH_MODE == "targeted",
+            after_owner=payload.get("after_owner"),
+            progress=lambda owner_id: outbox.checkpoint(after_owner=owner_id),
+        )
+
+
+# ===== TOPIC SUBSCRIPTION SIGNALS =====
+
+
+@receiver(pre_save, sender=NotificationToken)
+def store_old_token(sender, instance, **kwargs):
+    """Remember the owner and value a token had before this save."""
+    instance._old_token = (
+        None
+        if instance._state.adding
+        else NotificationToken.objects.filter(pk=instance.pk)
+        .values_list("owner_id", "token")
+        .first()
+    )
+
+
+@receiver(post_save, sender=NotificationToken)
+def subscribe_new_token(sender, instance, created, **kwargs):
+    """
+    Subscribe newly registered tokens to their owner's FCM topics, and move
+    tokens that changed owner (or value) to the topics of the new owner.
+    """
+    if created:
+        topics.queue_token_registration(instance)
+        return
+    old = getattr(instance, "_old_token", None)
+    if old is not None and old != (instance.owner_id, instance.token):
+        topics.queue_token_removal(old[1], old[0])
+        topics.queue_token_registration(instance)
+
+
+@receiver(post_delete, sender=NotificationToken)
+def unsubscribe_deleted_token(sender, instance, **kwargs):
+    """Stop pushing the topics of its former owner to a deleted token."""
+    if not is_pruning():
+        topics.queue_token_removal(instance.token, instance.owner_id)
+
+
+@receiver(post_save, sender=CategorySubscription)
+def subscribe_to_category(sender, instance, created, **kwargs):
+    if created:
+        topics.queue_category_change(instance.user_id, instance.category, True)
+
+
+@receiver(post_delete, sender=CategorySubscription)
+def unsubscribe_from_category(sender, instance, **kwargs):
+    topics.queue_category_change(instance.user_id, instance.category, False)
 
 
 # ===== BOOKING NOTIFICATION SIGNALS =====
@@ -70,109 +121,162 @@ def notify_users_on_publish(sender, instance, created, **kwargs):
 def store_old_booking_status(sender, instance, **kwargs):
     """
     Store the old status of the booking before saving.
-    This is used to determine if the booking status has changed.
+    This is used to determine if the booking status has changed. The status
+    is the one the booking was loaded with, so no extra query is needed.
     """
-    if instance.pk:
-        try:
-            instance._old_booking_status = sender.objects.get(pk=instance.pk).status
-        except sender.DoesNotExist:
-            instance._old_booking_status = None
-    else:
-        instance._old_booking_status = None
+    instance._old_booking_status = instance.previous_status(kwargs.get("update_fields"))
 
 
 @receiver(post_save, sender=Booking)
 def notify_user_on_booking_change(sender, instance, created, **kwargs):
     """
-    Send notifications to the user when a booking is created or status changes.
+    Queue notifications to the user when a booking's status changes.
 
-    Sends notifications for:
+    The notifications are recorded in the outbox and sent after commit for:
     - Booking confirmation (when status becomes 'paid')
     - Booking cancellation (when status becomes 'cancelled')
     - Booking refund (when status becomes 'refunded')
     """
-    user = instance.user
-    event = instance.ticket.event
-
-    # Booking Confirmation (when payment is verified)
     if not created:  # Only on updates
         old_status = getattr(instance, "_old_booking_status", None)
+        if is_notified_change(old_status, instance.status):
+            outbox.enqueue("booking_status", booking_change(instance, old_status))
 
-        if old_status != "paid" and instance.status == "paid":
-            # Payment just got verified - send confirmation
-            message = f"Your booking for {event.name} is confirmed! Quantity: {instance.quantity}, Total: Rs. {instance.total_amount}. Your QR code ticket has been generated."
 
-            # Send Email (required by requirements)
-            # Send the email with QR code
-            try:
-                send_booking_confirmation_email(instance)
-            except Exception as e:
-                print(f"❌ Failed to send booking confirmation email: {e}")
+@receiver(bookings_status_changed)
+def notify_users_on_bulk_booking_change(sender, changes, **kwargs):
+    """
+    Queue the same notifications for bookings whose status was changed by a
+    bulk update (payment reconciliation, refunds) rather than save().
+    """
+    outbox.enqueue_many(
+        "booking_status",
+        [
+            booking_change(booking, old_status)
+            for booking, old_status in changes
+            if is_notified_change(old_status, booking.status)
+        ],
+    )
 
-            # Send Push notification
-            create_and_send_notification(
-                user=user,
-                event=event,
-                message=f"Booking confirmed for {event.name}!",
-                medium="push",
-                title="Booking Confirmed",
-            )
 
-            # Send SMS (required by requirements)
-            create_and_send_notification(
-                user=user, event=event, message=message, medium="sms"
-            )
+NOTIFIED_BOOKING_STATUSES = ("paid", "cancelled", "refunded")
 
-        # Booking Cancellation
-        elif old_status != "cancelled" and instance.status == "cancelled":
-            message = f"Your booking for {event.name} has been cancelled."
 
-            # Send Email
-            create_and_send_notification(
-                user=user,
-                event=event,
-                message=message,
-                medium="email",
-                title=f"Booking Cancelled - {event.name}",
-            )
+def is_notified_change(old_status, new_status):
+    return old_status != new_status and new_status in NOTIFIED_BOOKING_STATUSES
 
-            # Send Push
-            create_and_send_notification(
-                user=user,
-                event=event,
-                message=message,
-                medium="push",
-                title="Booking Cancelled",
-            )
 
-            # Send SMS
-            create_and_send_notification(
-                user=user, event=event, message=message, medium="sms"
-            )
+def booking_change(booking, old_status):
+    return {
+        "booking_id": booking.pk,
+        "old_status": old_status,
+        "status": booking.status,
+    }
 
-        # Booking Refund
-        elif old_status != "refunded" and instance.status == "refunded":
-            message = f"Your booking for {event.name} has been refunded. Amount: Rs. {instance.total_amount}."
 
-            # Send Email
-            create_and_send_notification(
-                user=user,
-                event=event,
-                message=message,
-                medium="email",
-                title=f"Booking Refunded - {event.name}",
-            )
+@outbox.handler("booking_status")
+def deliver_booking_status(payload):
+    booking = (
+        Booking.objects.select_related("user", "ticket__event")
+        .filter(pk=payload["booking_id"])
+        .first()
+    )
+    if booking is None:
+        return
+    # Notify about the change that was recorded, not the current status
+    booking.status = payload["status"]
+    notify_booking_status(booking, payload["old_status"], outbox.current().pk)
+
+
+def notify_booking_status(instance, old_status, transition=None):
+    """
+    Notify the booking's user about a status change from `old_status`.
+
+    Every channel is tried even when one fails; the first failure is raised
+    afterwards so that the outbox retries the message. The retry only sends
+    the channels that failed: the others are skipped through their dedup key.
+    That key names the `transition` (the outbox message recording it) when
+    given, so retries are deduplicated however late they come; otherwise it
+    falls back to the dedup window.
+    """
+    user = instance.user
+    event = instance.ticket.event
+    # Repeated saves or retries of the same transition are sent only once
+    kind = f"booking-{instance.status}-{instance.pk}"
+    if transition is not None:
+        kind = f"{kind}-{transition}"
+    failures = []
 
-            # Send Push
+    def notify(**kwargs):
+        try:
             create_and_send_notification(
                 user=user,
                 event=event,
-                message=message,
-                medium="push",
-                title="Booking Refunded",
+                kind=kind,
+                windowed=transition is None,
+                transactional=True,
+                raise_errors=True,
+                **kwargs,
             )
+        except Exception as e:
+            failures.append(e)
 
-            # Send SMS
-            create_and_send_notification(
-                user=user, event=event, message=message, medium="sms"
-            )
+    # Booking Confirmation (when payment is verified)
+    if old_status != "paid" and instance.status == "paid":
+        # Payment just got verified - send confirmation
+        message = f"Your booking for {event.name} is confirmed! Quantity: {instance.quantity}, Total: Rs. {instance.total_amount}. Your QR code ticket has been generated."
+
+        # Send Email (required by requirements)
+        # Send the email with QR code
+        notify(
+            message=message,
+            medium="email",
+            email=lambda: booking_confirmation_email(instance),
+        )
+
+        # Send Push notification
+        notify(
+            message=f"Booking confirmed for {event.name}!",
+            medium="push",
+            title="Booking Confirmed",
+        )
+
+        # Send SMS (required by requirements)
+        notify(message=message, medium="sms")
+
+    # Booking Cancellation
+    elif old_status != "cancelled" and instance.status == "cancelled":
+        message = f"Your booking for {event.name} has been cancelled."
+
+        # Send Email
+        notify(
+            message=message,
+            medium="email",
+            title=f"Booking Cancelled - {event.name}",
+        )
+
+        # Send Push
+        notify(message=message, medium="push", title="Booking Cancelled")
+
+        # Send SMS
+        notify(message=message, medium="sms")
+
+    # Booking Refund
+    elif old_status != "refunded" and instance.status == "refunded":
+        message = f"Your booking for {event.name} has been refunded. Amount: Rs. {instance.total_amount}."
+
+        # Send Email
+        notify(
+            message=message,
+            medium="email",
+            title=f"Booking Refunded - {event.name}",
+        )
+
+        # Send Push
+        notify(message=message, medium="push", title="Booking Refunded")
+
+        # Send SMS
+        notify(message=message, medium="sms")
+
+    if failures:
+        raise failures[0]
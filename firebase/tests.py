@@ -1,3 +1,764 @@
-from django.test import TestCase
+import time
+from datetime import timedelta
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from firebase_admin import exceptions, messaging
+
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.mail import EmailMessage
+from django.core.mail.backends.locmem import EmailBackend
+from django.test import TestCase, override_settings
+from django.db.models import F
+from django.utils import timezone
+
+from Eventmain.models import (
+    Booking,
+    Event,
+    EventAnalytics,
+    Notification,
+    Organizer,
+    Ticket,
+)
+from firebase import audience, digest, fanout, mailer, outbox, push, throttle, utils
+from firebase.models import (
+    CategorySubscription,
+    NotificationBucket,
+    NotificationToken,
+    OutboxMessage,
+    UserCategoryInterest,
+)
+from user.models import User
+
+
+def fake_multicast(calls):
+    """FCM stand-in rejecting every token that starts with "bad"."""
+
+    def send(tokens, title, body):
+        calls.append(list(tokens))
+        responses = [
+            SimpleNamespace(
+                success=not token.startswith("bad"),
+                exception=(
+                    messaging.UnregisteredError("Token is not registered")
+                    if token.startswith("bad")
+                    else None
+                ),
+            )
+            for token in tokens
+        ]
+        return SimpleNamespace(
+            responses=responses,
+            success_count=sum(response.success for response in responses),
+        )
+
+    return send
+
+
+class PublishFanoutTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        organizer_user = User.objects.create_user(
+            email="organizer@example.com", password="secret", phone_number="9812345678"
+        )
+        organizer = Organizer.objects.create(
+            user=organizer_user, organization_name="Organizer"
+        )
+        self.event = Event.objects.create(
+            organizer=organizer,
+            name="Festival",
+            description="Festival",
+            category="music",
+            location="Kathmandu",
+            start_date_time=timezone.now(),
+            end_date_time=timezone.now(),
+            capacity=100,
+            price=500,
+        )
+
+        for index in range(5):
+            user = User.objects.create_user(
+                email=f"fan{index}@example.com",
+                password="secret",
+                phone_number="9812345678",
+            )
+            if index == 3:
+                NotificationToken.objects.create(owner=user, token="bad-3")
+            else:
+                NotificationToken.objects.create(owner=user, token=f"token-{index}-a")
+                NotificationToken.objects.create(owner=user, token=f"token-{index}-b")
+        NotificationToken.objects.create(owner=None, token="anonymous")
+
+    def test_batches_tokens_without_splitting_users(self):
+        calls = []
+        with mock.patch.object(fanout, "send_fcm_multicast", fake_multicast(calls)):
+            # event, digest users and tokens, then an INSERT per batch, and a
+            # SELECT and DELETE for the batch with an invalid token
+            with self.assertNumQueries(3 + 4 + 2):
+                reached = fanout.publish_event(self.event.id, batch_size=3)
+
+        self.assertEqual(reached, 4)
+        self.assertEqual([len(tokens) for tokens in calls], [2, 2, 3, 2])
+        self.assertNotIn("anonymous", sum(calls, []))
+
+        notifications = Notification.objects.filter(event=self.event)
+        self.assertEqual(notifications.count(), 5)
+        self.assertEqual(notifications.filter(status="sent").count(), 4)
+        failed = notifications.get(status="failed")
+        self.assertEqual(failed.user.email, "fan3@example.com")
+        self.assertFalse(NotificationToken.objects.filter(token="bad-3").exists())
+
+    def test_push_reaches_every_device_of_a_user(self):
+        user = User.objects.get(email="fan0@example.com")
+        NotificationToken.objects.create(owner=user, token="bad-0-c")
+        calls = []
+        with mock.patch.object(utils, "send_fcm_multicast", fake_multicast(calls)):
+            notification = utils.create_and_send_notification(
+                user, self.event, "Doors open at six", medium="push"
+            )
+
+        self.assertEqual(notification.status, "sent")
+        self.assertEqual(calls, [["token-0-a", "token-0-b", "bad-0-c"]])
+        self.assertEqual(
+            set(
+                NotificationToken.objects.filter(owner=user).values_list(
+                    "token", flat=True
+                )
+            ),
+            {"token-0-a", "token-0-b"},
+        )
+
+    @override_settings(PUSH_PUBLISH_MODE="multicast")
+    def test_failed_publish_resumes_after_sent_batches(self):
+        OutboxMessage.objects.all().delete()
+        message = outbox.enqueue("event_published", {"event_id": self.event.id})
+        calls = []
+        send = fake_multicast(calls)
+        outages = [ConnectionError("FCM unavailable")]
+
+        def flaky(tokens, title, body):
+            if len(calls) == 1 and outages:
+                raise outages.pop()
+            return send(tokens, title, body)
+
+        with mock.patch.object(fanout, "send_fcm_multicast", flaky), mock.patch.object(
+            fanout, "FCM_MULTICAST_LIMIT", 3
+        ):
+            self.assertEqual(outbox.deliver_due(), (0, 1))
+            self.assertEqual(len(calls), 1)
+            OutboxMessage.objects.update(available_at=timezone.now())
+            self.assertEqual(outbox.deliver_due(), (1, 0))
+
+        # The retry went on with the second batch instead of starting over
+        self.assertEqual([len(tokens) for tokens in calls], [2, 2, 3, 2])
+        self.assertEqual(Notification.objects.filter(event=self.event).count(), 5)
+        message.refresh_from_db()
+        self.assertEqual(
+            message.payload["after_owner"],
+            User.objects.get(email="fan4@example.com").pk,
+        )
+
+    @override_settings(PUSH_BACKEND="memory")
+    def test_memory_push_backend(self):
+        push.reset_backends()
+        self.addCleanup(push.reset_backends)
+        backend = push.get_backend()
+        backend.invalid_tokens.update(["bad-3", "token-1-b"])
+
+        reached = fanout.publish_event(self.event.id)
+
+        self.assertEqual(reached, 4)
+        self.assertEqual(len(backend.sent), 7)
+        self.assertEqual(
+            {title for _, title, _ in backend.sent}, {"New Event: Festival"}
+        )
+        self.assertFalse(
+            NotificationToken.objects.filter(token__in=["bad-3", "token-1-b"]).exists()
+        )
+        self.assertIsInstance(push.get_backend(), push.MemoryBackend)
+
+    def test_only_token_errors_prune_tokens(self):
+        backend = push.FCMBackend(credential_path="unused.json")
+        self.assertTrue(backend.is_invalid_token(messaging.UnregisteredError("gone")))
+        self.assertTrue(
+            backend.is_invalid_token(
+                exceptions.InvalidArgumentError(
+                    "The registration token is not a valid FCM registration token"
+                )
+            )
+        )
+        # A bad message is not a bad token
+        self.assertFalse(
+            backend.is_invalid_token(
+                exceptions.InvalidArgumentError("Message payload is too big")
+            )
+        )
+
+    def test_fake_push_backend_failures(self):
+        backend = push.FakeFCMBackend(latency=0, failure_rate=0, invalid_rate=1)
+        result = backend.send_multicast(["token-0-a", "token-0-b"], "Title", "Body")
+        self.assertEqual(result.failure_count, 2)
+        self.assertTrue(backend.is_invalid_token(result.responses[0].exception))
+
+        backend = push.FakeFCMBackend(latency=0, failure_rate=1, invalid_rate=0)
+        result = backend.send_multicast(["token-0-a"], "Title", "Body")
+        self.assertIsInstance(result.responses[0].exception, push.PushUnavailable)
+        self.assertFalse(backend.is_invalid_token(result.responses[0].exception))
+        self.assertEqual((backend.calls, backend.failures), (1, 1))
+        with self.assertRaises(ValueError):
+            backend.send_multicast(["token"] * 501, "Title", "Body")
+
+    def test_push_benchmark_rolls_back(self):
+        out = StringIO()
+        users = User.objects.count()
+        call_command("benchmark_push", users=10, bookings=2, latency=0, stdout=out)
+
+        self.assertIn("publish: ", out.getvalue())
+        self.assertIn("bookings: ", out.getvalue())
+        self.assertEqual(User.objects.count(), users)
+        self.assertFalse(Booking.objects.exists())
+
+    def test_targeted_publish_reaches_interested_users(self):
+        fan0, fan1, fan2 = [
+            User.objects.get(email=f"fan{index}@example.com") for index in range(3)
+        ]
+        EventAnalytics.objects.create(event=self.event, user=fan0, views=3)
+        EventAnalytics.objects.create(event=self.event, user=fan1, views=0)
+        CategorySubscription.objects.create(user=fan2, category="tech")
+        self.assertEqual(audience.materialize_interests(), 2)
+
+        calls = []
+        with mock.patch.object(fanout, "send_fcm_multicast", fake_multicast(calls)):
+            # event, digest users, interested tokens, then the INSERT of one
+            # batch
+            with self.assertNumQueries(4):
+                reached = fanout.publish_event(self.event.id, targeted=True)
+
+        self.assertEqual(reached, 1)
+        self.assertEqual(calls, [["token-0-a", "token-0-b"]])
+
+        # Interests no longer backed by any source are dropped
+        EventAnalytics.objects.filter(user=fan0).delete()
+        self.assertEqual(audience.materialize_interests(), 1)
+        self.assertEqual(
+            list(UserCategoryInterest.objects.values_list("user", "category")),
+            [(fan2.id, "tech")],
+        )
+
+    def test_digest_users_get_one_digest(self):
+        User.objects.filter(email__in=["fan0@example.com", "fan1@example.com"]).update(
+            notification_mode="digest"
+        )
+        calls = []
+        with mock.patch.object(fanout, "send_fcm_multicast", fake_multicast(calls)):
+            self.assertEqual(fanout.publish_event(self.event.id), 2)
+            fanout.publish_event(self.event.id)
+        self.assertEqual(Notification.objects.filter(status="digest").count(), 4)
+        self.assertNotIn("token-0-a", sum(calls, []))
+
+        with mock.patch.object(utils, "send_fcm_multicast", fake_multicast(calls)):
+            self.assertEqual(digest.flush_digests(users_per_batch=1), 2)
+
+        self.assertFalse(Notification.objects.filter(status="digest").exists())
+        summary = Notification.objects.get(user__email="fan0@example.com")
+        self.assertEqual(summary.message, "2 new events: Festival, Festival")
+        self.assertEqual(summary.status, "sent")
+        self.assertEqual(calls[-1], ["token-1-a", "token-1-b"])
+        self.assertEqual(len(mail.outbox), 2)
+
+    def test_undelivered_digest_is_kept_for_the_next_flush(self):
+        # fan3 has no valid token, so only the email can deliver its digest
+        User.objects.filter(email="fan3@example.com").update(notification_mode="digest")
+        with mock.patch.object(fanout, "send_fcm_multicast", fake_multicast([])):
+            fanout.publish_event(self.event.id)
+
+        backend = CountingBackend(fail=True)
+        with mock.patch.object(utils, "send_fcm_multicast", fake_multicast([])):
+            with mock.patch.object(mailer, "get_connection", return_value=backend):
+                self.assertEqual(digest.flush_digests(), 0)
+            item = Notification.objects.get(user__email="fan3@example.com")
+            self.assertEqual((item.status, item.claimed_until), ("digest", None))
+
+            self.assertEqual(digest.flush_digests(), 1)
+        summary = Notification.objects.get(user__email="fan3@example.com")
+        self.assertEqual(
+            (summary.status, summary.message), ("sent", "New event: Festival")
+        )
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_digest_claimed_by_another_worker_is_not_sent(self):
+        User.objects.filter(email="fan0@example.com").update(notification_mode="digest")
+        with mock.patch.object(fanout, "send_fcm_multicast", fake_multicast([])):
+            fanout.publish_event(self.event.id)
+        Notification.objects.filter(status="digest").update(
+            claimed_until=timezone.now() + timedelta(minutes=5)
+        )
+
+        self.assertEqual(digest.flush_digests(), 0)
+        self.assertEqual(Notification.objects.filter(status="digest").count(), 1)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_topic_publish_is_one_send(self):
+        music_fan = User.objects.get(email="fan1@example.com")
+        sports_fan = User.objects.get(email="fan2@example.com")
+        CategorySubscription.objects.create(user=music_fan, category="music")
+        CategorySubscription.objects.create(user=sports_fan, category="sports")
+
+        with mock.patch.object(fanout, "send_fcm_to_condition") as send:
+            recorded = fanout.publish_event_to_topics(self.event.id)
+
+        send.assert_called_once_with(
+            "'events' in topics || 'events-music' in topics",
+            "New Event: Festival",
+            "Festival...",
+        )
+        self.assertEqual(recorded, 4)
+        self.assertEqual(
+            set(
+                Notification.objects.filter(event=self.event).values_list(
+                    "user__email", flat=True
+                )
+            ),
+            {
+                "fan0@example.com",
+                "fan1@example.com",
+                "fan3@example.com",
+                "fan4@example.com",
+            },
+        )
+
+    def test_failed_topic_send_records_nothing(self):
+        with mock.patch.object(
+            fanout, "send_fcm_to_condition", side_effect=ConnectionError("down")
+        ):
+            with self.assertRaises(ConnectionError):
+                fanout.publish_event_to_topics(self.event.id)
+        self.assertFalse(Notification.objects.filter(event=self.event).exists())
+
+        # A retry after the send went out only records the rows
+        with mock.patch.object(fanout, "send_fcm_to_condition") as send:
+            self.assertEqual(
+                fanout.publish_event_to_topics(self.event.id, sent=True), 5
+            )
+        send.assert_not_called()
+        self.assertEqual(
+            Notification.objects.filter(event=self.event, status="sent").count(), 5
+        )
+
+    def test_topic_changes_are_queued(self):
+        user = User.objects.get(email="fan0@example.com")
+        OutboxMessage.objects.all().delete()
+
+        CategorySubscription.objects.create(user=user, category="music")
+        NotificationToken.objects.create(owner=user, token="token-0-c")
+
+        self.assertEqual(
+            list(OutboxMessage.objects.values_list("kind", "payload")),
+            [
+                (
+                    "topic_subscribe",
+                    {"tokens": ["token-0-a", "token-0-b"], "topic": "events-music"},
+                ),
+                (
+                    "topic_unsubscribe",
+                    {"tokens": ["token-0-a", "token-0-b"], "topic": "events"},
+                ),
+                ("topic_subscribe", {"tokens": ["token-0-c"], "topic": "events-music"}),
+            ],
+        )
+
+    def test_removed_tokens_leave_their_topics(self):
+        user = User.objects.get(email="fan0@example.com")
+        other = User.objects.get(email="fan1@example.com")
+        CategorySubscription.objects.create(user=user, category="music")
+        OutboxMessage.objects.all().delete()
+
+        NotificationToken.objects.filter(token="token-0-a").delete()
+        token = NotificationToken.objects.get(token="token-0-b")
+        token.owner = other
+        token.save()
+        # Tokens pruned as invalid are already gone from FCM
+        utils.prune_invalid_tokens(
+            ["token-1-a"],
+            [SimpleNamespace(success=False, exception=messaging.UnregisteredError(""))],
+        )
+
+        self.assertEqual(
+            list(OutboxMessage.objects.values_list("kind", "payload")),
+            [
+                (
+                    "topic_unsubscribe",
+                    {"tokens": ["token-0-a"], "topic": "events-music"},
+                ),
+                (
+                    "topic_unsubscribe",
+                    {"tokens": ["token-0-b"], "topic": "events-music"},
+                ),
+                ("topic_subscribe", {"tokens": ["token-0-b"], "topic": "events"}),
+            ],
+        )
+
+
+@outbox.handler("test-failure")
+def fail_delivery(payload):
+    raise RuntimeError("gateway down")
+
+
+@outbox.handler("test-steps")
+def deliver_in_steps(payload):
+    outbox.checkpoint(step=1)
+    if payload.get("take_over"):
+        # Another worker claims the message once the lease ran out
+        OutboxMessage.objects.update(attempts=F("attempts") + 1)
+    outbox.checkpoint(step=2)
+
+
+class BookingTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            email="buyer@example.com", password="secret", phone_number="9812345678"
+        )
+        organizer = Organizer.objects.create(
+            user=self.user, organization_name="Organizer"
+        )
+        event = Event.objects.create(
+            organizer=organizer,
+            name="Festival",
+            description="Festival",
+            category="music",
+            location="Kathmandu",
+            start_date_time=timezone.now(),
+            end_date_time=timezone.now(),
+            capacity=100,
+            price=500,
+        )
+        ticket = Ticket.objects.create(
+            event=event, name="GA", price=500, quantity=50, ticket_type="GA"
+        )
+        self.booking = Booking.objects.create(
+            user=self.user,
+            ticket=ticket,
+            quantity=1,
+            total_amount=500,
+            status="pending",
+            payment_method="khalti",
+        )
+
+
+class OutboxTests(BookingTestCase):
+    def test_booking_notifications_are_sent_after_drain(self):
+        self.booking.status = "paid"
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.booking.save()
+
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.payload["status"], "paid")
+        self.assertEqual(len(callbacks), 1)
+        self.assertFalse(Notification.objects.exists())
+        self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(outbox.drain(workers=1), (1, 0))
+        message.refresh_from_db()
+        self.assertEqual(message.status, "sent")
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(
+            set(Notification.objects.values_list("medium", flat=True)),
+            {"email", "push", "sms"},
+        )
+
+    def test_failed_channel_is_retried_alone(self):
+        self.booking.status = "paid"
+        self.booking.save()
+
+        with mock.patch.object(
+            utils, "send_sms_notification", side_effect=[False, True]
+        ) as send_sms:
+            self.assertEqual(outbox.drain(workers=1), (0, 1))
+            sms = Notification.objects.get(medium="sms")
+            self.assertEqual(sms.status, "failed")
+            OutboxMessage.objects.update(available_at=timezone.now())
+            self.assertEqual(outbox.drain(workers=1), (1, 0))
+
+        self.assertEqual(send_sms.call_count, 2)
+        sms.refresh_from_db()
+        self.assertEqual(sms.status, "sent")
+        # The push and the confirmation email went out on the first attempt
+        # and were not repeated
+        self.assertEqual(Notification.objects.filter(medium="push").count(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_message_waits_for_its_email_batch(self):
+        self.booking.status = "cancelled"
+        self.booking.save()
+
+        backend = CountingBackend(fail=True)
+        with mock.patch.object(mailer, "get_connection", return_value=backend):
+            self.assertEqual(outbox.drain(workers=1), (0, 1))
+        self.assertEqual(OutboxMessage.objects.get().status, "pending")
+        email = Notification.objects.get(medium="email")
+        self.assertEqual(email.status, "failed")
+
+        OutboxMessage.objects.update(available_at=timezone.now())
+        self.assertEqual(outbox.drain(workers=1), (1, 0))
+        email.refresh_from_db()
+        self.assertEqual(email.status, "sent")
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(Notification.objects.filter(medium="sms").count(), 1)
+
+    @override_settings(OUTBOX_MAX_ATTEMPTS=2, OUTBOX_RETRY_BACKOFF=0)
+    def test_failing_messages_are_retried_then_dead_lettered(self):
+        outbox.enqueue("test-failure", {})
+
+        self.assertEqual(outbox.drain(workers=1), (0, 2))
+        message = OutboxMessage.objects.get()
+        self.assertEqual((message.status, message.attempts), ("dead", 2))
+        self.assertEqual(message.last_error, "gateway down")
+
+    def test_checkpoint_renews_the_lease(self):
+        outbox.enqueue("test-steps", {})
+        claimed = outbox.claim(10)
+        # The lease is about to run out
+        OutboxMessage.objects.update(available_at=timezone.now())
+
+        with mock.patch.object(outbox, "_record_outcome") as record:
+            outbox.deliver(claimed[0])
+        record.assert_called_once_with(claimed[0], None)
+        message = OutboxMessage.objects.get()
+        self.assertEqual(message.payload, {"step": 2})
+        self.assertGreater(message.available_at, timezone.now() + timedelta(seconds=30))
+
+    def test_handler_stops_once_its_lease_is_lost(self):
+        outbox.enqueue("test-steps", {"take_over": True})
+        outcomes = []
+
+        outbox.deliver(outbox.claim(10)[0], outcomes.append)
+
+        self.assertEqual(outcomes, [False])
+        message = OutboxMessage.objects.get()
+        # Left to the worker holding it, untouched by this one
+        self.assertEqual((message.status, message.attempts), ("pending", 2))
+        self.assertEqual(message.payload, {"take_over": True, "step": 1})
+        self.assertEqual(message.last_error, "")
+
+
+class NotificationThrottleTests(BookingTestCase):
+    def notify(self, kind, message="Doors open at six"):
+        return utils.create_and_send_notification(
+            self.user, self.booking.ticket.event, message, medium="sms", kind=kind
+        )
+
+    def test_same_kind_is_recorded_once_per_window(self):
+        self.assertIsNotNone(self.notify("booking-paid-1"))
+        self.assertIsNone(self.notify("booking-paid-1"))
+        self.assertIsNotNone(self.notify("booking-cancelled-1"))
+        self.assertEqual(Notification.objects.count(), 2)
+
+    def test_unwindowed_kind_is_recorded_once_across_windows(self):
+        def notify_at(now, windowed):
+            with mock.patch.object(throttle.time, "time", return_value=now):
+                return utils.create_and_send_notification(
+                    self.user,
+                    self.booking.ticket.event,
+                    "Doors open at six",
+                    medium="sms",
+                    kind="booking-paid-1-7",
+                    windowed=windowed,
+                )
+
+        # Fixed windows let a repeat straddling their boundary through
+        self.assertIsNotNone(notify_at(599.0, windowed=True))
+        self.assertIsNotNone(notify_at(601.0, windowed=True))
+        self.assertIsNotNone(notify_at(599.0, windowed=False))
+        self.assertIsNone(notify_at(601.0, windowed=False))
+
+    @override_settings(NOTIFICATION_RATE_BURST=2, NOTIFICATION_RATE_PER_MINUTE=0)
+    def test_burst_over_the_limit_is_coalesced(self):
+        statuses = [self.notify(f"update-{index}").status for index in range(4)]
+        self.assertEqual(statuses, ["sent", "sent", "coalesced", "coalesced"])
+
+        with mock.patch.object(
+            utils, "send_sms_notification", return_value=True
+        ) as send_sms:
+            self.assertEqual(throttle.flush_coalesced(), 2)
+        send_sms.assert_called_once()
+        self.assertIn("You have 2 updates", send_sms.call_args.args[1])
+        self.assertFalse(Notification.objects.filter(status="coalesced").exists())
+
+    @override_settings(NOTIFICATION_RATE_BURST=1, NOTIFICATION_RATE_PER_MINUTE=0)
+    def test_booking_notifications_are_not_throttled(self):
+        self.assertEqual(self.notify("update-1").status, "sent")
+        self.assertEqual(self.notify("update-2").status, "coalesced")
+
+        self.booking.status = "paid"
+        self.booking.save()
+        outbox.drain(workers=1)
+        self.assertFalse(
+            Notification.objects.filter(
+                status="coalesced", dedup_key__contains="booking-paid"
+            ).exists()
+        )
+        # The confirmation email went out with its ticket
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(len(mail.outbox[0].attachments), 1)
+
+    @override_settings(NOTIFICATION_RATE_BURST=2, NOTIFICATION_RATE_PER_MINUTE=60)
+    def test_bucket_is_kept_in_the_database(self):
+        now = 1000.0
+        self.assertEqual(
+            [throttle.allow(self.user.id, now=now) for _ in range(3)],
+            [True, True, False],
+        )
+        bucket = NotificationBucket.objects.get(user=self.user)
+        self.assertEqual((bucket.tokens, bucket.updated_at), (0, now))
+        # Refilled at one token a second
+        self.assertTrue(throttle.allow(self.user.id, now=now + 1))
+        self.assertFalse(throttle.allow(self.user.id, now=now + 1))
+
+    @override_settings(NOTIFICATION_RATE_BURST=0, NOTIFICATION_RATE_PER_MINUTE=0)
+    def test_flush_skips_rows_claimed_by_another_worker(self):
+        held, expired = self.notify("update-1"), self.notify("update-2")
+        now = timezone.now()
+        Notification.objects.filter(pk=held.pk).update(
+            claimed_until=now + timedelta(minutes=5)
+        )
+        Notification.objects.filter(pk=expired.pk).update(
+            claimed_until=now - timedelta(minutes=5)
+        )
+
+        with mock.patch.object(
+            utils, "send_sms_notification", return_value=True
+        ) as send_sms:
+            self.assertEqual(throttle.flush_coalesced(), 1)
+            self.assertEqual(throttle.flush_coalesced(), 0)
+        send_sms.assert_called_once()
+        held.refresh_from_db()
+        expired.refresh_from_db()
+        self.assertEqual((held.status, expired.status), ("coalesced", "sent"))
+
+
+class StatusTrackingTests(BookingTestCase):
+    def test_saves_do_not_reread_the_status(self):
+        booking = Booking.objects.get(pk=self.booking.pk)
+        booking.quantity = 2
+        with self.assertNumQueries(1):
+            booking.save()
+
+        event = Event.objects.get(pk=booking.ticket.event_id)
+        event.name = "Renamed festival"
+        with self.assertNumQueries(1):
+            event.save()
+
+    def test_status_change_is_detected_from_loaded_status(self):
+        booking = Booking.objects.get(pk=self.booking.pk)
+        booking.status = "paid"
+        # UPDATE of the booking and INSERT of its outbox message
+        with self.assertNumQueries(2):
+            booking.save(update_fields=["status"])
+
+        booking.status = "cancelled"
+        booking.save(update_fields=["quantity"])
+        booking.save()
+
+        self.assertEqual(
+            list(OutboxMessage.objects.values_list("payload", flat=True)),
+            [
+                {"booking_id": booking.pk, "old_status": "pending", "status": "paid"},
+                {"booking_id": booking.pk, "old_status": "paid", "status": "cancelled"},
+            ],
+        )
+
+    def test_loading_a_deferred_field_keeps_the_saved_status(self):
+        booking = Booking.objects.only("id", "status").get(pk=self.booking.pk)
+        booking.status = "paid"
+        # Runs refresh_from_db(fields=["quantity"])
+        self.assertEqual(booking.quantity, 1)
+        booking.save()
+
+        self.assertEqual(
+            OutboxMessage.objects.get().payload,
+            {"booking_id": booking.pk, "old_status": "pending", "status": "paid"},
+        )
+
+
+class CountingBackend(EmailBackend):
+    """locmem backend counting the connections opened and batches sent."""
+
+    def __init__(self, fail=False, **kwargs):
+        super().__init__(**kwargs)
+        self.fail = fail
+        self.opened = 0
+        self.batches = []
+
+    def open(self):
+        self.opened += 1
+        return True
+
+    def send_messages(self, messages):
+        if self.fail:
+            raise ConnectionError("SMTP server unavailable")
+        self.batches.append(len(messages))
+        return super().send_messages(messages)
+
+
+class EmailDispatcherTests(TestCase):
+    def message(self, index):
+        return EmailMessage(f"Subject {index}", "Body", to=[f"user{index}@example.com"])
+
+    def test_batches_share_one_connection(self):
+        backend = CountingBackend()
+        with mailer.EmailDispatcher(batch_size=2, connection=backend) as dispatcher:
+            for index in range(5):
+                dispatcher.add(self.message(index))
+
+        self.assertEqual(backend.opened, 1)
+        self.assertEqual(backend.batches, [2, 2, 1])
+        self.assertEqual(len(mail.outbox), 5)
+        self.assertEqual(dispatcher.stats["sent"], 5)
+
+    def test_failed_batch_is_reported(self):
+        results = []
+        backend = CountingBackend(fail=True)
+        with mailer.EmailDispatcher(batch_size=2, connection=backend) as dispatcher:
+            for index in range(2):
+                dispatcher.add(self.message(index), results.append)
+
+        self.assertEqual(results, [False, False])
+        self.assertEqual(dispatcher.stats["failed"], 2)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_partial_batch_goes_out_once_due(self):
+        backend = CountingBackend()
+        with mailer.EmailDispatcher(
+            batch_size=10, flush_interval=60, connection=backend
+        ) as dispatcher:
+            dispatcher.add(self.message(1))
+            dispatcher.flush_if_due()
+            self.assertEqual(backend.batches, [])
+
+            later = time.monotonic() + 60
+            with mock.patch.object(mailer.time, "monotonic", return_value=later):
+                dispatcher.flush_if_due()
+            self.assertEqual(backend.batches, [1])
+
+    def test_group_settles_when_its_emails_went_out(self):
+        outcomes = []
+        with mailer.batched(batch_size=10):
+            with mailer.group() as emails:
+                mailer.send_email(self.message(1))
+            emails.then(outcomes.append)
+            self.assertEqual(outcomes, [])
+
+        self.assertEqual(outcomes, [True])
+
+    def test_batched_block_queues_send_email(self):
+        with mailer.batched(batch_size=10) as dispatcher:
+            mailer.send_email(self.message(1))
+            mailer.send_email(self.message(2))
+            self.assertEqual(len(mail.outbox), 0)
+
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(dispatcher.stats["batches"], 1)
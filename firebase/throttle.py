@@ -0,0 +1,158 @@
+"""
+Notification deduplication, rate limiting and coalescing.
+
+Notifications created with a `kind` get a dedup key made of the user,
+event, kind, medium and a NOTIFICATION_DEDUP_WINDOW second time window.
+The key is unique in the database, so repeated saves, outbox retries or
+status churn within the window record and send a notification only once.
+Windows are fixed buckets of time, so two sends straddling a bucket
+boundary both go out. Kinds naming a single occurrence, like the booking
+transition an outbox message records, are keyed without a window instead.
+
+Every user also has a token bucket, shared by all channels:
+NOTIFICATION_RATE_BURST sends at once, refilled with
+NOTIFICATION_RATE_PER_MINUTE. Notifications over the limit are stored as
+"coalesced" instead of being sent, and `flush_coalesced` later sends each
+user a single message per medium that sums them up. Transactional
+notifications, like booking confirmations carrying the ticket, are never
+held back. The bucket is a NotificationBucket row updated with a
+conditional UPDATE, so the limit holds across processes and concurrent
+takes cannot both spend the same token.
+
+Flushing workers `claim` the rows they send with a lease of
+OUTBOX_LEASE_SECONDS, so concurrent workers never send the same summary
+and a worker that crashes mid-flush only delays its rows until the lease
+runs out; they are then sent again, at least once like the outbox.
+"""
+
+import logging
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from Eventmain.models import Notification
+from firebase.models import NotificationBucket
+
+logger = logging.getLogger(__name__)
+
+
+def dedup_key(user_id, event_id, kind, medium, now=None, windowed=True):
+    if not windowed:
+        return f"{user_id}:{event_id}:{kind}:{medium}"
+    window = int((now or time.time()) // settings.NOTIFICATION_DEDUP_WINDOW)
+    return f"{user_id}:{event_id}:{kind}:{medium}:{window}"
+
+
+def allow(user_id, now=None):
+    """Take a token from the bucket of `user_id`; False when it is empty."""
+    capacity = settings.NOTIFICATION_RATE_BURST
+    rate = settings.NOTIFICATION_RATE_PER_MINUTE / 60
+    now = now or time.time()
+    buckets = NotificationBucket.objects.filter(user_id=user_id)
+
+    while True:
+        saved = buckets.values_list("tokens", "updated_at").first()
+        tokens, updated_at = saved or (capacity, now)
+        tokens = min(capacity, tokens + max(0, now - updated_at) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+
+        if saved is None:
+            try:
+                with transaction.atomic():
+                    NotificationBucket.objects.create(
+                        user_id=user_id, tokens=tokens, updated_at=now
+                    )
+                return allowed
+            except IntegrityError:
+                continue
+        # Only applies if no other worker took a token since the read;
+        # otherwise read the bucket again
+        if buckets.filter(tokens=saved[0], updated_at=saved[1]).update(
+            tokens=tokens, updated_at=max(now, saved[1])
+        ):
+            return allowed
+
+
+def claim(notifications):
+    """
+    Lease the rows of `notifications` that no other worker holds to the
+    caller and return their ids.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            notifications.select_for_update(skip_locked=True)
+            .filter(Q(claimed_until__isnull=True) | Q(claimed_until__lte=now))
+            .values_list("id", flat=True)
+        )
+        if ids:
+            Notification.objects.filter(id__in=ids).update(
+                claimed_until=now + timedelta(seconds=settings.OUTBOX_LEASE_SECONDS)
+            )
+    return ids
+
+
+def _summary(notifications):
+    if len(notifications) == 1:
+        return notifications[0].message
+    lines = [f"You have {len(notifications)} updates:"]
+    lines.extend(f"- {notification.message}" for notification in notifications)
+    return "\n".join(lines)
+
+
+def flush_coalesced():
+    """
+    Send every user's coalesced notifications as one message per medium.
+    Returns the number of notifications flushed.
+    """
+    from firebase.utils import (
+        send_email_notification,
+        send_push_to_user,
+        send_sms_notification,
+    )
+
+    ids = claim(Notification.objects.filter(status="coalesced"))
+    groups = defaultdict(list)
+    for notification in (
+        Notification.objects.filter(id__in=ids, status="coalesced")
+        .select_related("user", "event")
+        .order_by("user_id", "medium", "created_at", "id")
+    ):
+        groups[(notification.user_id, notification.medium)].append(notification)
+
+    sent, failed = [], []
+    for (_, medium), notifications in groups.items():
+        user = notifications[0].user
+        event = notifications[-1].event
+        message = _summary(notifications)
+        try:
+            if medium == "push":
+                ok = bool(send_push_to_user(user, title="Event updates", body=message))
+            elif medium == "email":
+                ok = send_email_notification(user, message, event, "Event updates")
+            else:
+                ok = send_sms_notification(user, message, event)
+        except Exception as e:
+            logger.exception(f"Coalesced {medium} notification failed: {e}")
+            ok = False
+        (sent if ok else failed).extend(
+            notification.pk for notification in notifications
+        )
+
+    if sent:
+        Notification.objects.filter(pk__in=sent).update(status="sent")
+    if failed:
+        Notification.objects.filter(pk__in=failed).update(status="failed")
+    if groups:
+        logger.info(
+            f"Flushed {len(sent) + len(failed)} coalesced notifications "
+            f"in {len(groups)} messages"
+        )
+    return len(sent) + len(failed)
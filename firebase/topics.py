@@ -0,0 +1,168 @@
+"""
+FCM topic subscriptions.
+
+Every notification token is subscribed either to the topic of each event
+category its owner follows (CategorySubscription) or, when the owner follows
+no category, to the global topic. Publishing an event is then a single FCM
+send to the condition "global topic or the event's category topic", and FCM
+delivers it once per device whatever the number of users.
+
+Subscription changes, including tokens that are deleted or change owner,
+are queued in the outbox (`topic_subscribe` and `topic_unsubscribe`
+messages) and applied in calls of up to FCM_TOPIC_BATCH_SIZE tokens. `sync_all_tokens` subscribes existing tokens
+in bulk, see the `sync_topic_subscriptions` command.
+"""
+
+import logging
+from collections import defaultdict
+
+from django.db.models import Q
+
+from firebase import outbox
+from firebase.models import CategorySubscription, NotificationToken
+from firebase.utils import subscribe_to_topic, unsubscribe_from_topic
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_TOPIC = "events"
+# FCM accepts at most 1000 tokens per topic management call
+FCM_TOPIC_BATCH_SIZE = 1000
+
+
+def category_topic(category):
+    return f"{GLOBAL_TOPIC}-{category}"
+
+
+def event_condition(event):
+    """FCM condition matching every device that should hear about `event`."""
+    return f"'{GLOBAL_TOPIC}' in topics || '{category_topic(event.category)}' in topics"
+
+
+def topics_for_categories(categories):
+    return [category_topic(category) for category in categories] or [GLOBAL_TOPIC]
+
+
+def topics_for_user(user_id):
+    """Return the topics the tokens of `user_id` belong in."""
+    return topics_for_categories(
+        CategorySubscription.objects.filter(user_id=user_id)
+        .order_by("category")
+        .values_list("category", flat=True)
+    )
+
+
+def user_tokens(user_id):
+    return list(
+        NotificationToken.objects.filter(owner_id=user_id)
+        .order_by("id")
+        .values_list("token", flat=True)
+    )
+
+
+def queue_subscribe(tokens, topic):
+    if tokens:
+        outbox.enqueue("topic_subscribe", {"tokens": tokens, "topic": topic})
+
+
+def queue_unsubscribe(tokens, topic):
+    if tokens:
+        outbox.enqueue("topic_unsubscribe", {"tokens": tokens, "topic": topic})
+
+
+def queue_token_registration(token):
+    """Subscribe a newly registered token to its owner's topics."""
+    if token.owner_id is None:
+        return
+    for topic in topics_for_user(token.owner_id):
+        queue_subscribe([token.token], topic)
+
+
+def queue_token_removal(token, owner_id):
+    """Unsubscribe `token` from the topics of its (former) owner."""
+    if owner_id is None:
+        return
+    for topic in topics_for_user(owner_id):
+        queue_unsubscribe([token], topic)
+
+
+def queue_category_change(user_id, category, subscribed):
+    """
+    Move the tokens of `user_id` after it (un)followed `category`, switching
+    between the global topic and category topics when needed.
+    """
+    tokens = user_tokens(user_id)
+    following = CategorySubscription.objects.filter(user_id=user_id).count()
+    if subscribed:
+        queue_subscribe(tokens, category_topic(category))
+        if following == 1:
+            queue_unsubscribe(tokens, GLOBAL_TOPIC)
+    else:
+        queue_unsubscribe(tokens, category_topic(category))
+        if following == 0:
+            queue_subscribe(tokens, GLOBAL_TOPIC)
+
+
+def _in_batches(tokens, call, topic):
+    for start in range(0, len(tokens), FCM_TOPIC_BATCH_SIZE):
+        batch = tokens[start : start + FCM_TOPIC_BATCH_SIZE]
+        response = call(batch, topic)
+        if response.failure_count:
+            logger.warning(
+                f"{response.failure_count} of {len(batch)} tokens failed "
+                f"topic update for {topic}"
+            )
+
+
+@outbox.handler("topic_subscribe")
+def deliver_subscribe(payload):
+    _in_batches(payload["tokens"], subscribe_to_topic, payload["topic"])
+
+
+@outbox.handler("topic_unsubscribe")
+def deliver_unsubscribe(payload):
+    _in_batches(payload["tokens"], unsubscribe_from_topic, payload["topic"])
+
+
+def sync_all_tokens():
+    """
+    Subscribe every owned token to its owner's topics, in calls of
+    FCM_TOPIC_BATCH_SIZE tokens per topic. Returns the number of tokens.
+    """
+    categories = defaultdict(list)
+    for user_id, category in CategorySubscription.objects.order_by(
+        "category"
+    ).values_list("user_id", "category"):
+        categories[user_id].append(category)
+
+    pending = defaultdict(list)
+    count = 0
+    for owner_id, token in (
+        NotificationToken.objects.filter(owner__isnull=False)
+        .values_list("owner_id", "token")
+        .iterator(chunk_size=2000)
+    ):
+        count += 1
+        for topic in topics_for_categories(categories.get(owner_id, [])):
+            pending[topic].append(token)
+            if len(pending[topic]) == FCM_TOPIC_BATCH_SIZE:
+                _in_batches(pending.pop(topic), subscribe_to_topic, topic)
+    for topic, tokens in pending.items():
+        _in_batches(tokens, subscribe_to_topic, topic)
+
+    logger.info(f"Synced topic subscriptions of {count} tokens")
+    return count
+
+
+def recipients(event):
+    """Ids of the users the topic send of `event` reaches, streamed."""
+    return (
+        NotificationToken.objects.filter(
+            Q(owner__category_subscriptions__isnull=True)
+            | Q(owner__category_subscriptions__category=event.category),
+            owner__isnull=False,
+        )
+        .order_by("owner_id")
+        .values_list("owner_id", flat=True)
+        .distinct()
+        .iterator(chunk_size=2000)
+    )
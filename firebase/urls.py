@@ -1,11 +1,16 @@
-from django.urls import path
-from .views import save_fcm_token, index, showFirebaseJS
+from django.urls import path, include
+from rest_framework.routers import SimpleRouter
+from .views import save_fcm_token, index, showFirebaseJS, CategorySubscriptionViewSet
+
+router = SimpleRouter()
+router.register(r"category-subscriptions", CategorySubscriptionViewSet, basename="category-subscription")
 
 
 urlpatterns = [
 
     path('firebase-messaging-sw.js',showFirebaseJS,name="show_firebase_js"),
     path('save-token/',save_fcm_token, name='save_fcm_token'),
+    path('api/', include(router.urls)),
     path('',index),
 
 ]
\ No newline at end of file
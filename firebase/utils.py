@@ -1,38 +1,120 @@
-import firebase_admin
-from firebase_admin import credentials, messaging
 import os
+from datetime import timedelta
+
 from django.conf import settings
-from django.core.mail import send_mail
+from django.core.mail import EmailMessage
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
 from Eventmain.models import Notification
+from Eventmain import inbox, tickets
+from . import throttle
+from .mailer import send_email
 from .models import NotificationToken
+from .push import get_backend
 import logging
+import threading
 
 
-import io
-import qrcode
 from django.core.mail import EmailMultiAlternatives
 from django.template.loader import render_to_string
 from email.mime.image import MIMEImage
 
 logger = logging.getLogger(__name__)
-# Check if Firebase is already initialized
-if not firebase_admin._apps:
-    cred_path = os.path.join(settings.BASE_DIR, "firebase_key.json")
-    cred = credentials.Certificate(cred_path)
-    firebase_admin.initialize_app(cred)
+
+
+# Set while invalid tokens are deleted: FCM already dropped them from their
+# topics, so firebase.signals queues no unsubscription for them
+_pruning = threading.local()
+
+
+class NotificationFailed(Exception):
+    """Raised when a channel did not accept a notification."""
+
+
+def is_pruning():
+    return getattr(_pruning, "active", False)
 
 
 def send_fcm_notification(token, title, body):
     try:
-        message = messaging.Message(
-            notification=messaging.Notification(title=title, body=body), token=token
-        )
-        response = messaging.send(message)
+        response = get_backend().send(token, title, body)
         return response
     except Exception as e:
         return str(e)
 
 
+def send_fcm_multicast(tokens, title, body):
+    """
+    Send one push notification to up to 500 tokens with a single FCM call.
+    Returns a BatchResponse whose `responses` follow the order of `tokens`.
+    """
+    return get_backend().send_multicast(tokens, title, body)
+
+
+def send_fcm_to_condition(condition, title, body):
+    """Send one push notification to every device matching a topic condition."""
+    return get_backend().send_to_condition(condition, title, body)
+
+
+def subscribe_to_topic(tokens, topic):
+    """Subscribe up to 1000 tokens to an FCM topic with one call."""
+    return get_backend().subscribe(tokens, topic)
+
+
+def unsubscribe_from_topic(tokens, topic):
+    """Unsubscribe up to 1000 tokens from an FCM topic with one call."""
+    return get_backend().unsubscribe(tokens, topic)
+
+
+def prune_invalid_tokens(tokens, responses):
+    """
+    Delete, in one query, the tokens whose multicast response reports them
+    unregistered or invalid. `responses` follow the order of `tokens`.
+    Returns the number of tokens deleted.
+    """
+    backend = get_backend()
+    invalid = [
+        token
+        for token, response in zip(tokens, responses)
+        if not response.success and backend.is_invalid_token(response.exception)
+    ]
+    if not invalid:
+        return 0
+    _pruning.active = True
+    try:
+        deleted, _ = NotificationToken.objects.filter(token__in=invalid).delete()
+    finally:
+        _pruning.active = False
+    logger.info(f"Removed {deleted} invalid notification tokens")
+    return deleted
+
+
+def send_push_to_user(user, title, body):
+    """
+    Send a push notification to every device of `user` with one multicast
+    call, dropping tokens FCM rejects as invalid. Returns the number of
+    devices the notification was delivered to; raises NotificationFailed
+    when the user has valid devices but none of them accepted it.
+    """
+    tokens = list(
+        NotificationToken.objects.filter(owner=user)
+        .order_by("id")
+        .values_list("token", flat=True)
+    )
+    delivered = pruned = 0
+    # FCM takes at most 500 tokens per multicast
+    for start in range(0, len(tokens), 500):
+        batch = tokens[start : start + 500]
+        response = send_fcm_multicast(batch, title, body)
+        pruned += prune_invalid_tokens(batch, response.responses)
+        delivered += response.success_count
+    if not delivered and pruned < len(tokens):
+        # Valid devices that all failed: worth retrying, unlike having none
+        raise NotificationFailed(f"No device of user {user.id} accepted the push")
+    return delivered
+
+
 logger = logging.getLogger(__name__)
 
 
@@ -53,9 +135,27 @@ def create_and_send_notification(user, event, message, medium="push", **kwargs):
         **kwargs: Additional parameters for specific notification types
             - title (str): Optional notification title (defaults to event name)
             - icon (str): Optional icon URL for push notifications
+            - kind (str): Optional notification kind; a notification of the
+              same kind, user, event and medium within
+              NOTIFICATION_DEDUP_WINDOW seconds is skipped, unless it failed,
+              in which case it is sent again
+            - windowed (bool): False keys `kind` without the time window,
+              for kinds naming a single occurrence; defaults to True
+            - email (callable): Builds the EmailMessage to send instead of
+              the plain notification email
+            - transactional (bool): Never hold the notification back for the
+              rate limit, for mail the user must get as sent, like a
+              booking confirmation with its ticket
+            - raise_errors (bool): Re-raise the error of a failed send after
+              recording it, so an outbox delivery is retried
+
+    Users over their notification rate limit get the notification stored as
+    "coalesced"; `firebase.throttle.flush_coalesced` sends those later in a
+    single message.
 
     Returns:
-        Notification: The created notification object with updated status
+        Notification: The created notification object with updated status,
+        or None when it duplicates one already recorded
 
     Example:
         >>> user = User.objects.get(id=1)
@@ -70,35 +170,78 @@ def create_and_send_notification(user, event, message, medium="push", **kwargs):
     # Extract additional parameters
     title = kwargs.get("title", f"Event: {event.name}")
 
+    kind = kwargs.get("kind")
+    build_email = kwargs.get("email")
+    raise_errors = kwargs.get("raise_errors", False)
+
     # Create notification record with pending status
-    notification = Notification.objects.create(
-        user=user, event=event, message=message, medium=medium, status="pending"
+    key = kind and throttle.dedup_key(
+        user.id, event.id, kind, medium, windowed=kwargs.get("windowed", True)
     )
+    try:
+        with transaction.atomic():
+            notification = Notification.objects.create(
+                user=user,
+                event=event,
+                message=message,
+                medium=medium,
+                status="pending",
+                dedup_key=key,
+            )
+    except IntegrityError:
+        notification = _retry_failed(key)
+        if notification is None:
+            logger.info(
+                f"Skipped duplicate {kind} {medium} notification for user {user.id}"
+            )
+            return None
+    inbox.forget_unread([user.id])
+
+    if not kwargs.get("transactional") and not throttle.allow(user.id):
+        notification.status = "coalesced"
+        notification.save(update_fields=["status"])
+        return notification
 
     # Send via appropriate channel
     try:
         if medium == "push":
-            # Get user's token
-            token_obj = NotificationToken.objects.filter(owner=user).first()
-            if token_obj:
-                response = send_fcm_notification(
-                    token=token_obj.token, title=title, body=message
-                )
+            # Send to all of the user's devices at once
+            delivered = send_push_to_user(user, title=title, body=message)
+            if delivered:
                 notification.status = "sent"
-                logger.info(f"Push notification sent to user {user.id}: {response}")
+                logger.info(
+                    f"Push notification sent to {delivered} devices of user {user.id}"
+                )
             else:
                 notification.status = "failed"
-                logger.warning(f"Push notification failed: No token for user {user.id}")
+                logger.warning(
+                    f"Push notification failed: No reachable device for user {user.id}"
+                )
 
         elif medium == "email":
-            # You'll implement this function next
-            send_email_notification(user, message, event, title)
-            notification.status = "sent"
-            logger.info(f"Email notification sent to user {user.id}")
+            # The email may be queued on the thread's dispatcher: it stays
+            # pending until its batch went out
+            def email_sent(sent):
+                notification.status = "sent" if sent else "failed"
+                Notification.objects.filter(pk=notification.pk).update(
+                    status=notification.status
+                )
+                if sent:
+                    logger.info(f"Email notification sent to user {user.id}")
+
+            if build_email is not None:
+                queued = send_email(build_email(), email_sent)
+            else:
+                queued = send_email_notification(
+                    user, message, event, title, email_sent
+                )
+            if not queued:
+                raise NotificationFailed(f"Email to user {user.id} failed")
 
         elif medium == "sms":
             # You'll implement this function next
-            send_sms_notification(user, message, event)
+            if not send_sms_notification(user, message, event):
+                raise NotificationFailed(f"SMS to user {user.id} failed")
             notification.status = "sent"
             logger.info(f"SMS notification sent to user {user.id}")
 
@@ -109,21 +252,47 @@ def create_and_send_notification(user, event, message, medium="push", **kwargs):
     except Exception as e:
         notification.status = "failed"
         logger.exception(f"Failed to send {medium} notification: {str(e)}")
+        error = e
+    else:
+        error = None
 
     # Save the updated status
     notification.save()
+    if raise_errors and error is not None:
+        raise error
     return notification
 
 
-def send_email_notification(user, message, event, subject=None):
+def _retry_failed(key):
+    """
+    Take over the notification recorded under dedup `key` to send it again
+    when it failed, or was left pending for longer than an outbox lease by a
+    worker that died before its email batch went out. Returns None when it
+    was sent, is still in flight or another caller took it.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=settings.OUTBOX_LEASE_SECONDS)
+    taken = Notification.objects.filter(
+        Q(status="failed") | Q(status="pending", created_at__lte=stale),
+        dedup_key=key,
+    ).update(status="pending", created_at=now)
+    return Notification.objects.get(dedup_key=key) if taken else None
+
+
+def send_email_notification(user, message, event, subject=None, callback=None):
     """
     Send an email notification to a user.
 
+    Inside `firebase.mailer.batched()` the email is queued and sent with the
+    rest of its batch over a shared SMTP connection.
+
     Args:
         user (User): The recipient user object
         message (str): The email message body
         event (Event): The related event object
         subject (str, optional): Custom email subject. Defaults to event name.
+        callback (callable, optional): Called with True or False once the
+            email was sent or failed.
 
     Returns:
         bool: True if sent successfully, False otherwise
@@ -141,30 +310,26 @@ def send_email_notification(user, message, event, subject=None):
     email_subject = subject or f"Event Notification: {event.name}"
 
     try:
-        send_mail(
+        email = EmailMessage(
             subject=email_subject,
-            message=message,
+            body=message,
             from_email=settings.DEFAULT_FROM_EMAIL,
-            recipient_list=[user.email],
-            fail_silently=False,
+            to=[user.email],
         )
-        return True
+        return send_email(email, callback)
     except Exception as e:
         logger.exception(f"Email sending failed: {str(e)}")
         return False
 
 
-def send_booking_confirmation_email(booking, tidx=None):
-    """
-    Sends booking confirmation email with QR code as attachment.
+def booking_confirmation_email(booking):
     """
-    qr_data = f"BookingID:{booking.id};TransactionID:{booking.transaction_id};TIDX:{tidx or ''}"
-    qr = qrcode.make(qr_data)
+    Build the booking confirmation email with QR code as attachment.
 
-    buffer = io.BytesIO()
-    qr.save(buffer)
-    buffer.seek(0)
-    qr_image_data = buffer.getvalue()
+    The QR code is the one stored for the booking by `Eventmain.tickets`, so
+    re-sending a ticket does not render it again.
+    """
+    qr_image_data = bytes(tickets.qr_code_for(booking).image)
 
     subject = f"Your Booking Confirmation - {booking.ticket.event.name}"
     to_email = booking.user.email
@@ -190,12 +355,26 @@ def send_booking_confirmation_email(booking, tidx=None):
     qr_image = MIMEImage(qr_image_data)
     qr_image.add_header("Content-ID", "<qr_code_cid>")
     email.attach(qr_image)
+    return email
 
-    try:
-        email.send()
-        print(f"✅ Email with QR code sent to {to_email}")
-    except Exception as e:
-        print(f"❌ Failed to send email: {e}")
+
+def send_booking_confirmation_email(booking):
+    """
+    Sends booking confirmation email with QR code as attachment. Raises
+    NotificationFailed when the email could not be sent.
+    """
+    email = booking_confirmation_email(booking)
+    to_email = booking.user.email
+
+    # Inside mailer.batched() the email only goes out with its batch
+    def sent(ok):
+        if ok:
+            print(f"✅ Email with QR code sent to {to_email}")
+        else:
+            print(f"❌ Failed to send email to {to_email}")
+
+    if not send_email(email, sent):
+        raise NotificationFailed(f"Booking confirmation email to {to_email} failed")
 
 
 def send_sms_notification(user, message, event):
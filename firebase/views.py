@@ -15,6 +15,8 @@ import json
 from .models import FCMTokens
 
 from django.shortcuts import render
+from rest_framework import viewsets
+from rest_framework.permissions import IsAuthenticated
 
 
 @csrf_exempt
@@ -85,3 +87,16 @@ def showFirebaseJS(request):
     """
     return HttpResponse(data, content_type="text/javascript")
 
+
+class CategorySubscriptionViewSet(viewsets.ModelViewSet):
+    """Event categories the current user gets push notifications about."""
+
+    serializer_class = CategorySubscriptionSerializer
+    permission_classes = [IsAuthenticated]
+    http_method_names = ["get", "post", "delete"]
+
+    def get_queryset(self):
+        return CategorySubscription.objects.filter(user=self.request.user)
+
+    def perform_create(self, serializer):
+        serializer.save(user=self.request.user)
@@ -0,0 +1,22 @@
+# Generated by Django 5.2 on 2026-10-18 17:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("user", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="user",
+            name="notification_mode",
+            field=models.CharField(
+                choices=[("instant", "Instant"), ("digest", "Digest")],
+                default="instant",
+                max_length=10,
+            ),
+        ),
+    ]
@@ -59,6 +59,10 @@ class User(AbstractUser):
         ("en", "English"),
         ("np", "Nepali"),
     )
+    NOTIFICATION_MODE_CHOICES = (
+        ("instant", "Instant"),
+        ("digest", "Digest"),
+    )
     name = models.CharField(max_length=255, null=True, blank=True)
     email = models.EmailField(unique=True)
     role = models.ForeignKey(
@@ -69,6 +73,10 @@ class User(AbstractUser):
         on_delete=models.SET_NULL,
     )
     language = models.CharField(max_length=2, choices=LANGUAGE_CHOICES, default="en")
+    # "digest" users get new events in a periodic digest instead of one push each
+    notification_mode = models.CharField(
+        max_length=10, choices=NOTIFICATION_MODE_CHOICES, default="instant"
+    )
     created_at = models.DateTimeField(auto_now_add=True)
 
     # Phone-related fields
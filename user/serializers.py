@@ -144,3 +144,9 @@ class PasswordChangeSerializer(serializers.Serializer):
         validate_password(new_password)  # Use Django's password validators
 
         return attrs
+
+
+class NotificationPreferenceSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = get_user_model()
+        fields = ("notification_mode",)
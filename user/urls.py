@@ -3,6 +3,7 @@ from rest_framework.routers import DefaultRouter
 from .views import (
     AdminRegisterAPIView,
     CustomUserViewSet,
+    NotificationPreferenceAPIView,
     PasswordChangeAPIView,
     StaffLoginAPIView,
     VerificationResendViewSet,
@@ -22,6 +23,11 @@ urlpatterns = [
     path(
         "auth/change-password/", PasswordChangeAPIView.as_view(), name="change-password"
     ),
+    path(
+        "notification-preferences/",
+        NotificationPreferenceAPIView.as_view(),
+        name="notification-preferences",
+    ),
     path("admin/register/", AdminRegisterAPIView.as_view(), name="admin-register"),
     path("admin/login/", StaffLoginAPIView.as_view(), name="admin-login"),
     path("", include(router.urls)),  # Include the router-generated URLs
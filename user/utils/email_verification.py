@@ -8,6 +8,7 @@ from django.urls import reverse
 from django.core.mail import EmailMultiAlternatives
 from django.template.loader import render_to_string
 
+from firebase.mailer import send_email
 from firebase.models import User
 
 
@@ -43,11 +44,10 @@ def send_verification_email(request, user, email_subject="Verify your email"):
     )
     email.attach_alternative(html_message, "text/html")
 
-    try:
-        email.send()
+    if send_email(email):
         print(f"✅ Verification email sent to {user.email}")
-    except Exception as e:
-        print(f"❌ Failed to send email: {e}")
+    else:
+        print(f"❌ Failed to send email to {user.email}")
 
     return otp, token, verification_url
 
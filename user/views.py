@@ -14,6 +14,7 @@ from user.utils.email_verification import (
 from .serializers import (
     AdminUserCreateSerializer,
     CustomUserCreateSerializer,
+    NotificationPreferenceSerializer,
     PasswordChangeSerializer,
     StaffTokenCreateSerializer,
 )
@@ -197,3 +198,20 @@ class PasswordChangeAPIView(APIView):
         return Response(
             {"message": "Password updated successfully."}, status=status.HTTP_200_OK
         )
+
+
+class NotificationPreferenceAPIView(APIView):
+    """Read or change how the current user receives event notifications."""
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        return Response(NotificationPreferenceSerializer(request.user).data)
+
+    def patch(self, request):
+        serializer = NotificationPreferenceSerializer(
+            request.user, data=request.data, partial=True
+        )
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data)